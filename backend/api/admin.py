@@ -4,9 +4,11 @@ from .models import (
     Category, InstrumentType, Instrument,
     ConfigurableField, FieldOption,
     AddOn, AddOnType, Quotation, QuotationItem,
-    QuotationItemSelection, QuotationItemAddOn
+    QuotationItemSelection, QuotationItemAddOn, QuotationDeliveryJob, StoredBlob, MediaUploadJob
 )
 from django.utils.translation import gettext_lazy as _
+from .pdf_export import QuotationPdfExport, export_response
+from .pricing import reprice_quotation
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -128,8 +130,11 @@ class QuotationItemInline(admin.TabularInline):
     readonly_fields = ['product_code', 'quantity', 'instrument', 'total_price_display']
     inlines = [QuotationItemSelectionInline, QuotationItemAddOnInline]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('instrument')
+
     def total_price_display(self, obj):
-        return f"RM {obj.calculate_total_price():,.2f}"
+        return f"RM {obj.line_total:,.2f}"
     total_price_display.short_description = "Total Price (RM)"
 
 @admin.register(Quotation)
@@ -144,6 +149,7 @@ class QuotationAdmin(admin.ModelAdmin):
     search_fields = ['id', 'company', 'created_by__username', 'reviewed_by__username']
     inlines = [QuotationItemInline]
     list_per_page = 25
+    list_select_related = ['created_by', 'reviewed_by']
 
     fieldsets = (
         (None, {'fields': ('created_by', 'company', 'project_name')}),
@@ -157,11 +163,16 @@ class QuotationAdmin(admin.ModelAdmin):
         'total_quotation_price'
     ]
 
-    actions = ['submit_quotation', 'approve_quotation', 'reject_quotation']
+    actions = ['export_pdfs', 'submit_quotation', 'approve_quotation', 'reject_quotation']
 
     def has_view_or_change_permission(self, request, obj=None):
         return request.user.is_authenticated and request.user.role in ['proposal_engineer', 'admin']
 
+    def export_pdfs(self, request, queryset):
+        export = QuotationPdfExport(queryset.order_by('id').values_list('id', flat=True))
+        return export_response(export)
+    export_pdfs.short_description = "Export PDFs as ZIP"
+
     def submit_quotation(self, request, queryset):
         queryset.update(status='submitted', emailed_at=timezone.now())
         self.message_user(request, "Quotations have been marked as submitted.")
@@ -182,19 +193,26 @@ class QuotationAdmin(admin.ModelAdmin):
     reject_quotation.short_description = "Reject quotations with remarks"
 
     def total_quotation_price(self, obj):
-        return f"RM {obj.calculate_total_price():,.2f}"
+        return f"RM {obj.grand_total:,.2f}"
     total_quotation_price.short_description = "Total Quotation Price (RM)"
 
     def save_model(self, request, obj, form, change):
         obj.save()
         self.log_change(request, obj, f"{'Updated' if change else 'Created'} quotation: {obj.id}")
 
+    def save_formset(self, request, form, formset, change):
+        super().save_formset(request, form, formset, change)
+        # Deleting items through the inline bypasses RepriceOnWriteMixin
+        if formset.model is QuotationItem and (formset.deleted_objects or formset.changed_objects or formset.new_objects):
+            reprice_quotation(form.instance.pk)
+
 @admin.register(QuotationItem)
 class QuotationItemAdmin(admin.ModelAdmin):
     list_display = ['id', 'quotation', 'product_code', 'instrument', 'quantity', 'total_price_display']
     list_display_links = ['id', 'product_code']  # Make id and product_code clickable
     readonly_fields = ['quotation', 'product_code', 'instrument', 'quantity', 'total_price_display', 'field_options_list', 'addons_list']
     list_per_page = 25
+    list_select_related = ['quotation__created_by', 'instrument']
 
     fieldsets = (
         (None, {
@@ -209,21 +227,61 @@ class QuotationItemAdmin(admin.ModelAdmin):
     )
 
     def total_price_display(self, obj):
-        return f"RM {obj.calculate_total_price():,.2f}"
+        return f"RM {obj.line_total:,.2f}"
     total_price_display.short_description = "Total Price (RM)"
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('selections__field_option', 'addons__addon')
+
     def field_options_list(self, obj):
-        if not obj.selections.exists():
+        selections = obj.selections.all()
+        if not selections:
             return "-"
-        return "\n".join([f"{sel.field_option.label} (RM {sel.field_option.price})" for sel in obj.selections.all()])
+        return "\n".join([f"{sel.field_option.label} (RM {sel.field_option.price})" for sel in selections])
     field_options_list.short_description = "Field Options"
 
     def addons_list(self, obj):
-        if not obj.addons.exists():
+        addons = obj.addons.all()
+        if not addons:
             return "-"
-        return "\n".join([f"{addon.addon.label} (RM {addon.addon.price})" for addon in obj.addons.all()])
+        return "\n".join([f"{addon.addon.label} (RM {addon.addon.price})" for addon in addons])
     addons_list.short_description = "Add-Ons"
 
     def save_model(self, request, obj, form, change):
         obj.save()
-        self.log_change(request, obj, f"{'Updated' if change else 'Created'} quotation item: {obj.id}")
\ No newline at end of file
+        self.log_change(request, obj, f"{'Updated' if change else 'Created'} quotation item: {obj.id}")
+
+@admin.register(QuotationDeliveryJob)
+class QuotationDeliveryJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'quotation', 'status', 'attempts', 'run_after', 'finished_at']
+    list_filter = ['status']
+    readonly_fields = ['quotation', 'requested_by', 'attempts', 'locked_at', 'last_error', 'created_at', 'finished_at']
+    list_per_page = 25
+    list_select_related = ['quotation__created_by']
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        count = queryset.filter(status='failed').update(status='pending', attempts=0, run_after=timezone.now(), finished_at=None)
+        self.message_user(request, f"{count} failed delivery job(s) queued for retry.")
+    retry_jobs.short_description = "Retry failed delivery jobs"
+
+@admin.register(StoredBlob)
+class StoredBlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'field', 'size', 'created_at']
+    list_filter = ['field']
+    search_fields = ['name', 'sha256']
+    readonly_fields = ['field', 'sha256', 'name', 'url', 'size', 'created_at']
+    list_per_page = 25
+
+@admin.register(MediaUploadJob)
+class MediaUploadJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'field', 'object_id', 'file_name', 'status', 'attempts', 'run_after', 'finished_at']
+    list_filter = ['status', 'field']
+    readonly_fields = ['field', 'object_id', 'requested_by', 'staged_path', 'file_name', 'sha256', 'blob', 'attempts', 'locked_at', 'last_error', 'created_at', 'finished_at']
+    list_per_page = 25
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        count = queryset.filter(status='failed').update(status='pending', attempts=0, run_after=timezone.now(), finished_at=None)
+        self.message_user(request, f"{count} failed media upload job(s) queued for retry.")
+    retry_jobs.short_description = "Retry failed media upload jobs"
@@ -0,0 +1,82 @@
+"""
+Content-addressed media uploads.
+
+Upload handlers hash the body while it streams to disk and leave the hex digest
+on the uploaded file as `file.sha256`. store_blob() looks the digest up in
+StoredBlob first: a known file is reused without touching the storage backend,
+so re-sending the same datasheet or image costs one indexed query instead of a
+remote transfer. Blobs are keyed per FileField because each field has its own
+storage (raw vs image Cloudinary).
+"""
+import hashlib
+import logging
+
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import IntegrityError, transaction
+
+from .models import StoredBlob
+
+logger = logging.getLogger(__name__)
+
+HASH_BUFFER_SIZE = 64 * 1024
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """Spools uploads to a temporary file and records their SHA-256 as `file.sha256`."""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.digest.hexdigest()
+        return file
+
+
+def file_sha256(file):
+    """Digest recorded by HashingUploadHandler, or computed by reading `file` once."""
+    if getattr(file, 'sha256', None):
+        return file.sha256
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(HASH_BUFFER_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def field_label(field):
+    return f"{field.model._meta.label_lower}.{field.name}"
+
+
+def find_blob(field, sha256):
+    return StoredBlob.objects.filter(field=field_label(field), sha256=sha256).first()
+
+
+def store_blob(field, file, file_name):
+    """
+    Store `file` with `field`'s storage unless identical content is already
+    there. Returns (blob, created).
+    """
+    label, sha256 = field_label(field), file_sha256(file)
+    blob = find_blob(field, sha256)
+    if blob is not None:
+        logger.info(f"Reusing stored {label} {blob.name} for {file_name}")
+        return blob, False
+
+    name = field.storage.save(field.generate_filename(None, file_name), file, max_length=field.max_length)
+    try:
+        with transaction.atomic():
+            blob = StoredBlob.objects.create(
+                field=label, sha256=sha256, name=name, url=field.storage.url(name), size=file.size
+            )
+    except IntegrityError:
+        # A concurrent upload of the same content won; keep its object and drop ours
+        field.storage.delete(name)
+        return StoredBlob.objects.get(field=label, sha256=sha256), False
+    return blob, True
@@ -0,0 +1,235 @@
+"""
+Compiled configurator documents.
+
+An instrument's configurator payload (ordered field tree, parent_field /
+trigger_value edges, options and add-ons) is built once, stored in the shared
+cache and served as-is until one of the models it was built from changes
+(see api.signals).
+"""
+import hashlib
+from decimal import Decimal
+import json
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Prefetch
+
+from .models import Instrument, ConfigurableField, FieldOption, AddOn
+
+# Bump when the document layout changes so old cache entries are ignored
+CONFIG_SCHEMA_VERSION = 1
+CONFIG_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def config_cache_key(instrument_id):
+    return f"instrument-config:v{CONFIG_SCHEMA_VERSION}:{instrument_id}"
+
+
+def build_config_document(instrument_id):
+    instrument = Instrument.objects.filter(pk=instrument_id).only('id', 'name', 'base_price').first()
+    if instrument is None:
+        return None
+
+    fields = ConfigurableField.objects.filter(instrument_id=instrument_id).order_by('order', 'id').prefetch_related(
+        Prefetch('options', queryset=FieldOption.objects.order_by('id'))
+    )
+    addons = AddOn.objects.filter(addon_type__instruments__id=instrument_id).select_related('addon_type').prefetch_related(
+        Prefetch('addon_type__instruments', queryset=Instrument.objects.only('id').order_by('id'))
+    ).order_by('id')
+
+    compiled_fields = []
+    dependencies = []
+    for field in fields:
+        compiled_fields.append({
+            'id': field.id,
+            'instrument': field.instrument_id,
+            'name': field.name,
+            'order': field.order,
+            'parent_field': field.parent_field_id,
+            'trigger_value': field.trigger_value,
+            'options': [
+                {'id': option.id, 'field': field.id, 'label': option.label, 'code': option.code, 'price': str(option.price)}
+                for option in field.options.all()
+            ],
+        })
+        if field.parent_field_id:
+            dependencies.append({
+                'field': field.id,
+                'parent_field': field.parent_field_id,
+                'trigger_value': field.trigger_value,
+            })
+
+    compiled_addons = [
+        {
+            'id': addon.id,
+            'addon_type': {
+                'id': addon.addon_type.id,
+                'name': addon.addon_type.name,
+                'instruments': [related.id for related in addon.addon_type.instruments.all()],
+            },
+            'label': addon.label,
+            'code': addon.code,
+            'price': str(addon.price),
+        }
+        for addon in addons
+    ]
+
+    return {
+        'id': instrument.id,
+        'name': instrument.name,
+        'base_price': str(instrument.base_price),
+        'version': CONFIG_SCHEMA_VERSION,
+        'fields': compiled_fields,
+        'dependencies': dependencies,
+        'addons': compiled_addons,
+    }
+
+
+def get_instrument_config(instrument_id):
+    """Return {'etag': ..., 'document': ...} for an instrument, or None if it does not exist."""
+    key = config_cache_key(instrument_id)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry
+
+    document = build_config_document(instrument_id)
+    if document is None:
+        return None
+    encoded = json.dumps(document, sort_keys=True, separators=(',', ':')).encode()
+    entry = {'etag': hashlib.sha256(encoded).hexdigest()[:32], 'document': document}
+    cache.set(key, entry, CONFIG_CACHE_TIMEOUT)
+    return entry
+
+
+def invalidate_instrument_configs(instrument_ids):
+    keys = [config_cache_key(instrument_id) for instrument_id in set(instrument_ids) if instrument_id]
+    if keys:
+        # After commit, so a concurrent rebuild cannot cache the pre-change rows
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class ConfigurationError(Exception):
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+# Process-local compiled graphs, keyed by instrument id and checked against the document etag
+_compiled_graphs = {}
+
+
+def _compile_graph(document):
+    fields = []
+    options = {}
+    for field in document['fields']:
+        fields.append((field['id'], field['name'], field['parent_field'], field['trigger_value'], bool(field['options'])))
+        for option in field['options']:
+            options[option['id']] = (field['id'], option['code'], option['label'], Decimal(option['price']))
+    addons = {
+        addon['id']: (position, addon['code'], addon['label'], Decimal(addon['price']))
+        for position, addon in enumerate(document['addons'])
+    }
+    return {
+        'base_price': Decimal(document['base_price']),
+        'fields': fields,
+        'options': options,
+        'addons': addons,
+    }
+
+
+def get_compiled_graph(instrument_id):
+    entry = get_instrument_config(instrument_id)
+    if entry is None:
+        return None
+    cached = _compiled_graphs.get(instrument_id)
+    if cached is None or cached[0] != entry['etag']:
+        cached = (entry['etag'], _compile_graph(entry['document']))
+        _compiled_graphs[instrument_id] = cached
+    return cached[1]
+
+
+def evaluate_configuration(instrument_id, option_ids=(), addon_ids=(), quantity=1):
+    """
+    Validate a configurator selection and return its canonical product code and price breakdown.
+
+    Fields are walked in order; a field with a parent_field is only active when the option chosen
+    for the parent has code == trigger_value. Every active field with options needs exactly one
+    option, inactive fields must have none. Raises ConfigurationError listing every problem.
+    """
+    graph = get_compiled_graph(instrument_id)
+    if graph is None:
+        raise ConfigurationError([f"Instrument {instrument_id} does not exist."])
+
+    errors = []
+    chosen = {}
+    for option_id in option_ids:
+        option = graph['options'].get(option_id)
+        if option is None:
+            errors.append(f"Option {option_id} does not belong to instrument {instrument_id}.")
+        elif option[0] in chosen:
+            errors.append(f"More than one option selected for field {option[0]}.")
+        else:
+            chosen[option[0]] = (option_id,) + option[1:]
+
+    parents = {field[0]: (field[2], field[3]) for field in graph['fields']}
+    activity = {}
+
+    def is_active(field_id):
+        # A field is active when its parent is active and the parent's chosen code matches trigger_value
+        if field_id not in activity:
+            activity[field_id] = False  # guards against parent_field cycles
+            parent_field, trigger_value = parents.get(field_id, (None, None))
+            activity[field_id] = parent_field is None or (
+                is_active(parent_field) and parent_field in chosen and chosen[parent_field][1] == trigger_value
+            )
+        return activity[field_id]
+
+    code_segments = []
+    selections = []
+    for field_id, name, parent_field, trigger_value, has_options in graph['fields']:
+        selection = chosen.get(field_id)
+        if not is_active(field_id):
+            if selection:
+                errors.append(f"Option {selection[0]} selected for '{name}', which is not active for this configuration.")
+            continue
+        if selection is None:
+            if has_options:
+                errors.append(f"No option selected for '{name}'.")
+            continue
+        option_id, code, label, price = selection
+        code_segments.append(f"[{code}]")
+        selections.append({'field': field_id, 'field_name': name, 'option': option_id, 'label': label, 'code': code, 'price': price})
+
+    addons = []
+    for addon_id in dict.fromkeys(addon_ids):
+        addon = graph['addons'].get(addon_id)
+        if addon is None:
+            errors.append(f"Add-on {addon_id} is not available for instrument {instrument_id}.")
+        else:
+            addons.append(addon + (addon_id,))
+
+    if quantity < 1:
+        errors.append("Quantity must be at least 1.")
+    if errors:
+        raise ConfigurationError(errors)
+
+    addons.sort()
+    if addons:
+        code_segments.append(f"[{''.join(addon[1] for addon in addons)}]")
+
+    unit_price = graph['base_price'] + sum((s['price'] for s in selections), Decimal('0')) + sum(
+        (addon[3] for addon in addons), Decimal('0')
+    )
+    return {
+        'instrument': instrument_id,
+        'product_code': ''.join(code_segments),
+        'base_price': graph['base_price'],
+        'selections': selections,
+        'addons': [
+            {'addon': addon_id, 'label': label, 'code': code, 'price': price}
+            for _, code, label, price, addon_id in addons
+        ],
+        'unit_price': unit_price,
+        'quantity': quantity,
+        'line_total': unit_price * quantity,
+    }
@@ -0,0 +1,162 @@
+"""
+Background delivery of approved quotations to the sales team.
+
+QuotationSubmitView only enqueues a QuotationDeliveryJob and returns 202; the
+PDF render and SMTP send happen in `manage.py run_quotation_worker` (or
+run_pending_jobs() in-process, as the tests do). A quotation only moves to
+'submitted' once the email has actually been handed to the mail backend.
+Failed attempts are retried with exponential backoff up to job.max_attempts.
+"""
+from datetime import timedelta
+import logging
+import traceback
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Quotation, QuotationDeliveryJob
+from .pdf_cache import get_quotation_pdf
+
+logger = logging.getLogger(__name__)
+
+SALES_TEAM_EMAIL = 'adriannorman@graduate.utm.my'
+RETRY_BASE_DELAY = timedelta(seconds=30)
+RETRY_MAX_DELAY = timedelta(hours=1)
+# A 'running' job whose worker has not finished within this window is assumed dead and re-claimed.
+# Network calls made while holding it are capped well below it (settings.EMAIL_TIMEOUT,
+# settings.MEDIA_UPLOAD_TIMEOUT), and outcomes are only written while the lease is still held.
+JOB_LEASE = timedelta(minutes=10)
+ACTIVE_STATUSES = ('pending', 'running')
+
+
+class PermanentDeliveryError(Exception):
+    """Raised for failures that retrying cannot fix."""
+
+
+class LeaseLost(Exception):
+    """Raised when another worker re-claimed the job this worker is running."""
+
+
+def retry_delay(attempts):
+    return min(RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0), RETRY_MAX_DELAY)
+
+
+def enqueue_quotation_delivery(quotation, requested_by=None):
+    """Queue a quotation for delivery; returns the already active job if there is one."""
+    with transaction.atomic():
+        # Lock the quotation row so two concurrent submits cannot both enqueue
+        Quotation.objects.select_for_update().filter(pk=quotation.pk).exists()
+        job = quotation.delivery_jobs.filter(status__in=ACTIVE_STATUSES).order_by('id').first()
+        if job is None:
+            job = QuotationDeliveryJob.objects.create(quotation=quotation, requested_by=requested_by)
+    return job
+
+
+def claim_next_job(now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        job = (
+            QuotationDeliveryJob.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='pending', run_after__lte=now) | Q(status='running', locked_at__lt=now - JOB_LEASE))
+            .order_by('run_after', 'id')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_at = now
+        job.save(update_fields=['status', 'attempts', 'locked_at'])
+    return job
+
+
+def holds_lease(job):
+    """False once the job's lease ran out and another worker re-claimed it."""
+    return type(job).objects.filter(pk=job.pk, status='running', locked_at=job.locked_at).exists()
+
+
+def settle_job(job, **fields):
+    """
+    Write the outcome of a claimed job and release its lease. Nothing is written
+    when another worker re-claimed the job meanwhile, since that worker owns the
+    outcome now. Returns True when the outcome was recorded.
+    """
+    claimed_at = job.locked_at
+    fields['locked_at'] = None
+    for name, value in fields.items():
+        setattr(job, name, value)
+    settled = type(job).objects.filter(pk=job.pk, status='running', locked_at=claimed_at).update(**fields)
+    if not settled:
+        logger.warning(f"{type(job).__name__} {job.id} was re-claimed or superseded meanwhile; not recording this attempt")
+    return bool(settled)
+
+
+def build_submission_email(quotation, pdf_data):
+    client = quotation.created_by
+    message = EmailMessage(
+        subject=f"Approved Purchase Order Quotation #{quotation.id} Submission",
+        body=f"Dear Sales Team,\n\nQuotation #{quotation.id} from {quotation.company or 'N/A'} has been approved and submitted by {client.first_name or 'Client'} ({client.email}).\nThe PDF is attached for your reference.\n\nBest regards,\nInstruGate System",
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[SALES_TEAM_EMAIL],
+        cc=[client.email],
+    )
+    message.attach(f"Quotation_{quotation.id}.pdf", pdf_data, 'application/pdf')
+    return message
+
+
+def deliver_quotation(quotation, job=None):
+    if quotation.status != 'approved':
+        raise PermanentDeliveryError(f"Quotation {quotation.id} is '{quotation.status}', not approved")
+    if not quotation.created_by.email:
+        raise PermanentDeliveryError(f"Client email is not set for quotation {quotation.id}")
+    storage, name = get_quotation_pdf(quotation)
+    # Attached straight from the stored file; MIME encoding is the only in-memory copy
+    with storage.open(name, 'rb') as pdf_file:
+        message = build_submission_email(quotation, pdf_file.read())
+    if job is not None and not holds_lease(job):
+        raise LeaseLost(f"Delivery job {job.id} was re-claimed before sending")
+    message.send(fail_silently=False)
+
+
+def run_job(job):
+    """Run one claimed job. Returns True when the quotation was delivered."""
+    try:
+        quotation = Quotation.objects.with_details().filter(pk=job.quotation_id).first()
+        if quotation is None:
+            raise PermanentDeliveryError(f"Quotation {job.quotation_id} no longer exists")
+        deliver_quotation(quotation, job)
+    except LeaseLost as e:
+        logger.warning(str(e))
+        return False
+    except Exception as e:
+        logger.error(f"Delivery job {job.id} for quotation {job.quotation_id} failed (attempt {job.attempts}): {str(e)}\n{traceback.format_exc()}")
+        if isinstance(e, PermanentDeliveryError) or job.attempts >= job.max_attempts:
+            settle_job(job, status='failed', last_error=str(e), finished_at=timezone.now())
+        else:
+            settle_job(job, status='pending', last_error=str(e), run_after=timezone.now() + retry_delay(job.attempts))
+        return False
+
+    now = timezone.now()
+    with transaction.atomic():
+        # The email is out either way, so the quotation is marked submitted even if the lease was lost
+        quotation.status = 'submitted'
+        quotation.emailed_at = now
+        quotation.save(update_fields=['status', 'emailed_at', 'updated_at'])
+        settle_job(job, status='succeeded', last_error='', finished_at=now)
+    logger.info(f"Quotation {quotation.id} delivered by job {job.id}")
+    return True
+
+
+def run_pending_jobs(limit=None, now=None):
+    """Claim and run due jobs until none are left (or `limit` ran). Returns the number processed."""
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_job(now)
+        if job is None:
+            break
+        run_job(job)
+        processed += 1
+    return processed
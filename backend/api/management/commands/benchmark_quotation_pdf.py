@@ -0,0 +1,76 @@
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import (
+    Instrument, FieldOption, AddOn, Quotation, QuotationItem,
+    QuotationItemSelection, QuotationItemAddOn
+)
+from api.pdf import RenderContext, generate_quotation_pdf, get_render_context
+from users.models import CustomUser
+
+
+def build_sample_quotation(item_count):
+    """Unsaved quotation with `item_count` items, shaped like Quotation.objects.with_details() output."""
+    client = CustomUser(first_name='Benchmark', email='benchmark@example.com')
+    quotation = Quotation(
+        id=1, created_by=client, reviewed_by=client, company='ACME Sdn Bhd', project_name='Benchmark Plant',
+        status='approved', submitted_at=timezone.now(), approved_at=timezone.now(),
+        grand_total=Decimal('150.00') * item_count,
+    )
+    instrument = Instrument(id=1, name='Bourdon Tube Pressure Gauge', base_price=Decimal('100.00'))
+    options = [FieldOption(id=n, label=f"Option {n}", code=f"O{n}", price=Decimal('10.00')) for n in range(4)]
+    addons = [AddOn(id=n, label=f"Add-on {n}", code=f"A{n}", price=Decimal('5.00')) for n in range(2)]
+
+    items = []
+    for n in range(item_count):
+        item = QuotationItem(
+            id=n + 1, quotation=quotation, instrument=instrument, quantity=1 + n % 3,
+            product_code='[O0][O1][O2][A0A1]', unit_price=Decimal('150.00'), line_total=Decimal('150.00'),
+        )
+        # Vary the block heights so page packing is exercised
+        item._prefetched_objects_cache = {
+            'selections': [QuotationItemSelection(quotation_item=item, field_option=option) for option in options[:1 + n % 4]],
+            'addons': [QuotationItemAddOn(quotation_item=item, addon=addon) for addon in addons[:n % 3]],
+        }
+        items.append(item)
+    quotation._prefetched_objects_cache = {'items': items}
+    return quotation
+
+
+class Command(BaseCommand):
+    help = "Time generate_quotation_pdf() for quotations of different sizes (no database access)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, nargs='+', default=[1, 50, 500], help="Item counts to render")
+        parser.add_argument('--repeat', type=int, default=3, help="Renders per size; the best time is reported")
+
+    def time_best(self, func, repeat):
+        """(best time, last result) of `repeat` calls to func()."""
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - started)
+        return min(timings), result
+
+    def handle(self, *args, **options):
+        # Per-render setup: styles, table styles and the letterhead. Building a
+        # RenderContext is what every render used to pay; now it is a cached lookup.
+        built, _ = self.time_best(RenderContext, options['repeat'])
+        get_render_context()
+        cached, _ = self.time_best(get_render_context, options['repeat'])
+        self.stdout.write(
+            f"render setup: {built * 1000:.1f} ms when built per render, {cached * 1e6:.1f} µs from the process context"
+        )
+
+        for item_count in options['items']:
+            quotation = build_sample_quotation(item_count)
+            best, pdf_data = self.time_best(lambda: generate_quotation_pdf(quotation), options['repeat'])
+            pages = pdf_data.count(b'/Type /Page\n') or pdf_data.count(b'/Type /Page ')
+            self.stdout.write(
+                f"{item_count:>5} items: best {best * 1000:8.1f} ms, "
+                f"{pages} page(s), {len(pdf_data) / 1024:.0f} KiB"
+            )
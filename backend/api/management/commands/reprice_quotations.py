@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Quotation
+from api.pricing import reprice_quotation_items
+
+
+class Command(BaseCommand):
+    help = "Backfill the stored quotation totals, or verify them against the live calculation."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="Quotation ids to process (default: all)")
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="Only compare stored totals with calculate_total_price(); exit non-zero on mismatch",
+        )
+        parser.add_argument(
+            '--touch', action='store_true',
+            help="Also bump updated_at, which invalidates the cached PDFs (default: leave it unchanged)",
+        )
+
+    def handle(self, *args, **options):
+        queryset = Quotation.objects.order_by('id')
+        if options['ids']:
+            queryset = queryset.filter(id__in=options['ids'])
+
+        if options['verify']:
+            mismatches = 0
+            for quotation in queryset.iterator():
+                live_total = quotation.calculate_total_price()
+                if live_total != quotation.grand_total:
+                    mismatches += 1
+                    self.stdout.write(
+                        f"Quotation {quotation.id}: stored RM {quotation.grand_total:,.2f}, live RM {live_total:,.2f}"
+                    )
+                for item in quotation.items.all():
+                    live_line_total = item.calculate_total_price()
+                    if live_line_total != item.line_total:
+                        mismatches += 1
+                        self.stdout.write(
+                            f"  QuotationItem {item.id}: stored RM {item.line_total:,.2f}, live RM {live_line_total:,.2f}"
+                        )
+            if mismatches:
+                raise CommandError(f"{mismatches} stored total(s) out of date; run without --verify to backfill.")
+            self.stdout.write(self.style.SUCCESS("All stored quotation totals match."))
+            return
+
+        count = 0
+        for quotation_id in queryset.values_list('id', flat=True).iterator():
+            reprice_quotation_items(quotation_id, touch=options['touch'])
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Repriced {count} quotation(s)."))
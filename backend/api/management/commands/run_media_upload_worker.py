@@ -0,0 +1,34 @@
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.media import run_pending_media_uploads
+
+
+class Command(BaseCommand):
+    help = "Push staged chat files and instrument images to remote storage (MediaUploadJob)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the jobs that are due, then exit")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the queue is empty")
+
+    def handle(self, *args, **options):
+        # Cloudinary uploads go through urllib3 without a timeout of their own, which
+        # falls back to the process-wide socket default
+        socket.setdefaulttimeout(settings.MEDIA_UPLOAD_TIMEOUT)
+        self.stdout.write("Media upload worker started.")
+        try:
+            while True:
+                close_old_connections()
+                processed = run_pending_media_uploads()
+                if processed:
+                    self.stdout.write(f"Processed {processed} media upload job(s).")
+                if options['once']:
+                    break
+                if not processed:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Media upload worker stopped.")
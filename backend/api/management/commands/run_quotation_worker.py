@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.delivery import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Render and email queued quotation submissions (QuotationDeliveryJob)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the jobs that are due, then exit")
+        parser.add_argument('--poll-interval', type=float, default=5.0, help="Seconds to sleep when the queue is empty")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Quotation delivery worker started.")
+        try:
+            while True:
+                close_old_connections()
+                processed = run_pending_jobs()
+                if processed:
+                    self.stdout.write(f"Processed {processed} delivery job(s).")
+                if options['once']:
+                    break
+                if not processed:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Quotation delivery worker stopped.")
@@ -0,0 +1,177 @@
+"""
+Background transfer of uploaded media to remote storage.
+
+Upload views no longer wait on Cloudinary. stage_media() reuses a StoredBlob
+when identical content is already stored; otherwise it copies the spooled
+upload to MEDIA_UPLOAD_STAGING_DIR, the view records a MediaUploadJob and
+answers with a pending state. `manage.py run_media_upload_worker` (or
+run_pending_media_uploads() in-process, as the tests do) pushes the staged file
+through store_blob(), retrying with exponential backoff, and then sends
+media_upload_finished so the app that owns the row can point it at the blob and
+announce the result on the channel layer.
+"""
+from collections import namedtuple
+import logging
+import os
+from pathlib import Path
+import shutil
+import traceback
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .blobs import field_label, file_sha256, find_blob, store_blob
+from .delivery import JOB_LEASE, retry_delay, settle_job
+from .models import MediaUploadJob
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+StagedMedia = namedtuple('StagedMedia', ['path', 'sha256'])
+
+# Sent with sender=<model of the target field>, job=<MediaUploadJob> and blob=<StoredBlob>,
+# or blob=None once the job has failed for good. Sent inside the job's transaction.
+media_upload_finished = Signal()
+
+
+def resolve_field(label):
+    app_label, model_name, field_name = label.split('.')
+    return apps.get_model(app_label, model_name)._meta.get_field(field_name)
+
+
+def stage_media(field, file):
+    """
+    (blob, None) when `field` already stores this content, otherwise
+    (None, StagedMedia) with `file` copied to MEDIA_UPLOAD_STAGING_DIR.
+    """
+    sha256 = file_sha256(file)
+    blob = find_blob(field, sha256)
+    if blob is not None:
+        return blob, None
+
+    directory = Path(settings.MEDIA_UPLOAD_STAGING_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / uuid.uuid4().hex
+    file.seek(0)
+    with open(path, 'wb') as staged:
+        shutil.copyfileobj(file, staged, COPY_BUFFER_SIZE)
+    file.seek(0)
+    return None, StagedMedia(str(path), sha256)
+
+
+def discard_staged(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def enqueue_media_upload(instance, field_name, staged, file_name, requested_by=None):
+    """Queue the staged file for `instance.<field_name>`; call inside the transaction that saved `instance`."""
+    return MediaUploadJob.objects.create(
+        field=field_label(instance._meta.get_field(field_name)),
+        object_id=instance.pk,
+        requested_by=requested_by,
+        staged_path=staged.path,
+        file_name=file_name,
+        sha256=staged.sha256,
+    )
+
+
+def supersede_media_uploads(instance, field_name):
+    """
+    Retire the queued and running uploads for `instance.<field_name>`; call inside
+    the transaction that points the field at newer content, so an older upload that
+    finishes later cannot overwrite it. A worker still running one of them finds
+    the job no longer 'running' and records nothing (settle_job).
+    """
+    jobs = list(
+        MediaUploadJob.objects.select_for_update()
+        .filter(field=field_label(instance._meta.get_field(field_name)), object_id=instance.pk, status__in=('pending', 'running'))
+        .values_list('id', 'staged_path')
+    )
+    if not jobs:
+        return 0
+    MediaUploadJob.objects.filter(id__in=[job_id for job_id, _ in jobs]).update(
+        status='superseded', locked_at=None, finished_at=timezone.now()
+    )
+    transaction.on_commit(lambda: [discard_staged(path) for _, path in jobs])
+    return len(jobs)
+
+
+def announce_media(group, **payload):
+    """Best-effort `media.stored` event; the database row is the source of truth."""
+    try:
+        async_to_sync(get_channel_layer().group_send)(group, {'type': 'media.stored', **payload})
+    except Exception as e:
+        logger.warning(f"Could not announce stored media to {group}: {str(e)}")
+
+
+def claim_next_media_job(now=None):
+    now = now or timezone.now()
+    with transaction.atomic():
+        job = (
+            MediaUploadJob.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='pending', run_after__lte=now) | Q(status='running', locked_at__lt=now - JOB_LEASE))
+            .order_by('run_after', 'id')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_at = now
+        job.save(update_fields=['status', 'attempts', 'locked_at'])
+    return job
+
+
+def run_media_job(job):
+    """Run one claimed job. Returns True when the file was stored."""
+    field = None
+    try:
+        field = resolve_field(job.field)
+        with open(job.staged_path, 'rb') as staged:
+            file = File(staged, name=job.file_name)
+            file.sha256 = job.sha256
+            blob, _ = store_blob(field, file, job.file_name)
+    except Exception as e:
+        logger.error(f"Media upload job {job.id} for {job.field} {job.object_id} failed (attempt {job.attempts}): {str(e)}\n{traceback.format_exc()}")
+        # Without the staged file there is nothing left to retry
+        if isinstance(e, (FileNotFoundError, LookupError)) or job.attempts >= job.max_attempts:
+            with transaction.atomic():
+                if settle_job(job, status='failed', last_error=str(e), finished_at=timezone.now()) and field is not None:
+                    media_upload_finished.send(sender=field.model, job=job, blob=None)
+        else:
+            settle_job(job, status='pending', last_error=str(e), run_after=timezone.now() + retry_delay(job.attempts))
+        return False
+
+    # A worker that re-claimed the job meanwhile finds the same blob (store_blob is keyed
+    # on the content hash) and finishes the job itself
+    with transaction.atomic():
+        if not settle_job(job, blob=blob, status='succeeded', last_error='', finished_at=timezone.now()):
+            return False
+        media_upload_finished.send(sender=field.model, job=job, blob=blob)
+    discard_staged(job.staged_path)
+    logger.info(f"Media upload job {job.id} stored {job.field} {job.object_id} as {blob.name}")
+    return True
+
+
+def run_pending_media_uploads(limit=None, now=None):
+    """Claim and run due jobs until none are left (or `limit` ran). Returns the number processed."""
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_media_job(now)
+        if job is None:
+            break
+        run_media_job(job)
+        processed += 1
+    return processed
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.7 on 2026-10-17 17:54
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def price_sum(model, price_field):
+    # Per-item sum of one priced relation, as a correlated subquery
+    return Coalesce(Subquery(
+        model.objects.filter(quotation_item=OuterRef('pk')).values('quotation_item')
+        .annotate(total=Sum(price_field)).values('total')
+    ), Value(0), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+
+
+def backfill_totals(apps, schema_editor):
+    # Same arithmetic as api.pricing, in three set-based UPDATEs; updated_at is not
+    # touched so cached PDFs stay valid
+    Instrument = apps.get_model('api', 'Instrument')
+    Quotation = apps.get_model('api', 'Quotation')
+    QuotationItem = apps.get_model('api', 'QuotationItem')
+    QuotationItemSelection = apps.get_model('api', 'QuotationItemSelection')
+    QuotationItemAddOn = apps.get_model('api', 'QuotationItemAddOn')
+
+    base_price = Subquery(Instrument.objects.filter(pk=OuterRef('instrument_id')).values('base_price'))
+    QuotationItem.objects.update(
+        unit_price=base_price
+        + price_sum(QuotationItemSelection, 'field_option__price')
+        + price_sum(QuotationItemAddOn, 'addon__price')
+    )
+    QuotationItem.objects.update(line_total=F('unit_price') * F('quantity'))
+    Quotation.objects.update(grand_total=Coalesce(Subquery(
+        QuotationItem.objects.filter(quotation=OuterRef('pk')).values('quotation')
+        .annotate(total=Sum('line_total')).values('total')
+    ), Value(0), output_field=models.DecimalField(max_digits=14, decimal_places=2)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0032_alter_instrument_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quotation',
+            name='grand_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='quotationitem',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='quotationitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0033_quotation_stored_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='quotation',
+            index=models.Index(fields=['submitted_at', 'id'], name='quotation_submitted_id_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-17 18:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0035_quotation_delivery_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=100)),
+                ('sha256', models.CharField(max_length=64)),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.CharField(max_length=500)),
+                ('size', models.PositiveBigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storedblob',
+            constraint=models.UniqueConstraint(fields=('field', 'sha256'), name='stored_blob_field_sha256_uniq'),
+        ),
+        migrations.AddField(
+            model_name='instrument',
+            name='image_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.storedblob'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0037_media_upload_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediauploadjob',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('superseded', 'Superseded')], default='pending', max_length=20),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from cloudinary_storage.storage import MediaCloudinaryStorage 
 
@@ -41,6 +42,25 @@ class InstrumentType(models.Model):
     def __str__(self):
         return f"{self.name} ({self.category.name})"
 
+# One stored media object per distinct content, so re-uploading the same bytes
+# reuses it instead of transferring it again (see api.blobs)
+class StoredBlob(models.Model):
+    # Which FileField's storage holds the object, e.g. 'api.instrument.image'
+    field = models.CharField(max_length=100)
+    sha256 = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
+    url = models.CharField(max_length=500)
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['field', 'sha256'], name='stored_blob_field_sha256_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.sha256[:12]})"
+
 class Instrument(models.Model):
     type = models.ForeignKey(InstrumentType, on_delete=models.CASCADE, related_name='instruments')
     name = models.CharField(max_length=100)
@@ -55,6 +75,7 @@ class Instrument(models.Model):
         blank=True,
         null=True
     )
+    image_blob = models.ForeignKey(StoredBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
 
     is_available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -105,6 +126,13 @@ class AddOn(models.Model):
     def __str__(self):
         return f"[{self.code}] {self.label} ({self.addon_type.name})"
 
+class QuotationQuerySet(models.QuerySet):
+    def with_details(self):
+        # Everything QuotationSerializer and generate_quotation_pdf walk, in a fixed number of queries
+        return self.select_related('created_by', 'reviewed_by').prefetch_related(
+            models.Prefetch('items', queryset=QuotationItem.objects.with_details()),
+        )
+
 class Quotation(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -123,23 +151,48 @@ class Quotation(models.Model):
     reviewed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='reviewed_quotations')
     emailed_at = models.DateTimeField(blank=True, null=True)  # Replaced submitted_to_sales_at
     updated_at = models.DateTimeField(auto_now=True)
+    grand_total = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)  # Maintained by api.pricing
+
+    objects = QuotationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the review queue orders on (submitted_at, id)
+            models.Index(fields=['submitted_at', 'id'], name='quotation_submitted_id_idx'),
+        ]
 
     def __str__(self):
         return f"Quotation {self.id} by {self.created_by.username} ({self.status})"
     
     def calculate_total_price(self):
+        # Live calculation; list endpoints read the stored grand_total instead
         return sum(item.calculate_total_price() for item in self.items.all())
 
+class QuotationItemQuerySet(models.QuerySet):
+    def with_details(self):
+        return self.select_related('instrument__type__category').prefetch_related(
+            models.Prefetch('selections', queryset=QuotationItemSelection.objects.select_related('field_option')),
+            models.Prefetch(
+                'addons',
+                queryset=QuotationItemAddOn.objects.select_related('addon__addon_type').prefetch_related('addon__addon_type__instruments'),
+            ),
+        )
+
 class QuotationItem(models.Model):
     quotation = models.ForeignKey(Quotation, on_delete=models.CASCADE, related_name='items')
     product_code = models.CharField(max_length=100)
     quantity = models.PositiveIntegerField(default=1)
     instrument = models.ForeignKey(Instrument, on_delete=models.CASCADE)
+    unit_price = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)  # Maintained by api.pricing
+    line_total = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)  # unit_price * quantity
+
+    objects = QuotationItemQuerySet.as_manager()
 
     def __str__(self):
         return f"(Quotation {self.quotation.id})"
     
     def calculate_total_price(self):
+        # Live calculation; list endpoints read the stored line_total instead
         base_price = self.instrument.base_price
 
         # Selections
@@ -169,4 +222,67 @@ class QuotationItemAddOn(models.Model):
         unique_together = ('quotation_item', 'addon')
 
     def __str__(self):
-        return f"AddOn {self.addon} for QuotationItem {self.quotation_item.id}"
\ No newline at end of file
+        return f"AddOn {self.addon} for QuotationItem {self.quotation_item.id}"
+
+# Durable queue for submitting approved quotations to sales (PDF render + email),
+# drained by `manage.py run_quotation_worker` instead of the request thread
+class QuotationDeliveryJob(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    )
+    quotation = models.ForeignKey(Quotation, on_delete=models.CASCADE, related_name='delivery_jobs')
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='delivery_job_status_run_idx'),
+        ]
+
+    def __str__(self):
+        return f"Delivery job {self.id} for Quotation {self.quotation_id} ({self.status})"
+
+# Durable queue of staged media waiting to be pushed to remote storage, drained
+# by `manage.py run_media_upload_worker` so upload requests return immediately
+class MediaUploadJob(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        ('superseded', 'Superseded'),  # a later upload set the field first
+    )
+    # Target FileField as a StoredBlob.field label, and the row it belongs to
+    field = models.CharField(max_length=100)
+    object_id = models.PositiveBigIntegerField()
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    staged_path = models.CharField(max_length=500)
+    file_name = models.CharField(max_length=255)
+    sha256 = models.CharField(max_length=64)
+    blob = models.ForeignKey(StoredBlob, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='media_job_status_run_idx'),
+        ]
+
+    def __str__(self):
+        return f"Media upload job {self.id} for {self.field} {self.object_id} ({self.status})"
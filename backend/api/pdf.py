@@ -0,0 +1,306 @@
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Frame, PageTemplate, KeepTogether, PageBreak
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.boxstuff import aspectRatioFix
+from reportlab.lib.utils import ImageReader
+from reportlab.lib.units import mm
+from reportlab.lib import colors
+from reportlab import rl_config
+import logging
+import os
+import tempfile
+from io import BytesIO
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout below changes so cached PDFs (api.pdf_cache) are re-rendered
+PDF_TEMPLATE_VERSION = 3
+# Rendered PDFs above this size are spooled to a temporary file instead of memory
+PDF_SPOOL_MAX_SIZE = 1024 * 1024
+
+# Write streams as binary. With the default ASCII85 wrapping, embedding the letterhead
+# JPEG costs ~100 ms of pure-Python encoding in every document.
+rl_config.useA85 = 0
+
+# Frame geometry shared by CustomDocTemplate and the page packer below
+FRAME_PADDING = 6  # reportlab's default Frame padding
+CONTENT_WIDTH = A4[0] - 30*mm - 2*FRAME_PADDING
+CONTENT_HEIGHT = A4[1] - 30*mm - 2*FRAME_PADDING
+ITEM_GAP = 24  # vertical space between two item blocks on the same page
+PACKING_SLACK = 1  # points kept free per page so rounding never pushes a block over
+
+class Letterhead:
+    """The letterhead JPEG and its page placement, measured once per process."""
+
+    def __init__(self, path):
+        self.path = path
+        width, height = ImageReader(path).getSize()
+        self.x, self.y, self.width, self.height, _ = aspectRatioFix(
+            True, 'c', 0, 0, A4[0], A4[1], width, height
+        )
+
+    def draw(self, canvas):
+        # Drawn by file name: drawImage() keys the XObject on the name, so each document
+        # embeds the JPEG once and every later page refers back to it. An ImageReader
+        # would be keyed on a hash of the decoded pixels, recomputed on every page.
+        canvas.drawImage(self.path, self.x, self.y, self.width, self.height)
+
+class RenderContext:
+    """
+    Everything a quotation PDF needs that does not depend on the quotation:
+    paragraph and table styles plus the measured letterhead. Built once per
+    process by get_render_context(), so renders only lay out data.
+    """
+    def __init__(self, letterhead_path=None):
+        self.title_style = ParagraphStyle(name='Title', fontSize=16, leading=20, fontName='Helvetica-Bold', spaceAfter=10, leftIndent=0, alignment=0)
+        self.heading_style = ParagraphStyle(name='Heading', fontSize=12, leading=16, fontName='Helvetica-Bold', spaceBefore=10, spaceAfter=8, leftIndent=0, alignment=0)
+        self.normal_style = ParagraphStyle(name='Normal', fontSize=10, leading=12, fontName='Helvetica')
+        self.bold_style = ParagraphStyle(name='Bold', fontSize=10, leading=12, fontName='Helvetica-Bold', leftIndent=0)
+        self.list_style = ParagraphStyle(name='List', fontSize=10, leading=14, fontName='Helvetica')
+
+        self.details_table_style = TableStyle([
+            ('FONT', (0, 0), (-1, -1), 'Helvetica', 10),
+            ('LEFTPADDING', (0, 0), (-1, -1), 5),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ])
+        self.divider_table_style = TableStyle([
+            ('LINEBELOW', (0, 0), (-1, -1), 0.3, colors.HexColor('#646464')),
+        ])
+        self.item_table_style = TableStyle([
+            ('FONT', (0, 0), (-1, -1), 'Helvetica', 10),
+            ('LEFTPADDING', (0, 0), (-1, -1), 5),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 5),
+            ('TOPPADDING', (0, 0), (-1, -1), 2),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ])
+        self.item_number_table_style = TableStyle([
+            ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold', 10),
+            ('LEFTPADDING', (0, 0), (-1, -1), 5),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+            ('TOPPADDING', (0, 0), (-1, -1), 0),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 0),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ])
+
+        letterhead_path = letterhead_path or os.path.join(settings.STATIC_ROOT, 'images', 'letterhead.jpg')
+        self.letterhead = None
+        if os.path.exists(letterhead_path):
+            try:
+                self.letterhead = Letterhead(letterhead_path)
+            except Exception as e:
+                logger.error(f"Failed to load letterhead {letterhead_path}: {str(e)}\n{traceback.format_exc()}")
+        else:
+            logger.warning(f"Letterhead not found at {letterhead_path}")
+
+_render_context = None
+
+def get_render_context():
+    global _render_context
+    if _render_context is None:
+        _render_context = RenderContext()
+    return _render_context
+
+def page_canvas(canvas, doc):
+    letterhead = doc.render_context.letterhead
+    if letterhead is None:
+        return
+    try:
+        letterhead.draw(canvas)
+    except Exception as e:
+        logger.error(f"Failed to render letterhead on page {doc.page}: {str(e)}\n{traceback.format_exc()}")
+
+class CustomDocTemplate(SimpleDocTemplate):
+    # Frames track their fill position while building, so the template is per render
+    def __init__(self, filename, render_context=None, **kwargs):
+        self.render_context = render_context or get_render_context()
+        super().__init__(filename, **kwargs)
+        frame = Frame(15*mm, 15*mm, A4[0]-30*mm, A4[1]-30*mm, leftPadding=FRAME_PADDING, rightPadding=FRAME_PADDING, topPadding=FRAME_PADDING, bottomPadding=FRAME_PADDING)
+        template = PageTemplate(id='AllPages', frames=[frame], onPage=page_canvas)
+        self.addPageTemplates(template)  # Single template for all pages
+
+def measure_flowables(flowables):
+    """Height the flowables take when stacked at the top of an empty frame."""
+    height = 0
+    for position, flowable in enumerate(flowables):
+        _, flowable_height = flowable.wrap(CONTENT_WIDTH, CONTENT_HEIGHT)
+        height += flowable_height + flowable.getSpaceAfter()
+        if position:
+            height += flowable.getSpaceBefore()  # Frames drop spaceBefore at the top of a page
+    return height
+
+def pack_blocks(heights, first_capacity, capacity, gap=ITEM_GAP):
+    """
+    Assign block indexes to pages, in order, and return one list of indexes per page.
+
+    Blocks must keep their order (Item #1, #2, ...), so this is next-fit packing:
+    a page takes blocks until the next one no longer fits, which is already the
+    minimum page count for an ordered sequence.
+    """
+    pages = []
+    current, used, available = [], 0, first_capacity - PACKING_SLACK
+    for idx, height in enumerate(heights):
+        needed = height + (gap if current else 0)
+        if used + needed > available and (current or available < capacity - PACKING_SLACK):
+            pages.append(current)
+            current, used, available = [], 0, capacity - PACKING_SLACK
+            needed = height
+        current.append(idx)
+        used += needed
+    pages.append(current)
+    return pages
+
+def continued_heading(heading_style):
+    return [Paragraph("Instruments (Continued)", heading_style), Spacer(1, 10*mm)]
+
+def build_item_block(idx, item, context):
+    bold_style, normal_style, list_style = context.bold_style, context.normal_style, context.list_style
+    try:
+        item_total_price = item.line_total
+        item_total_price_str = f"RM {item_total_price:,.2f}" if item_total_price is not None else "N/A"
+    except (AttributeError, Exception) as e:
+        logger.error(f"Failed to calculate total_price for QuotationItem {item.id}: {str(e)}")
+        item_total_price_str = "N/A"
+    logger.debug(f"QuotationItem {item.id} total_price: {item_total_price_str}")
+
+    selections_text = ""
+    selections = item.selections.all()
+    if selections:
+        for s in selections:
+            if s.field_option:
+                selections_text += f"• {s.field_option.label} ({s.field_option.code})<br/>"
+    else:
+        selections_text = "None"
+
+    addons_text = ""
+    addons = item.addons.all()
+    if addons:
+        for a in addons:
+            if a.addon:
+                addons_text += f"• {a.addon.label} ({a.addon.code})<br/>"
+    else:
+        addons_text = "None"
+
+    item_data = [
+        [Paragraph("Instrument Name:", bold_style), Paragraph((item.instrument.name if item.instrument else item.name) or 'N/A', normal_style)],
+        [Paragraph("Product Code:", bold_style), Paragraph(item.product_code or 'N/A', normal_style)],
+        [Paragraph("Quantity:", bold_style), Paragraph(str(item.quantity or 1), normal_style)],
+        [Paragraph("Total Price:", bold_style), Paragraph(item_total_price_str, normal_style)],
+        [Paragraph("Selections:", bold_style), Paragraph(selections_text, list_style)],
+        [Paragraph("Add-Ons:", bold_style), Paragraph(addons_text, list_style)],
+    ]
+    item_table = Table(item_data, colWidths=[50*mm, 120*mm], style=context.item_table_style)
+    # Item #<n> in a Table for alignment
+    item_number_table = Table([[Paragraph(f"Item #{idx}", bold_style)]], colWidths=[170*mm], style=context.item_number_table_style)
+    return [item_number_table, Spacer(1, 2), item_table]  # Spacer matches Details spacing
+
+def render_quotation_pdf(quotation, output):
+    """Lay out the quotation and write the PDF into the binary file object `output`."""
+    context = get_render_context()
+    doc = CustomDocTemplate(
+        output,
+        render_context=context,
+        pagesize=A4,
+        rightMargin=20*mm,
+        leftMargin=20*mm,
+        topMargin=15*mm,
+        bottomMargin=15*mm
+    )
+    elements = []
+    title_style, heading_style, normal_style = context.title_style, context.heading_style, context.normal_style
+
+    # Title
+    elements.append(Spacer(1, 20*mm))  # Top padding
+    elements.append(Paragraph(f"Purchase Order Quotation #{quotation.id}", title_style))
+    elements.append(Spacer(1, 5*mm))
+
+    # Details: Two-column layout
+    try:
+        total_price = quotation.grand_total
+        total_price_str = f"RM {total_price:,.2f}" if total_price is not None else "N/A"
+    except Exception as e:
+        logger.error(f"Failed to calculate total_price for quotation {quotation.id}: {str(e)}")
+        total_price_str = "N/A"
+    logger.debug(f"Quotation {quotation.id} total_price: {total_price_str}")
+
+    details_left = [
+        f"<b>Submitted by:</b> {quotation.created_by.first_name if quotation.created_by else 'N/A'}",
+        f"<b>Company:</b> {quotation.company or 'N/A'}",
+        f"<b>Project:</b> {quotation.project_name or 'N/A'}",
+        f"<b>Total Quotation Price:</b> {total_price_str}",
+    ]
+    details_right = [
+        f"<b>Submitted at:</b> {quotation.submitted_at.strftime('%b %d, %Y, %I:%M %p') if quotation.submitted_at else 'N/A'}",
+        f"<b>Reviewed by:</b> {quotation.reviewed_by.first_name if quotation.reviewed_by else 'N/A'}",
+        f"<b>Status:</b> {quotation.status.capitalize() if quotation.status else 'N/A'}",
+        f"<b>Approved at:</b> {quotation.approved_at.strftime('%b %d, %Y, %I:%M %p') if quotation.approved_at else 'N/A'}",
+    ]
+
+    details_data = [[Paragraph(left, normal_style), Paragraph(right, normal_style)] for left, right in zip(details_left, details_right)]
+    details_table = Table(details_data, colWidths=[85*mm, 85*mm], style=context.details_table_style)
+    elements.append(details_table)
+    elements.append(Spacer(1, 5*mm))
+
+    # Divider
+    divider_data = [['']]
+    divider_table = Table(divider_data, colWidths=[A4[0]-40*mm], style=context.divider_table_style)
+    elements.append(divider_table)
+    elements.append(Spacer(1, 10*mm))
+
+    # Instruments section: each item block is built and measured once, then packed onto pages
+    items = quotation.items.all()
+    if not items:
+        elements.append(Paragraph("No instruments listed.", normal_style))
+    else:
+        blocks = [build_item_block(idx, item, context) for idx, item in enumerate(items, 1)]
+        heights = [measure_flowables(block) for block in blocks]
+        pages = pack_blocks(
+            heights,
+            first_capacity=CONTENT_HEIGHT - measure_flowables(elements),
+            capacity=CONTENT_HEIGHT - measure_flowables(continued_heading(heading_style)),
+        )
+        logger.debug(f"Quotation {quotation.id}: {len(blocks)} item blocks packed onto {len(pages)} page(s)")
+
+        for page_idx, page in enumerate(pages):
+            if page_idx > 0:
+                elements.append(PageBreak())
+                elements.extend(continued_heading(heading_style))
+            for position, block_idx in enumerate(page):
+                if position:
+                    elements.append(Spacer(1, ITEM_GAP))
+                elements.append(KeepTogether(blocks[block_idx]))
+
+    try:
+        doc.build(elements)
+    except Exception as e:
+        logger.error(f"PDF generation failed for quotation {quotation.id}: {str(e)}\n{traceback.format_exc()}")
+        raise
+
+def generate_quotation_pdf(quotation):
+    buffer = BytesIO()
+    try:
+        render_quotation_pdf(quotation, buffer)
+        return buffer.getvalue()
+    finally:
+        buffer.close()
+
+def spool_quotation_pdf(quotation):
+    """
+    Render into a SpooledTemporaryFile, rewound and ready to read. Small PDFs stay
+    in memory, larger ones spill to disk, so big quotations are never held as
+    extra in-memory copies. The caller closes the file.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_SIZE, mode='w+b')
+    try:
+        render_quotation_pdf(quotation, spooled)
+    except Exception:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled
@@ -0,0 +1,77 @@
+"""
+Content-addressed storage for rendered quotation PDFs.
+
+A PDF is keyed by quotation id + updated_at + PDF_TEMPLATE_VERSION. Anything
+that changes what the PDF shows (review PATCH, status change, item edits via
+api.pricing.reprice_quotation) moves updated_at, so a stored file is never
+stale and repeat downloads are a plain file read. Files live on the storage
+named by settings.QUOTATION_PDF_STORAGE.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.files import File
+from django.utils.module_loading import import_string
+
+from .models import Quotation
+from .pdf import spool_quotation_pdf, PDF_TEMPLATE_VERSION
+
+logger = logging.getLogger(__name__)
+
+PDF_CACHE_DIR = 'quotation_pdfs'
+
+
+def get_pdf_storage():
+    return import_string(settings.QUOTATION_PDF_STORAGE)()
+
+
+def quotation_pdf_key(quotation):
+    raw = f"{quotation.pk}|{quotation.updated_at.isoformat()}|v{PDF_TEMPLATE_VERSION}"
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def quotation_pdf_name(quotation):
+    return f"{PDF_CACHE_DIR}/{quotation.pk}/{quotation_pdf_key(quotation)}.pdf"
+
+
+def get_quotation_pdf(quotation, storage=None):
+    """
+    Return (storage, name) of the rendered PDF for `quotation`, rendering and
+    storing it first on a miss. `quotation` only needs id and updated_at; the
+    full object graph is loaded only when a render is actually needed.
+    """
+    storage = storage or get_pdf_storage()
+    name = quotation_pdf_name(quotation)
+    if storage.exists(name):
+        return storage, name
+
+    if 'items' not in getattr(quotation, '_prefetched_objects_cache', {}):
+        quotation = Quotation.objects.with_details().get(pk=quotation.pk)
+    # Rendered to a spooled temp file and copied to storage in chunks
+    with spool_quotation_pdf(quotation) as pdf_file:
+        return storage, store_quotation_pdf(quotation, File(pdf_file), storage)
+
+
+def store_quotation_pdf(quotation, content, storage=None):
+    """Save an already rendered PDF (a django File) under the quotation's key and return its storage name."""
+    storage = storage or get_pdf_storage()
+    name = quotation_pdf_name(quotation)
+    if not storage.exists(name):
+        name = storage.save(name, content)
+        logger.info(f"Cached PDF for quotation {quotation.pk} as {name}")
+        discard_stale_pdfs(quotation.pk, keep=name, storage=storage)
+    return name
+
+
+def discard_stale_pdfs(quotation_id, keep=None, storage=None):
+    storage = storage or get_pdf_storage()
+    directory = f"{PDF_CACHE_DIR}/{quotation_id}"
+    try:
+        _, files = storage.listdir(directory)
+    except (FileNotFoundError, NotImplementedError):
+        return
+    for filename in files:
+        name = f"{directory}/{filename}"
+        if name != keep:
+            storage.delete(name)
@@ -0,0 +1,197 @@
+"""
+Batch export of quotation PDFs as a streamed ZIP.
+
+Layout is CPU-bound reportlab work, so PDFs that are not in the PDF cache are
+rendered in a process pool that is created on first use and shared by every
+export in the worker process. Database access stays in this process: the
+quotations are loaded in chunks with with_details() and the pickled instances
+(prefetch caches included) are handed to the workers, which only run
+generate_quotation_pdf(). Each finished PDF is written into the archive and
+yielded immediately, and at most `window` quotations are in flight, so memory
+stays flat no matter how many quotations are exported. export_response()
+hands the archive to Django as an async iterator (api.streaming) so that holds
+under Daphne too.
+
+Progress is kept in the cache under the export id (see get_export_progress).
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import threading
+import uuid
+import zipfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.http import StreamingHttpResponse
+
+from .models import Quotation
+from .pdf import generate_quotation_pdf
+from .pdf_cache import get_pdf_storage, quotation_pdf_name, store_quotation_pdf
+from .streaming import async_chunks
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 50
+EXPORT_PROGRESS_TIMEOUT = 60 * 60
+
+
+def export_progress_key(export_id):
+    return f"quotation-export:{export_id}"
+
+
+def get_export_progress(export_id):
+    return cache.get(export_progress_key(export_id))
+
+
+def _init_render_worker():
+    # Forked workers inherit the configured project; spawned ones have to set it up
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+        django.setup()
+
+
+def _render_pdf(quotation):
+    return generate_quotation_pdf(quotation)
+
+
+def render_pool_size():
+    return getattr(settings, 'PDF_EXPORT_WORKERS', None) or os.cpu_count() or 1
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    """The process-wide render pool, started on first use; workers are forked once, not per export."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=render_pool_size(), initializer=_init_render_worker)
+        return _render_pool
+
+
+def discard_render_pool(pool):
+    # A worker died (BrokenProcessPool); the next export starts a fresh pool
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+class _ZipStream:
+    """Write-only sink for ZipFile; the archive is yielded piecewise via drain()."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class QuotationPdfExport:
+    def __init__(self, quotation_ids, max_workers=None, export_id=None):
+        self.quotation_ids = list(dict.fromkeys(quotation_ids))
+        self.export_id = export_id or uuid.uuid4().hex
+        # Bounds this export's share of the shared pool
+        self.max_workers = max_workers or render_pool_size()
+        self.window = self.max_workers * 2
+        self.progress = {'total': len(self.quotation_ids), 'done': 0, 'failed': [], 'finished': False}
+
+    def _report(self):
+        cache.set(export_progress_key(self.export_id), self.progress, EXPORT_PROGRESS_TIMEOUT)
+
+    def _quotations(self):
+        for start in range(0, len(self.quotation_ids), EXPORT_CHUNK_SIZE):
+            chunk = self.quotation_ids[start:start + EXPORT_CHUNK_SIZE]
+            yield from Quotation.objects.with_details().filter(pk__in=chunk).order_by('id')
+
+    def _add(self, archive, stream, quotation, pdf_data):
+        archive.writestr(f"Quotation_{quotation.pk}.pdf", pdf_data)
+        self.progress['done'] += 1
+        self._report()
+        return stream.drain()
+
+    def _collect(self, archive, stream, storage, future, quotation):
+        try:
+            pdf_data = future.result()
+        except Exception as e:
+            logger.error(f"Export {self.export_id}: PDF generation failed for quotation {quotation.pk}: {str(e)}")
+            if isinstance(e, BrokenProcessPool):
+                discard_render_pool(self.pool)
+            self.progress['failed'].append(quotation.pk)
+            self._report()
+            return b''
+        store_quotation_pdf(quotation, ContentFile(pdf_data), storage)
+        return self._add(archive, stream, quotation, pdf_data)
+
+    def __iter__(self):
+        self._report()
+        storage = get_pdf_storage()
+        stream = _ZipStream()
+        self.pool = get_render_pool()
+        in_flight = {}
+        try:
+            with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for quotation in self._quotations():
+                    name = quotation_pdf_name(quotation)
+                    if storage.exists(name):
+                        with storage.open(name, 'rb') as pdf_file:
+                            yield self._add(archive, stream, quotation, pdf_file.read())
+                        continue
+
+                    try:
+                        future = self.pool.submit(_render_pdf, quotation)
+                    except BrokenProcessPool:
+                        discard_render_pool(self.pool)
+                        self.pool = get_render_pool()
+                        future = self.pool.submit(_render_pdf, quotation)
+                    in_flight[future] = quotation
+                    if len(in_flight) >= self.window:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield self._collect(archive, stream, storage, future, in_flight.pop(future))
+
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._collect(archive, stream, storage, future, in_flight.pop(future))
+
+                if self.progress['failed']:
+                    archive.writestr(
+                        'errors.txt',
+                        "".join(f"Quotation {pk}: PDF generation failed\n" for pk in self.progress['failed'])
+                    )
+            yield stream.drain()
+        finally:
+            # The pool outlives the export; only drop this export's queued renders
+            for future in in_flight:
+                future.cancel()
+            self.progress['finished'] = True
+            self._report()
+            logger.info(
+                f"Export {self.export_id}: {self.progress['done']}/{self.progress['total']} PDFs, "
+                f"{len(self.progress['failed'])} failed"
+            )
+
+
+def export_response(export):
+    response = StreamingHttpResponse(async_chunks(export), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="Quotations_{export.export_id}.zip"'
+    response['X-Export-Id'] = export.export_id
+    return response
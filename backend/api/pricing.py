@@ -0,0 +1,75 @@
+"""
+Repricing service for the stored quotation totals.
+
+QuotationItem.unit_price / line_total and Quotation.grand_total are denormalized
+copies of what calculate_total_price() would return. They are written when a
+quotation is created and recomputed here whenever an item's quantity,
+instrument, selections or add-ons change, so that read paths never have to walk
+items -> selections -> add-ons per row.
+"""
+from decimal import Decimal
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Quotation, QuotationItem, QuotationItemSelection, QuotationItemAddOn
+
+ZERO = Decimal('0.00')
+
+
+def compute_unit_price(instrument, field_options=(), addons=()):
+    # Pure in-memory calculation, mirrors QuotationItem.calculate_total_price()
+    return (
+        instrument.base_price
+        + sum((option.price for option in field_options), ZERO)
+        + sum((addon.price for addon in addons), ZERO)
+    )
+
+
+def reprice_item(item, update_quotation=True):
+    """Recompute and store unit_price/line_total for a single QuotationItem."""
+    base_price = (
+        QuotationItem.objects.filter(pk=item.pk)
+        .values_list('instrument__base_price', flat=True)
+        .first()
+    )
+    if base_price is None:
+        return item
+    selections_total = QuotationItemSelection.objects.filter(quotation_item_id=item.pk).aggregate(
+        total=Sum('field_option__price')
+    )['total'] or ZERO
+    addons_total = QuotationItemAddOn.objects.filter(quotation_item_id=item.pk).aggregate(
+        total=Sum('addon__price')
+    )['total'] or ZERO
+
+    item.unit_price = base_price + selections_total + addons_total
+    item.line_total = item.unit_price * item.quantity
+    # queryset.update() so no model signals fire and updated_at stays untouched
+    QuotationItem.objects.filter(pk=item.pk).update(unit_price=item.unit_price, line_total=item.line_total)
+
+    if update_quotation:
+        reprice_quotation(item.quotation_id)
+    return item
+
+
+def reprice_quotation(quotation_id, touch=True):
+    """
+    Recompute Quotation.grand_total from the stored line totals. Every item write
+    ends here, so this is also where the quotation's updated_at (which keys the
+    cached PDF) moves forward; backfills pass touch=False to leave it alone.
+    """
+    grand_total = QuotationItem.objects.filter(quotation_id=quotation_id).aggregate(
+        total=Sum('line_total')
+    )['total'] or ZERO
+    fields = {'grand_total': grand_total}
+    if touch:
+        fields['updated_at'] = timezone.now()
+    Quotation.objects.filter(pk=quotation_id).update(**fields)
+    return grand_total
+
+
+def reprice_quotation_items(quotation_id, touch=True):
+    """Recompute every item of a quotation, then its grand_total."""
+    for item in QuotationItem.objects.filter(quotation_id=quotation_id).only('id', 'quantity', 'quotation_id'):
+        reprice_item(item, update_quotation=False)
+    return reprice_quotation(quotation_id, touch=touch)
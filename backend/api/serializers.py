@@ -5,11 +5,92 @@ from .models import (
     AddOn, AddOnType, Quotation, QuotationItem,
     QuotationItemSelection, QuotationItemAddOn
 )
+from .pricing import compute_unit_price, ZERO
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connection, transaction
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
+# Lets a view pass fields=[...] to serialize only a subset of the declared fields
+class ProjectedFieldsMixin:
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+# PrimaryKeyRelatedField that resolves ids from the maps BatchedRelatedFieldsMixin preloads
+# into context['preloaded'], so N ids cost one query per queryset instead of N queries
+class BatchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    def preload_key(self):
+        queryset = self.get_queryset()
+        return (queryset.model, str(queryset.query))
+
+    def to_pk(self, data):
+        if isinstance(data, bool):
+            raise TypeError(data)
+        return self.get_queryset().model._meta.pk.to_python(data)
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get('preloaded', {}).get(self.preload_key())
+        try:
+            pk = self.to_pk(data)
+        except (TypeError, ValueError, DjangoValidationError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if preloaded is None or pk not in preloaded[0]:
+            return super().to_internal_value(data)
+        obj = preloaded[1].get(pk)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
+
+# Validation pre-pass for the root serializer: collects every id sent to a
+# BatchedPrimaryKeyRelatedField anywhere in the (nested) payload and resolves
+# them with one in_bulk() per queryset before field validation runs
+class BatchedRelatedFieldsMixin:
+    serializer_related_field = BatchedPrimaryKeyRelatedField
+
+    def to_internal_value(self, data):
+        if self.parent is None:
+            requested = {}
+            self._collect_related_ids(self, data, requested)
+            self._context['preloaded'] = {
+                key: (pks, queryset.in_bulk(pks)) for key, (queryset, pks) in requested.items()
+            }
+        return super().to_internal_value(data)
+
+    @classmethod
+    def _collect_related_ids(cls, serializer, data, requested):
+        if not hasattr(data, 'get'):
+            return
+        for field in serializer._writable_fields:
+            if isinstance(field, serializers.ManyRelatedField):
+                relation = field.child_relation
+                values = data.getlist(field.field_name) if hasattr(data, 'getlist') else data.get(field.field_name)
+            else:
+                relation = field
+                values = [data.get(field.field_name)]
+            if isinstance(relation, BatchedPrimaryKeyRelatedField):
+                if not isinstance(values, (list, tuple)):
+                    continue
+                queryset, pks = requested.setdefault(relation.preload_key(), (relation.get_queryset(), set()))
+                for value in values:
+                    if value in (None, ''):
+                        continue
+                    try:
+                        pks.add(relation.to_pk(value))
+                    except (TypeError, ValueError, DjangoValidationError):
+                        pass  # left for the field to reject
+            elif isinstance(field, serializers.ListSerializer) and isinstance(field.child, serializers.Serializer):
+                items = data.get(field.field_name)
+                for item in items if isinstance(items, list) else []:
+                    cls._collect_related_ids(field.child, item, requested)
+            elif isinstance(field, serializers.Serializer):
+                cls._collect_related_ids(field, data.get(field.field_name), requested)
+
 # User Serializer
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -26,9 +107,9 @@ class CategorySerializer(serializers.ModelSerializer):
         }
 
 # Instrument Type Serializer
-class InstrumentTypeSerializer(serializers.ModelSerializer):
+class InstrumentTypeSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
-    category_id = serializers.PrimaryKeyRelatedField(
+    category_id = BatchedPrimaryKeyRelatedField(
         queryset=Category.objects.all(), source='category', write_only=True
     )
 
@@ -41,13 +122,13 @@ class InstrumentTypeSerializer(serializers.ModelSerializer):
         }
 
 # Instrument Serializer
-class InstrumentSerializer(serializers.ModelSerializer):
+class InstrumentSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     type = InstrumentTypeSerializer(read_only=True)
-    type_id = serializers.PrimaryKeyRelatedField(
+    type_id = BatchedPrimaryKeyRelatedField(
         queryset=InstrumentType.objects.all(), source='type', write_only=True
     )
     category = CategorySerializer(source='type.category', read_only=True)
-    category_id = serializers.PrimaryKeyRelatedField(
+    category_id = BatchedPrimaryKeyRelatedField(
         queryset=Category.objects.all(), source='type.category', write_only=True, required=False
     )
 
@@ -66,8 +147,8 @@ class InstrumentSerializer(serializers.ModelSerializer):
         }
 
 # Field Option Serializer
-class FieldOptionSerializer(serializers.ModelSerializer):
-    field = serializers.PrimaryKeyRelatedField(queryset=ConfigurableField.objects.all())
+class FieldOptionSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    field = BatchedPrimaryKeyRelatedField(queryset=ConfigurableField.objects.all())
 
     class Meta:
         model = FieldOption
@@ -80,10 +161,10 @@ class FieldOptionSerializer(serializers.ModelSerializer):
         }
 
 # Configurable Field Serializer
-class ConfigurableFieldSerializer(serializers.ModelSerializer):
+class ConfigurableFieldSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     options = FieldOptionSerializer(many=True, read_only=True)
-    instrument = serializers.PrimaryKeyRelatedField(queryset=Instrument.objects.all())
-    parent_field = serializers.PrimaryKeyRelatedField(queryset=ConfigurableField.objects.all(), allow_null=True)
+    instrument = BatchedPrimaryKeyRelatedField(queryset=Instrument.objects.all())
+    parent_field = BatchedPrimaryKeyRelatedField(queryset=ConfigurableField.objects.all(), allow_null=True)
 
     class Meta:
         model = ConfigurableField
@@ -96,8 +177,8 @@ class ConfigurableFieldSerializer(serializers.ModelSerializer):
         }
 
 # AddOn Type Serializer
-class AddOnTypeSerializer(serializers.ModelSerializer):
-    instruments = serializers.PrimaryKeyRelatedField(queryset=Instrument.objects.all(), many=True, required=False)
+class AddOnTypeSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    instruments = BatchedPrimaryKeyRelatedField(queryset=Instrument.objects.all(), many=True, required=False)
 
     class Meta:
         model = AddOnType
@@ -107,9 +188,9 @@ class AddOnTypeSerializer(serializers.ModelSerializer):
         }
 
 # AddOn Serializer
-class AddOnSerializer(serializers.ModelSerializer):
+class AddOnSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     addon_type = AddOnTypeSerializer(read_only=True)
-    addon_type_id = serializers.PrimaryKeyRelatedField(
+    addon_type_id = BatchedPrimaryKeyRelatedField(
         queryset=AddOnType.objects.all(), source='addon_type', write_only=True
     )
 
@@ -124,9 +205,9 @@ class AddOnSerializer(serializers.ModelSerializer):
         }
 
 # Quotation Item Selection Serializer
-class QuotationItemSelectionSerializer(serializers.ModelSerializer):
+class QuotationItemSelectionSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     field_option = FieldOptionSerializer(read_only=True)
-    field_option_id = serializers.PrimaryKeyRelatedField(
+    field_option_id = BatchedPrimaryKeyRelatedField(
         queryset=FieldOption.objects.all(), source='field_option', write_only=True
     )
 
@@ -142,9 +223,9 @@ class QuotationItemSelectionSerializer(serializers.ModelSerializer):
         return data
 
 # Quotation Item AddOn Serializer
-class QuotationItemAddOnSerializer(serializers.ModelSerializer):
+class QuotationItemAddOnSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     addon = AddOnSerializer(read_only=True)
-    addon_id = serializers.PrimaryKeyRelatedField(
+    addon_id = BatchedPrimaryKeyRelatedField(
         queryset=AddOn.objects.all(), source='addon', write_only=True
     )
 
@@ -160,21 +241,25 @@ class QuotationItemAddOnSerializer(serializers.ModelSerializer):
         return data
 
 # Quotation Item Serializer
-class QuotationItemSerializer(serializers.ModelSerializer):
+class QuotationItemSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     instrument = InstrumentSerializer(read_only=True)
-    instrument_id = serializers.PrimaryKeyRelatedField(
+    instrument_id = BatchedPrimaryKeyRelatedField(
         queryset=Instrument.objects.all(), source='instrument', write_only=True
     )
     selections = QuotationItemSelectionSerializer(many=True, required=False)
     addons = QuotationItemAddOnSerializer(many=True, required=False)
+    unit_price = serializers.SerializerMethodField()
     total_price = serializers.SerializerMethodField()
 
+    def get_unit_price(self, obj):
+        return obj.unit_price
+
     def get_total_price(self, obj):
-        return obj.calculate_total_price()
+        return obj.line_total
 
     class Meta:
         model = QuotationItem
-        fields = ['id', 'product_code', 'quantity', 'instrument', 'instrument_id', 'selections', 'addons', 'total_price']
+        fields = ['id', 'product_code', 'quantity', 'instrument', 'instrument_id', 'selections', 'addons', 'unit_price', 'total_price']
         extra_kwargs = {
             'product_code': {'required': True, 'allow_blank': False},
             'quantity': {'required': True},
@@ -183,37 +268,62 @@ class QuotationItemSerializer(serializers.ModelSerializer):
 
     def validate(self, data):
         print("QuotationItemSerializer validate:", data)
+        option_ids = [s['field_option'].pk for s in data.get('selections', [])]
+        if len(option_ids) != len(set(option_ids)):
+            raise serializers.ValidationError({"selections": "Each field option can only be selected once."})
+        addon_ids = [a['addon'].pk for a in data.get('addons', [])]
+        if len(addon_ids) != len(set(addon_ids)):
+            raise serializers.ValidationError({"addons": "Each add-on can only be selected once."})
         return data
 
-    def create(self, validated_data):
-        print("QuotationItemSerializer.create validated_data:", validated_data)
+    @staticmethod
+    def build_item(validated_data):
+        # Unsaved QuotationItem with its priced totals, plus the selection/add-on rows to insert after it
         selections_data = validated_data.pop('selections', [])
         addons_data = validated_data.pop('addons', [])
-        quotation_item = QuotationItem.objects.create(**validated_data)
-        for selection_data in selections_data:
-            print("Creating selection:", selection_data)
-            QuotationItemSelection.objects.create(
-                quotation_item=quotation_item,
-                field_option=selection_data['field_option']
-            )
-        for addon_data in addons_data:
-            print("Creating addon:", addon_data)
-            QuotationItemAddOn.objects.create(
-                quotation_item=quotation_item,
-                addon=addon_data['addon']
-            )
-        return quotation_item
-
-class QuotationSerializer(serializers.ModelSerializer):
+        quotation_item = QuotationItem(**validated_data)
+        quotation_item.unit_price = compute_unit_price(
+            quotation_item.instrument,
+            [s['field_option'] for s in selections_data],
+            [a['addon'] for a in addons_data],
+        )
+        quotation_item.line_total = quotation_item.unit_price * quotation_item.quantity
+        selections = [QuotationItemSelection(quotation_item=quotation_item, field_option=s['field_option']) for s in selections_data]
+        addons = [QuotationItemAddOn(quotation_item=quotation_item, addon=a['addon']) for a in addons_data]
+        return quotation_item, selections, addons
+
+    @staticmethod
+    def bulk_create_items(built_items):
+        items = [item for item, _, _ in built_items]
+        if connection.features.can_return_rows_from_bulk_insert:
+            QuotationItem.objects.bulk_create(items)
+        else:
+            # Backends that cannot return primary keys from a bulk insert (MySQL)
+            for item in items:
+                item.save(force_insert=True)
+        for item, selections, addons in built_items:
+            for row in selections + addons:
+                row.quotation_item = item  # picks up the now-assigned primary key
+        QuotationItemSelection.objects.bulk_create([row for _, selections, _ in built_items for row in selections])
+        QuotationItemAddOn.objects.bulk_create([row for _, _, addons in built_items for row in addons])
+        return items
+
+    @transaction.atomic
+    def create(self, validated_data):
+        print("QuotationItemSerializer.create validated_data:", validated_data)
+        return self.bulk_create_items([self.build_item(validated_data)])[0]
+
+class QuotationSerializer(ProjectedFieldsMixin, BatchedRelatedFieldsMixin, serializers.ModelSerializer):
     items = QuotationItemSerializer(many=True)
     created_by = UserSerializer(read_only=True)
-    created_by_id = serializers.PrimaryKeyRelatedField(
+    created_by_id = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(), source='created_by', write_only=True
     )
     created_by_first_name = serializers.SerializerMethodField()
     reviewed_by = UserSerializer(read_only=True)
     reviewed_by_name = serializers.SerializerMethodField()
     total_price = serializers.SerializerMethodField()
+    item_count = serializers.SerializerMethodField()
 
     def get_created_by_first_name(self, obj):
         if not obj.created_by:
@@ -230,14 +340,20 @@ class QuotationSerializer(serializers.ModelSerializer):
         return f"{first_name} ({username})"
 
     def get_total_price(self, obj):
-        return obj.calculate_total_price()
+        return obj.grand_total
+
+    def get_item_count(self, obj):
+        # Annotated by summary querysets, otherwise counted from the prefetched items
+        if hasattr(obj, 'item_count'):
+            return obj.item_count
+        return len(obj.items.all())
 
     class Meta:
         model = Quotation
         fields = [
             'id', 'created_by', 'created_by_id', 'created_by_first_name', 'company', 'project_name', 'status',
             'remarks', 'submitted_at', 'approved_at', 'rejected_at', 'reviewed_by', 'reviewed_by_name', 
-            'emailed_at', 'updated_at', 'items', 'total_price'
+            'emailed_at', 'updated_at', 'items', 'total_price', 'item_count'
         ]
         read_only_fields = ['id', 'submitted_at', 'approved_at', 'rejected_at', 'reviewed_by', 'emailed_at', 'updated_at']
         extra_kwargs = {
@@ -250,16 +366,19 @@ class QuotationSerializer(serializers.ModelSerializer):
         print("QuotationSerializer validate:", data)
         return data
 
+    @transaction.atomic
     def create(self, validated_data):
         print("QuotationSerializer.create validated_data:", validated_data)
         items_data = validated_data.pop('items')
         validated_data['submitted_at'] = timezone.now()
+        built_items = [QuotationItemSerializer.build_item(item_data) for item_data in items_data]
+        validated_data['grand_total'] = sum((item.line_total for item, _, _ in built_items), ZERO)
         quotation = Quotation.objects.create(**validated_data)
-        for item_data in items_data:
-            print("Processing item:", item_data)
-            item_data['quotation'] = quotation
-            QuotationItemSerializer().create(item_data)
-        return quotation
+        for item, _, _ in built_items:
+            item.quotation = quotation
+        QuotationItemSerializer.bulk_create_items(built_items)
+        # Re-read with the prefetch plan so the response does not query per item
+        return Quotation.objects.with_details().get(pk=quotation.pk)
 
     def update(self, instance, validated_data):
         print("QuotationSerializer.update validated_data:", validated_data)
@@ -297,17 +416,19 @@ class QuotationReviewSerializer(serializers.ModelSerializer):
         return data
 
 # Instrument Config Serializer
+# (InstrumentConfigView answers with the compiled document from api.configurator)
 class InstrumentConfigSerializer(serializers.ModelSerializer):
     fields = ConfigurableFieldSerializer(many=True, read_only=True)
-    addons = serializers.SerializerMethodField()
 
     class Meta:
         model = Instrument
-        fields = ['id', 'name', 'fields', 'addons']
+        fields = ['id', 'name', 'fields']
 
-    def get_addons(self, obj):
-        addons = AddOn.objects.filter(addon_type__in=obj.addon_types.all())
-        return AddOnSerializer(addons, many=True).data
+# Configuration Evaluate Serializer
+class ConfigurationEvaluateSerializer(serializers.Serializer):
+    option_ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    addon_ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    quantity = serializers.IntegerField(min_value=1, required=False, default=1)
 
 # Admin Category Serializer
 class AdminCategorySerializer(serializers.ModelSerializer):
@@ -319,8 +440,8 @@ class AdminCategorySerializer(serializers.ModelSerializer):
         }
 
 # Admin Instrument Type Serializer
-class AdminInstrumentTypeSerializer(serializers.ModelSerializer):
-    category_id = serializers.PrimaryKeyRelatedField(
+class AdminInstrumentTypeSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    category_id = BatchedPrimaryKeyRelatedField(
         queryset=Category.objects.all(), source='category'
     )
 
@@ -333,8 +454,8 @@ class AdminInstrumentTypeSerializer(serializers.ModelSerializer):
         }
 
 # Admin Instrument Serializer
-class AdminInstrumentSerializer(serializers.ModelSerializer):
-    type_id = serializers.PrimaryKeyRelatedField(
+class AdminInstrumentSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    type_id = BatchedPrimaryKeyRelatedField(
         queryset=InstrumentType.objects.all(), source='type'
     )
     type = InstrumentTypeSerializer(read_only=True)
@@ -354,11 +475,11 @@ class AdminInstrumentSerializer(serializers.ModelSerializer):
         }
 
 # Admin Configurable Field Serializer
-class AdminConfigurableFieldSerializer(serializers.ModelSerializer):
-    instrument_id = serializers.PrimaryKeyRelatedField(
+class AdminConfigurableFieldSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    instrument_id = BatchedPrimaryKeyRelatedField(
         queryset=Instrument.objects.all(), source='instrument'
     )
-    parent_field_id = serializers.PrimaryKeyRelatedField(
+    parent_field_id = BatchedPrimaryKeyRelatedField(
         queryset=ConfigurableField.objects.all(), source='parent_field', allow_null=True
     )
 
@@ -373,8 +494,8 @@ class AdminConfigurableFieldSerializer(serializers.ModelSerializer):
         }
 
 # Admin Field Option Serializer
-class AdminFieldOptionSerializer(serializers.ModelSerializer):
-    field_id = serializers.PrimaryKeyRelatedField(
+class AdminFieldOptionSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    field_id = BatchedPrimaryKeyRelatedField(
         queryset=ConfigurableField.objects.all(), source='field'
     )
 
@@ -389,8 +510,8 @@ class AdminFieldOptionSerializer(serializers.ModelSerializer):
         }
 
 # Admin AddOn Type Serializer
-class AdminAddOnTypeSerializer(serializers.ModelSerializer):
-    instrument_ids = serializers.PrimaryKeyRelatedField(
+class AdminAddOnTypeSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    instrument_ids = BatchedPrimaryKeyRelatedField(
         queryset=Instrument.objects.all(), source='instruments', many=True, required=False
     )
 
@@ -402,8 +523,8 @@ class AdminAddOnTypeSerializer(serializers.ModelSerializer):
         }
 
 # Admin AddOn Serializer
-class AdminAddOnSerializer(serializers.ModelSerializer):
-    addon_type_id = serializers.PrimaryKeyRelatedField(
+class AdminAddOnSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    addon_type_id = BatchedPrimaryKeyRelatedField(
         queryset=AddOnType.objects.all(), source='addon_type'
     )
 
@@ -418,14 +539,14 @@ class AdminAddOnSerializer(serializers.ModelSerializer):
         }
 
 # Admin Quotation Serializer
-class AdminQuotationSerializer(serializers.ModelSerializer):
-    created_by_id = serializers.PrimaryKeyRelatedField(
+class AdminQuotationSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    created_by_id = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(), source='created_by'
     )
     total_price = serializers.SerializerMethodField()
 
     def get_total_price(self, obj):
-        return obj.calculate_total_price()
+        return obj.grand_total
 
     class Meta:
         model = Quotation
@@ -459,17 +580,17 @@ class AdminQuotationSerializer(serializers.ModelSerializer):
         return instance
 
 # Admin Quotation Item Serializer
-class AdminQuotationItemSerializer(serializers.ModelSerializer):
-    quotation_id = serializers.PrimaryKeyRelatedField(
+class AdminQuotationItemSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    quotation_id = BatchedPrimaryKeyRelatedField(
         queryset=Quotation.objects.all(), source='quotation'
     )
-    instrument_id = serializers.PrimaryKeyRelatedField(
+    instrument_id = BatchedPrimaryKeyRelatedField(
         queryset=Instrument.objects.all(), source='instrument'
     )
     total_price = serializers.SerializerMethodField()
 
     def get_total_price(self, obj):
-        return obj.calculate_total_price()
+        return obj.line_total
 
     class Meta:
         model = QuotationItem
@@ -482,11 +603,11 @@ class AdminQuotationItemSerializer(serializers.ModelSerializer):
         }
 
 # Admin Quotation Item Selection Serializer
-class AdminQuotationItemSelectionSerializer(serializers.ModelSerializer):
-    quotation_item_id = serializers.PrimaryKeyRelatedField(
+class AdminQuotationItemSelectionSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    quotation_item_id = BatchedPrimaryKeyRelatedField(
         queryset=QuotationItem.objects.all(), source='quotation_item'
     )
-    field_option_id = serializers.PrimaryKeyRelatedField(
+    field_option_id = BatchedPrimaryKeyRelatedField(
         queryset=FieldOption.objects.all(), source='field_option'
     )
 
@@ -499,11 +620,11 @@ class AdminQuotationItemSelectionSerializer(serializers.ModelSerializer):
         }
 
 # Admin Quotation Item AddOn Serializer
-class AdminQuotationItemAddOnSerializer(serializers.ModelSerializer):
-    quotation_item_id = serializers.PrimaryKeyRelatedField(
+class AdminQuotationItemAddOnSerializer(BatchedRelatedFieldsMixin, serializers.ModelSerializer):
+    quotation_item_id = BatchedPrimaryKeyRelatedField(
         queryset=QuotationItem.objects.all(), source='quotation_item'
     )
-    addon_id = serializers.PrimaryKeyRelatedField(
+    addon_id = BatchedPrimaryKeyRelatedField(
         queryset=AddOn.objects.all(), source='addon'
     )
 
@@ -0,0 +1,88 @@
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from .configurator import invalidate_instrument_configs
+from .media import announce_media, media_upload_finished
+from .models import Instrument, ConfigurableField, FieldOption, AddOnType, AddOn, MediaUploadJob
+
+
+# Compiled configurator documents (api.configurator) are dropped whenever a model they are built from changes
+
+def addon_type_instrument_ids(addon_type_ids):
+    return AddOnType.instruments.through.objects.filter(
+        addontype_id__in=addon_type_ids
+    ).values_list('instrument_id', flat=True)
+
+@receiver(pre_save, sender=ConfigurableField)
+@receiver(pre_save, sender=FieldOption)
+@receiver(pre_save, sender=AddOn)
+def remember_previous_parent(sender, instance, raw=False, **kwargs):
+    # A row moved to another parent must also drop the document of the parent it left
+    parent = {ConfigurableField: 'instrument_id', FieldOption: 'field_id', AddOn: 'addon_type_id'}[sender]
+    instance._previous_parent_id = None
+    if instance.pk and not raw:
+        instance._previous_parent_id = sender.objects.filter(pk=instance.pk).values_list(parent, flat=True).first()
+
+@receiver([post_save, post_delete], sender=Instrument)
+def instrument_changed(sender, instance, **kwargs):
+    invalidate_instrument_configs([instance.pk])
+
+@receiver([post_save, post_delete], sender=ConfigurableField)
+def configurable_field_changed(sender, instance, **kwargs):
+    invalidate_instrument_configs([instance.instrument_id, getattr(instance, '_previous_parent_id', None)])
+
+@receiver([post_save, post_delete], sender=FieldOption)
+def field_option_changed(sender, instance, **kwargs):
+    field_ids = [instance.field_id, getattr(instance, '_previous_parent_id', None)]
+    instrument_ids = ConfigurableField.objects.filter(pk__in=field_ids).values_list('instrument_id', flat=True)
+    invalidate_instrument_configs(list(instrument_ids))
+
+@receiver(post_save, sender=AddOnType)
+@receiver(pre_delete, sender=AddOnType)
+def addon_type_changed(sender, instance, **kwargs):
+    invalidate_instrument_configs(list(instance.instruments.values_list('id', flat=True)))
+
+@receiver(m2m_changed, sender=AddOnType.instruments.through)
+def addon_type_instruments_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # instrument.addon_types.add(...): pk_set holds add-on types, and every instrument
+        # of those types lists this one under addon_type.instruments. pre_clear has no
+        # pk_set, but the add-on types being removed are still linked.
+        addon_type_ids = pk_set if pk_set is not None else list(instance.addon_types.values_list('id', flat=True))
+        invalidate_instrument_configs({instance.pk} | set(addon_type_instrument_ids(addon_type_ids)))
+        return
+    # Every instrument that shares the add-on type lists it under addon_type.instruments
+    instrument_ids = set(instance.instruments.values_list('id', flat=True)) | set(pk_set or ())
+    invalidate_instrument_configs(instrument_ids)
+
+@receiver([post_save, post_delete], sender=AddOn)
+def addon_changed(sender, instance, **kwargs):
+    addon_type_ids = [instance.addon_type_id, getattr(instance, '_previous_parent_id', None)]
+    invalidate_instrument_configs(list(addon_type_instrument_ids(addon_type_ids)))
+
+
+# Instrument images are stored by the media worker (api.media); the instrument
+# points at the new image once it is there, unless a later upload superseded it
+
+@receiver(media_upload_finished, sender=Instrument)
+def instrument_image_stored(sender, job, blob, **kwargs):
+    instrument = Instrument.objects.filter(pk=job.object_id).first()
+    if instrument is None:
+        return
+    superseded = MediaUploadJob.objects.filter(field=job.field, object_id=job.object_id, id__gt=job.id).exists()
+    if blob is not None and not superseded:
+        instrument.image = blob.name
+        instrument.image_blob = blob
+        instrument.save(update_fields=['image', 'image_blob'])
+    if job.requested_by_id:
+        # The uploader's personal chat group (chat.consumers)
+        group = f"chat_{job.requested_by.username}"
+        transaction.on_commit(lambda: announce_media(
+            group,
+            instrument_id=instrument.pk,
+            image_url=instrument.image.url if instrument.image else None,
+            status='stored' if blob is not None else 'failed',
+        ))
@@ -0,0 +1,42 @@
+"""
+Streaming responses under ASGI.
+
+The app is served by Daphne. Django 4.2's StreamingHttpResponse drains a *sync*
+iterator with sync_to_async(list) before sending anything when it runs under
+ASGI, so sync generators lose their streaming. async_chunks() wraps one in an
+async iterator that advances it one item per sync_to_async call, which keeps
+memory bounded by a single chunk.
+"""
+from asgiref.sync import sync_to_async
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+_EXHAUSTED = object()
+
+
+async def async_chunks(iterable):
+    """Async iterator over a sync iterable, pulling one item at a time in the sync thread."""
+    iterator = iter(iterable)
+    # Thread-sensitive (the default), so ORM access inside the iterator keeps one connection
+    advance = sync_to_async(next)
+    try:
+        while True:
+            chunk = await advance(iterator, _EXHAUSTED)
+            if chunk is _EXHAUSTED:
+                break
+            yield chunk
+    finally:
+        # Runs the generator's cleanup when the client goes away mid-stream
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def file_chunks(file):
+    """Sync generator over an open file in FILE_CHUNK_SIZE pieces; closes it when done or abandoned."""
+    with file:
+        while True:
+            data = file.read(FILE_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
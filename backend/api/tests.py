@@ -1,3 +1,950 @@
-from django.test import TestCase
+import asyncio
+from contextlib import contextmanager
+from datetime import timedelta
+from importlib import import_module
+import re
+import os
+import shutil
+import tempfile
+import zipfile
+from io import BytesIO, StringIO
+from decimal import Decimal
+from smtplib import SMTPException
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import (
+    Category, InstrumentType, Instrument,
+    ConfigurableField, FieldOption,
+    AddOn, AddOnType, Quotation, QuotationItem,
+    QuotationItemSelection, QuotationItemAddOn, QuotationDeliveryJob, StoredBlob, MediaUploadJob
+)
+from .configurator import evaluate_configuration, ConfigurationError
+from .delivery import run_pending_jobs
+from .media import run_pending_media_uploads
+from . import delivery, media, pdf, pdf_cache, pdf_export, streaming
+from .management.commands.benchmark_quotation_pdf import build_sample_quotation
+from .pricing import reprice_quotation_items
+from .serializers import AddOnTypeSerializer
+from users.models import CustomUser
+
+# Maximum number of queries each list endpoint may run, regardless of row count.
+# Raise a budget only together with a prefetch plan that keeps it constant.
+QUERY_BUDGETS = {
+    'quotation-submitted': 6,
+    'quotation-review-list': 6,
+    'admin-quotation-list': 2,
+    'admin-quotation-item-list': 2,
+    'quotation-item-list': 6,
+    'admin:api_quotation_changelist': 12,
+}
+
+
+def streamed_content(response):
+    """Body of a StreamingHttpResponse whose content is an async iterator."""
+    async def collect():
+        return b''.join([chunk async for chunk in response.streaming_content])
+    return async_to_sync(collect)()
+
+
+def asgi_get(path, user, query_string='', on_send=None):
+    """
+    GET `path` through Django's ASGI handler, the way Daphne serves it, and
+    return the ASGI events sent back. on_send(event) runs as each one is sent.
+    """
+    async def run():
+        events, requested = [], False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Event().wait()
+
+        async def send(event):
+            if on_send:
+                on_send(event)
+            events.append(event)
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+            'query_string': query_string.encode(), 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {AccessToken.for_user(user)}'.encode())],
+        }
+        await ASGIHandler()(scope, receive, send)
+        return events
+
+    # Like the test client: keep the test transaction's connection open across the request
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        return async_to_sync(run)()
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+
+
+class TemporaryMediaMixin:
+    # Rendered PDFs are written to storage; keep them out of the real MEDIA_ROOT
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(
+            MEDIA_ROOT=cls.media_root, QUOTATION_PDF_STORAGE='django.core.files.storage.FileSystemStorage'
+        )
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+class QuotationFixtureMixin:
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = CustomUser.objects.create_user('client1', 'client1@example.com', 'pw', company='ACME')
+        cls.engineer = CustomUser.objects.create_user(
+            'engineer1', 'engineer1@example.com', 'pw', company='InstruGate', role='proposal_engineer'
+        )
+        cls.admin_user = CustomUser.objects.create_superuser('admin1', 'admin1@example.com', 'pw', company='InstruGate')
+
+        category = Category.objects.create(name='Pressure Instruments')
+        instrument_type = InstrumentType.objects.create(category=category, name='Pressure Gauges')
+        cls.instrument = Instrument.objects.create(type=instrument_type, name='PG-100', base_price='100.00')
+        size = ConfigurableField.objects.create(instrument=cls.instrument, name='Dial Size', order=0)
+        cls.size_4 = FieldOption.objects.create(field=size, label='4 inch', code='4', price='10.00')
+        cls.size_6 = FieldOption.objects.create(field=size, label='6 inch', code='6', price='20.00')
+        fill = ConfigurableField.objects.create(
+            instrument=cls.instrument, name='Fill', order=1, parent_field=size, trigger_value='6'
+        )
+        cls.glycerin = FieldOption.objects.create(field=fill, label='Glycerin', code='G', price='5.00')
+        addon_type = AddOnType.objects.create(name='Accessories')
+        addon_type.instruments.add(cls.instrument)
+        cls.valve = AddOn.objects.create(addon_type=addon_type, label='Needle Valve', code='NV', price='7.00')
+
+    @classmethod
+    def create_quotations(cls, count, items_per_quotation=2):
+        for _ in range(count):
+            quotation = Quotation.objects.create(created_by=cls.client_user, company='ACME', project_name='Plant')
+            for _ in range(items_per_quotation):
+                item = QuotationItem.objects.create(
+                    quotation=quotation, instrument=cls.instrument, product_code='PG-100-6-G', quantity=2
+                )
+                QuotationItemSelection.objects.create(quotation_item=item, field_option=cls.size_6)
+                QuotationItemSelection.objects.create(quotation_item=item, field_option=cls.glycerin)
+                QuotationItemAddOn.objects.create(quotation_item=item, addon=cls.valve)
+            reprice_quotation_items(quotation.id)
+
+
+class QueryBudgetTests(QuotationFixtureMixin, TestCase):
+    @contextmanager
+    def assertQueryBudget(self, name):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        self.assertLessEqual(
+            len(context), QUERY_BUDGETS[name],
+            f"{name} ran {len(context)} queries, budget is {QUERY_BUDGETS[name]}:\n"
+            + "\n".join(query['sql'] for query in context.captured_queries)
+        )
+
+    def get_within_budget(self, name, user, **kwargs):
+        client = APIClient()
+        client.force_authenticate(user)
+        url = reverse(name, kwargs=kwargs or None)
+        with self.assertQueryBudget(name) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def assertConstantQueries(self, name, user):
+        self.create_quotations(2)
+        small = self.get_within_budget(name, user)
+        self.create_quotations(8, items_per_quotation=3)
+        large = self.get_within_budget(name, user)
+        self.assertEqual(small, large, f"{name} query count grows with the number of rows")
+
+    def test_submitted_quotations(self):
+        self.assertConstantQueries('quotation-submitted', self.client_user)
+
+    def test_review_queue(self):
+        self.assertConstantQueries('quotation-review-list', self.engineer)
+
+    def test_admin_quotation_list(self):
+        self.assertConstantQueries('admin-quotation-list', self.admin_user)
+
+    def test_admin_quotation_item_list(self):
+        self.assertConstantQueries('admin-quotation-item-list', self.admin_user)
+
+    def test_quotation_item_list(self):
+        self.assertConstantQueries('quotation-item-list', self.engineer)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_django_admin_quotation_changelist(self):
+        self.client.force_login(self.admin_user)
+        url = reverse('admin:api_quotation_changelist')
+        self.create_quotations(2)
+        with self.assertQueryBudget('admin:api_quotation_changelist') as small:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.create_quotations(8)
+        with self.assertQueryBudget('admin:api_quotation_changelist') as large:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(len(small), len(large))
+
+
+class ReviewQueuePaginationTests(QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        self.api = APIClient()
+        self.api.force_authenticate(self.engineer)
+
+    def test_unpaginated_by_default(self):
+        self.create_quotations(3)
+        response = self.api.get(reverse('quotation-review-list'))
+        self.assertEqual(len(response.data), 3)
+        self.assertIn('items', response.data[0])
+
+    def test_cursor_walks_every_row_once(self):
+        self.create_quotations(7, items_per_quotation=1)
+        # Same submitted_at for several rows exercises the id tie-break
+        Quotation.objects.filter(id__in=Quotation.objects.order_by('id').values_list('id', flat=True)[:4]).update(
+            submitted_at=Quotation.objects.order_by('id').first().submitted_at
+        )
+        seen = []
+        url = reverse('quotation-review-list') + '?page_size=3&fields=summary'
+        while url:
+            response = self.api.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            seen += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        expected = list(Quotation.objects.order_by('-submitted_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_summary_projection(self):
+        self.create_quotations(2, items_per_quotation=3)
+        with CaptureQueriesContext(connection) as context:
+            response = self.api.get(reverse('quotation-review-list') + '?fields=summary&page_size=10')
+        self.assertEqual(len(context), 1)
+        row = response.data['results'][0]
+        self.assertEqual(
+            set(row), {'id', 'company', 'project_name', 'status', 'submitted_at', 'total_price', 'item_count'}
+        )
+        self.assertEqual(row['item_count'], 3)
+
+    def test_expand_items(self):
+        self.create_quotations(1)
+        response = self.api.get(reverse('quotation-review-list') + '?fields=id,status&expand=items')
+        self.assertEqual(set(response.data[0]), {'id', 'status', 'items'})
+        self.assertEqual(len(response.data[0]['items']), 2)
+
+    def test_detail_on_demand(self):
+        self.create_quotations(1)
+        quotation = Quotation.objects.get()
+        response = self.api.get(reverse('quotation-review', kwargs={'pk': quotation.pk}))
+        self.assertEqual(response.data['id'], quotation.pk)
+        self.assertEqual(len(response.data['items']), 2)
+
+    def test_invalid_cursor(self):
+        response = self.api.get(reverse('quotation-review-list') + '?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+
+class InstrumentConfigCacheTests(QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.api = APIClient()
+        self.api.force_authenticate(self.client_user)
+        self.url = reverse('instrument-config', kwargs={'pk': self.instrument.pk})
+
+    def test_document_shape(self):
+        response = self.api.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        document = response.json()
+        self.assertEqual([field['name'] for field in document['fields']], ['Dial Size', 'Fill'])
+        self.assertEqual(document['dependencies'], [
+            {'field': document['fields'][1]['id'], 'parent_field': document['fields'][0]['id'], 'trigger_value': '6'}
+        ])
+        self.assertEqual(document['addons'][0]['addon_type']['instruments'], [self.instrument.pk])
+
+    def test_cached_and_not_modified(self):
+        etag = self.api.get(self.url)['ETag']
+        with CaptureQueriesContext(connection) as context:
+            response = self.api.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(context), 0)
+
+    def test_invalidated_by_option_and_addon_changes(self):
+        etag = self.api.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            option = FieldOption.objects.get(pk=self.size_4.pk)
+            option.label = '4.5 inch'
+            option.save()
+        response = self.api.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.valve.price = '9.00'
+            self.valve.save()
+        response = self.api.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['addons'][0]['price'], '9.00')
+
+    def assertInvalidatedBy(self, change):
+        etag = self.api.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        response = self.api.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_invalidated_from_the_instrument_side(self):
+        other = Instrument.objects.create(type=self.instrument.type, name='PG-200', base_price='150.00')
+        addon_type = self.valve.addon_type
+        document = self.assertInvalidatedBy(lambda: other.addon_types.add(addon_type))
+        self.assertEqual(sorted(document['addons'][0]['addon_type']['instruments']), sorted([self.instrument.pk, other.pk]))
+
+        document = self.assertInvalidatedBy(lambda: other.addon_types.clear())
+        self.assertEqual(document['addons'][0]['addon_type']['instruments'], [self.instrument.pk])
+
+    def test_invalidated_when_rows_move_away(self):
+        other = Instrument.objects.create(type=self.instrument.type, name='PG-200', base_price='150.00')
+        other_field = ConfigurableField.objects.create(instrument=other, name='Range', order=0)
+        other_type = AddOnType.objects.create(name='Seals')
+        other_type.instruments.add(other)
+
+        def move(instance, **fields):
+            def change():
+                for name, value in fields.items():
+                    setattr(instance, name, value)
+                instance.save()
+            return change
+
+        document = self.assertInvalidatedBy(move(FieldOption.objects.get(pk=self.size_4.pk), field=other_field))
+        self.assertEqual([option['code'] for option in document['fields'][0]['options']], ['6'])
+        document = self.assertInvalidatedBy(move(AddOn.objects.get(pk=self.valve.pk), addon_type=other_type))
+        self.assertEqual(document['addons'], [])
+        document = self.assertInvalidatedBy(move(ConfigurableField.objects.get(name='Fill'), instrument=other))
+        self.assertEqual([field['name'] for field in document['fields']], ['Dial Size'])
+
+    def test_unknown_instrument(self):
+        response = self.api.get(reverse('instrument-config', kwargs={'pk': 9999}))
+        self.assertEqual(response.status_code, 404)
+
+
+class InstrumentImageUploadTests(QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        self.storage = FileSystemStorage(location=f'{media_root}/storage', base_url='/media/')
+        storage_override = mock.patch.object(Instrument._meta.get_field('image'), 'storage', self.storage)
+        storage_override.start()
+        self.addCleanup(storage_override.stop)
+        staging_override = override_settings(MEDIA_UPLOAD_STAGING_DIR=f'{media_root}/staging')
+        staging_override.enable()
+        self.addCleanup(staging_override.disable)
+        self.api = APIClient()
+        self.api.force_authenticate(self.engineer)
+
+    def upload(self, instrument, content):
+        return self.api.post(
+            reverse('instrument-image-upload', kwargs={'pk': instrument.pk}),
+            {'image': SimpleUploadedFile('gauge.png', content, content_type='image/png')}, format='multipart'
+        )
+
+    def test_new_image_is_stored_in_the_background(self):
+        with mock.patch.object(self.storage, 'save', wraps=self.storage.save) as save:
+            response = self.upload(self.instrument, b'image-bytes')
+            self.assertEqual((response.status_code, response.data['image_status']), (202, 'pending'))
+            self.assertEqual(save.call_count, 0)
+            self.assertFalse(Instrument.objects.get(pk=self.instrument.pk).image)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(run_pending_media_uploads(), 1)
+            self.assertEqual(save.call_count, 1)
+        self.instrument.refresh_from_db()
+        with self.instrument.image.open('rb') as stored:
+            self.assertEqual(stored.read(), b'image-bytes')
+        self.assertEqual(MediaUploadJob.objects.get().status, 'succeeded')
+
+    def test_identical_images_are_stored_once(self):
+        other = Instrument.objects.create(type=self.instrument.type, name='PG-200', base_price='120.00')
+        with mock.patch.object(self.storage, 'save', wraps=self.storage.save) as save:
+            self.assertEqual(self.upload(self.instrument, b'image-bytes').status_code, 202)
+            run_pending_media_uploads()
+            self.assertEqual(self.upload(other, b'image-bytes').status_code, 200)
+            self.assertEqual(save.call_count, 1)
+            self.assertEqual(self.upload(other, b'other-bytes').status_code, 202)
+            run_pending_media_uploads()
+            self.assertEqual(save.call_count, 2)
+
+        self.instrument.refresh_from_db()
+        blob = StoredBlob.objects.get(sha256=self.instrument.image_blob.sha256)
+        self.assertEqual((self.instrument.image.name, blob.field, blob.size), (blob.name, 'api.instrument.image', 11))
+        self.assertEqual(StoredBlob.objects.count(), 2)
+
+
+    def test_stored_image_supersedes_earlier_queued_upload(self):
+        other = Instrument.objects.create(type=self.instrument.type, name='PG-200', base_price='120.00')
+        self.upload(other, b'known-bytes')
+        run_pending_media_uploads()
+        known = StoredBlob.objects.get()
+
+        for claim_first in (False, True):
+            with self.subTest(claim_first=claim_first):
+                # An upload of new content is queued, then identical content to a stored blob is uploaded
+                self.assertEqual(self.upload(self.instrument, b'older-bytes-%d' % claim_first).status_code, 202)
+                older = media.claim_next_media_job() if claim_first else MediaUploadJob.objects.latest('id')
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertEqual(self.upload(self.instrument, b'known-bytes').status_code, 200)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    if claim_first:
+                        self.assertFalse(media.run_media_job(older))
+                    else:
+                        self.assertEqual(run_pending_media_uploads(), 0)
+                older.refresh_from_db()
+                self.assertEqual(older.status, 'superseded')
+                self.assertFalse(os.path.exists(older.staged_path))
+                self.instrument.refresh_from_db()
+                self.assertEqual((self.instrument.image.name, self.instrument.image_blob), (known.name, known))
+
+    def test_worker_that_lost_its_lease_records_nothing(self):
+        self.upload(self.instrument, b'image-bytes')
+        stale = media.claim_next_media_job()
+        # The lease runs out and a second worker takes the job over
+        current = media.claim_next_media_job(now=timezone.now() + delivery.JOB_LEASE + timedelta(minutes=1))
+        self.assertEqual((current.pk, current.attempts), (stale.pk, 2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertFalse(media.run_media_job(stale))
+        job = MediaUploadJob.objects.get()
+        self.assertEqual((job.status, job.locked_at), ('running', current.locked_at))
+        self.assertFalse(Instrument.objects.get(pk=self.instrument.pk).image)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(media.run_media_job(current))
+        self.assertEqual(MediaUploadJob.objects.get().status, 'succeeded')
+        self.assertEqual(StoredBlob.objects.count(), 1)
+
+
+class ConfigurationEvaluatorTests(QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_canonical_code_and_price(self):
+        result = evaluate_configuration(
+            self.instrument.pk, [self.glycerin.pk, self.size_6.pk], [self.valve.pk], quantity=2
+        )
+        self.assertEqual(result['product_code'], '[6][G][NV]')
+        self.assertEqual(result['unit_price'], Decimal('132.00'))
+        self.assertEqual(result['line_total'], Decimal('264.00'))
+
+    def test_trigger_gating(self):
+        result = evaluate_configuration(self.instrument.pk, [self.size_4.pk])
+        self.assertEqual(result['product_code'], '[4]')
+        with self.assertRaises(ConfigurationError):
+            evaluate_configuration(self.instrument.pk, [self.size_4.pk, self.glycerin.pk])
+        with self.assertRaises(ConfigurationError):
+            evaluate_configuration(self.instrument.pk, [self.size_6.pk])
+
+    def test_rejects_foreign_and_duplicate_options(self):
+        with self.assertRaises(ConfigurationError) as raised:
+            evaluate_configuration(self.instrument.pk, [self.size_4.pk, self.size_6.pk, 9999], [8888])
+        self.assertEqual(len(raised.exception.errors), 3)
+
+    def test_runs_without_queries_once_compiled(self):
+        evaluate_configuration(self.instrument.pk, [self.size_4.pk])
+        with CaptureQueriesContext(connection) as context:
+            evaluate_configuration(self.instrument.pk, [self.size_6.pk, self.glycerin.pk], [self.valve.pk])
+        self.assertEqual(len(context), 0)
+
+    def test_endpoint(self):
+        api = APIClient()
+        api.force_authenticate(self.client_user)
+        url = reverse('instrument-config-evaluate', kwargs={'pk': self.instrument.pk})
+        response = api.post(url, {'option_ids': [self.size_6.pk, self.glycerin.pk], 'addon_ids': [self.valve.pk]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['product_code'], '[6][G][NV]')
+        self.assertEqual(response.data['unit_price'], '132.00')
+        response = api.post(url, {'option_ids': [self.size_6.pk]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('errors', response.data)
+
+
+class QuotationCreateTests(QuotationFixtureMixin, TestCase):
+    def payload(self, item_count, **overrides):
+        item = {
+            'product_code': '[6][G][NV]', 'quantity': 2, 'instrument_id': self.instrument.pk,
+            'selections': [{'field_option_id': self.size_6.pk}, {'field_option_id': self.glycerin.pk}],
+            'addons': [{'addon_id': self.valve.pk}],
+        }
+        item.update(overrides)
+        return {'company': 'ACME', 'project_name': 'Plant', 'created_by_id': self.client_user.pk, 'items': [item] * item_count}
+
+    def post(self, payload):
+        api = APIClient()
+        api.force_authenticate(self.client_user)
+        return api.post(reverse('quotation-create'), payload, format='json')
+
+    def test_query_count_independent_of_size(self):
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.post(self.payload(1)).status_code, 201)
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(self.post(self.payload(50)).status_code, 201)
+        self.assertEqual(len(small), len(large))
+
+        quotation = Quotation.objects.order_by('-id').first()
+        self.assertEqual(quotation.items.count(), 50)
+        self.assertEqual(QuotationItemSelection.objects.filter(quotation_item__quotation=quotation).count(), 100)
+        self.assertEqual(quotation.grand_total, Decimal('13200.00'))
+        self.assertEqual(quotation.grand_total, quotation.calculate_total_price())
+
+    def test_unknown_option_rejected_without_writes(self):
+        payload = self.payload(3)
+        payload['items'] = payload['items'] + [dict(payload['items'][0], selections=[{'field_option_id': 9999}])]
+        response = self.post(payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Quotation.objects.exists())
+
+    def test_duplicate_selection_rejected(self):
+        response = self.post(self.payload(1, selections=[{'field_option_id': self.size_6.pk}] * 2))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Quotation.objects.exists())
+
+
+class BatchedRelatedFieldTests(QuotationFixtureMixin, TestCase):
+    def validate(self, instrument_ids):
+        serializer = AddOnTypeSerializer(data={'name': 'Valves', 'instruments': instrument_ids})
+        with CaptureQueriesContext(connection) as queries:
+            valid = serializer.is_valid()
+        return serializer, valid, len(queries)
+
+    def test_many_ids_resolved_in_one_query(self):
+        instruments = [
+            Instrument.objects.create(type=self.instrument.type, name=f"PG-{n}", base_price=Decimal('1.00'))
+            for n in range(20)
+        ]
+        _, valid, single = self.validate([self.instrument.pk])
+        self.assertTrue(valid)
+        serializer, valid, many = self.validate([instrument.pk for instrument in instruments])
+        self.assertTrue(valid)
+        self.assertEqual(single, many)
+        self.assertEqual([i.pk for i in serializer.validated_data['instruments']], [i.pk for i in instruments])
+
+    def test_missing_and_malformed_ids_rejected(self):
+        serializer, valid, _ = self.validate([self.instrument.pk, 9999])
+        self.assertFalse(valid)
+        self.assertIn('instruments', serializer.errors)
+        serializer, valid, _ = self.validate(['abc'])
+        self.assertFalse(valid)
+        self.assertIn('instruments', serializer.errors)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class QuotationDeliveryTests(TemporaryMediaMixin, QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        self.create_quotations(1)
+        self.quotation = Quotation.objects.get()
+        Quotation.objects.filter(pk=self.quotation.pk).update(status='approved')
+        self.api = APIClient()
+        self.api.force_authenticate(self.client_user)
+
+    def submit(self):
+        return self.api.post(reverse('quotation-submit', args=[self.quotation.pk]))
+
+    def test_submit_enqueues_and_worker_delivers(self):
+        response = self.submit()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(mail.outbox), 0)
+        self.quotation.refresh_from_db()
+        self.assertEqual(self.quotation.status, 'approved')
+
+        # Submitting again while queued reuses the job
+        self.assertEqual(self.submit().data['job'], response.data['job'])
+
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].attachments[0][0], f"Quotation_{self.quotation.pk}.pdf")
+        self.assertEqual(mail.outbox[0].cc, ['client1@example.com'])
+        self.quotation.refresh_from_db()
+        self.assertEqual(self.quotation.status, 'submitted')
+        self.assertIsNotNone(self.quotation.emailed_at)
+
+        status_response = self.api.get(reverse('quotation-submit', args=[self.quotation.pk]))
+        self.assertEqual(status_response.data['status'], 'succeeded')
+        self.assertEqual(status_response.data['quotation_status'], 'submitted')
+
+    def test_failed_send_retries_with_backoff(self):
+        self.submit()
+        with mock.patch('api.delivery.EmailMessage.send', side_effect=SMTPException('timeout')):
+            self.assertEqual(run_pending_jobs(), 1)
+        job = QuotationDeliveryJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.quotation.refresh_from_db()
+        self.assertEqual(self.quotation.status, 'approved')
+
+        # Not due yet
+        self.assertEqual(run_pending_jobs(), 0)
+        self.assertEqual(run_pending_jobs(now=timezone.now() + timedelta(hours=1)), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('succeeded', 2))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        self.submit()
+        QuotationDeliveryJob.objects.update(max_attempts=2)
+        with mock.patch('api.delivery.EmailMessage.send', side_effect=SMTPException('timeout')):
+            run_pending_jobs(now=timezone.now() + timedelta(days=1))
+        job = QuotationDeliveryJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertIn('timeout', job.last_error)
+        self.quotation.refresh_from_db()
+        self.assertEqual(self.quotation.status, 'approved')
+
+
+    def test_network_timeouts_stay_inside_the_lease(self):
+        self.assertLess(timedelta(seconds=settings.EMAIL_TIMEOUT), delivery.JOB_LEASE / 2)
+        self.assertLess(timedelta(seconds=settings.MEDIA_UPLOAD_TIMEOUT), delivery.JOB_LEASE / 2)
+
+    def test_worker_that_lost_its_lease_does_not_send(self):
+        self.submit()
+        stale = delivery.claim_next_job()
+        current = delivery.claim_next_job(now=timezone.now() + delivery.JOB_LEASE + timedelta(minutes=1))
+        self.assertEqual(current.pk, stale.pk)
+
+        self.assertFalse(delivery.run_job(stale))
+        self.assertEqual(len(mail.outbox), 0)
+        job = QuotationDeliveryJob.objects.get()
+        self.assertEqual((job.status, job.locked_at), ('running', current.locked_at))
+
+        self.assertTrue(delivery.run_job(current))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(QuotationDeliveryJob.objects.get().status, 'succeeded')
+
+    def test_late_failure_does_not_reschedule_a_reclaimed_job(self):
+        self.submit()
+        stale = delivery.claim_next_job()
+        current = delivery.claim_next_job(now=timezone.now() + delivery.JOB_LEASE + timedelta(minutes=1))
+        with mock.patch('api.delivery.EmailMessage.send', side_effect=SMTPException('timeout')), \
+                mock.patch('api.delivery.holds_lease', return_value=True):
+            self.assertFalse(delivery.run_job(stale))
+        job = QuotationDeliveryJob.objects.get()
+        self.assertEqual((job.status, job.locked_at, job.last_error), ('running', current.locked_at, ''))
+
+
+class QuotationPdfCacheTests(TemporaryMediaMixin, QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        self.create_quotations(1)
+        self.quotation = Quotation.objects.get()
+        self.api = APIClient()
+        self.api.force_authenticate(self.client_user)
+        self.url = reverse('quotation-download-pdf', args=[self.quotation.pk])
+
+    def download(self, **headers):
+        with mock.patch('api.pdf_cache.spool_quotation_pdf', wraps=pdf_cache.spool_quotation_pdf) as render:
+            response = self.api.get(self.url, **headers)
+        return response, render.call_count
+
+    def test_second_download_reads_stored_file(self):
+        response, renders = self.download()
+        self.assertEqual((response.status_code, renders), (200, 1))
+        self.assertTrue(streamed_content(response).startswith(b'%PDF'))
+        self.assertIn('Last-Modified', response)
+
+        response, renders = self.download()
+        self.assertEqual((response.status_code, renders), (200, 0))
+        self.assertTrue(streamed_content(response).startswith(b'%PDF'))
+
+        response, renders = self.download(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, renders), (304, 0))
+
+    def test_download_streams_under_asgi(self):
+        pdf_cache.get_quotation_pdf(self.quotation)
+        reads = []
+
+        def counting_chunks(file):
+            for chunk in streaming.file_chunks(file):
+                reads.append(len(chunk))
+                yield chunk
+
+        sent_after = []
+
+        def on_send(event):
+            if event['type'] == 'http.response.body' and event.get('body'):
+                sent_after.append(len(reads))
+
+        with mock.patch.object(streaming, 'FILE_CHUNK_SIZE', 1024), \
+                mock.patch('api.views.file_chunks', side_effect=counting_chunks):
+            events = asgi_get(self.url, self.client_user, on_send=on_send)
+        self.assertEqual(events[0]['status'], 200)
+        body = b''.join(event.get('body', b'') for event in events[1:])
+        self.assertTrue(body.startswith(b'%PDF'))
+        self.assertEqual(dict((k.lower(), v) for k, v in events[0]['headers'])[b'content-length'], str(len(body)).encode())
+        # Each chunk is sent as soon as it is read, not after the whole file was buffered
+        self.assertEqual(sent_after, list(range(1, len(reads) + 1)))
+        self.assertGreater(len(reads), 1)
+
+    def test_item_change_renders_new_version(self):
+        first, _ = self.download()
+        item = self.quotation.items.first()
+        QuotationItem.objects.filter(pk=item.pk).update(quantity=5)
+        reprice_quotation_items(self.quotation.pk)
+
+        second, renders = self.download(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual((second.status_code, renders), (200, 1))
+        self.assertNotEqual(first['ETag'], second['ETag'])
+        _, files = pdf_cache.get_pdf_storage().listdir(f"{pdf_cache.PDF_CACHE_DIR}/{self.quotation.pk}")
+        self.assertEqual(len(files), 1)
+
+
+class StoredTotalsTests(QuotationFixtureMixin, TestCase):
+    # One item: (100 base + 20 size + 5 fill + 7 valve) x 2 = 264 per item
+    def setUp(self):
+        self.create_quotations(1, items_per_quotation=2)
+        self.quotation = Quotation.objects.get()
+        self.item = self.quotation.items.order_by('id').first()
+        self.api = APIClient()
+        self.api.force_authenticate(self.admin_user)
+
+    def assertGrandTotal(self, expected):
+        self.quotation.refresh_from_db()
+        self.assertEqual(self.quotation.grand_total, Decimal(expected))
+        self.assertEqual(self.quotation.grand_total, self.quotation.calculate_total_price())
+
+    def test_item_writes_reprice(self):
+        self.assertGrandTotal('528.00')
+        response = self.api.post(reverse('admin-quotation-item-list'), {
+            'quotation_id': self.quotation.pk, 'instrument_id': self.instrument.pk,
+            'product_code': 'PG-100', 'quantity': 3,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertGrandTotal('828.00')
+
+        response = self.api.patch(reverse('admin-quotation-item-detail', args=[self.item.pk]), {'quantity': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertGrandTotal('696.00')
+
+        response = self.api.delete(reverse('admin-quotation-item-detail', args=[self.item.pk]))
+        self.assertEqual(response.status_code, 204)
+        self.assertGrandTotal('564.00')
+
+    def test_selection_writes_reprice(self):
+        size_8 = FieldOption.objects.create(field=self.size_4.field, label='8 inch', code='8', price='40.00')
+        response = self.api.post(reverse('admin-quotation-item-selection-list'), {
+            'quotation_item_id': self.item.pk, 'field_option_id': self.size_4.pk,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertGrandTotal('548.00')
+
+        selection_id = response.data['id']
+        response = self.api.patch(
+            reverse('admin-quotation-item-selection-detail', args=[selection_id]), {'field_option_id': size_8.pk}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertGrandTotal('608.00')
+
+        response = self.api.delete(reverse('admin-quotation-item-selection-detail', args=[selection_id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertGrandTotal('528.00')
+
+    def test_addon_writes_reprice(self):
+        other_item = self.quotation.items.exclude(pk=self.item.pk).get()
+        gauge_cock = AddOn.objects.create(addon_type=self.valve.addon_type, label='Gauge Cock', code='GC', price='3.00')
+        response = self.api.post(reverse('admin-quotation-item-addon-list'), {
+            'quotation_item_id': self.item.pk, 'addon_id': gauge_cock.pk,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertGrandTotal('534.00')
+
+        # Moving an add-on to another item reprices both items
+        addon_id = response.data['id']
+        response = self.api.patch(
+            reverse('admin-quotation-item-addon-detail', args=[addon_id]), {'quotation_item_id': other_item.pk}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertGrandTotal('534.00')
+        self.item.refresh_from_db()
+        other_item.refresh_from_db()
+        self.assertEqual((self.item.line_total, other_item.line_total), (Decimal('264.00'), Decimal('270.00')))
+
+        response = self.api.delete(reverse('admin-quotation-item-addon-detail', args=[addon_id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertGrandTotal('528.00')
+
+    def test_admin_inline_delete_reprices(self):
+        client = self.client
+        client.force_login(self.admin_user)
+        items = list(self.quotation.items.order_by('id'))
+        data = {
+            'created_by': self.client_user.pk, 'company': 'ACME', 'project_name': 'Plant',
+            'status': 'pending', 'remarks': '',
+            'items-TOTAL_FORMS': len(items), 'items-INITIAL_FORMS': len(items),
+            'items-MIN_NUM_FORMS': 0, 'items-MAX_NUM_FORMS': 1000,
+        }
+        for index, item in enumerate(items):
+            data[f'items-{index}-id'] = item.pk
+            data[f'items-{index}-quotation'] = self.quotation.pk
+        data['items-0-DELETE'] = 'on'
+        response = client.post(reverse('admin:api_quotation_change', args=[self.quotation.pk]), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(QuotationItem.objects.filter(pk=items[0].pk).exists())
+        self.assertGrandTotal('264.00')
+
+    def test_verify_reports_mismatch(self):
+        call_command('reprice_quotations', '--verify', stdout=StringIO())
+
+        Quotation.objects.filter(pk=self.quotation.pk).update(grand_total='1.00')
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('reprice_quotations', '--verify', stdout=out)
+        self.assertIn(f"Quotation {self.quotation.pk}: stored RM 1.00, live RM 528.00", out.getvalue())
+
+    def test_backfill_keeps_updated_at(self):
+        Quotation.objects.filter(pk=self.quotation.pk).update(grand_total='0.00')
+        QuotationItem.objects.filter(quotation=self.quotation).update(unit_price='0.00', line_total='0.00')
+        updated_at = Quotation.objects.get(pk=self.quotation.pk).updated_at
+
+        call_command('reprice_quotations', stdout=StringIO())
+        self.assertGrandTotal('528.00')
+        self.assertEqual(self.quotation.updated_at, updated_at)
+
+        call_command('reprice_quotations', '--touch', stdout=StringIO())
+        self.quotation.refresh_from_db()
+        self.assertGreater(self.quotation.updated_at, updated_at)
+
+    def test_migration_backfill(self):
+        migration = import_module('api.migrations.0033_quotation_stored_totals')
+        Quotation.objects.filter(pk=self.quotation.pk).update(grand_total='0.00')
+        QuotationItem.objects.filter(quotation=self.quotation).update(unit_price='0.00', line_total='0.00')
+        updated_at = Quotation.objects.get(pk=self.quotation.pk).updated_at
+
+        migration.backfill_totals(django_apps, None)
+        self.assertGrandTotal('528.00')
+        self.assertEqual(self.quotation.updated_at, updated_at)
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.unit_price, self.item.line_total), (Decimal('132.00'), Decimal('264.00')))
+
+
+class QuotationExportTests(TemporaryMediaMixin, QuotationFixtureMixin, TestCase):
+    def setUp(self):
+        self.create_quotations(3, items_per_quotation=1)
+        self.ids = list(Quotation.objects.order_by('id').values_list('id', flat=True))
+        self.api = APIClient()
+        self.api.force_authenticate(self.engineer)
+
+    def export(self):
+        response = self.api.get(reverse('quotation-export'), {'ids': ','.join(map(str, self.ids))})
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(BytesIO(streamed_content(response)))
+        return response, archive
+
+    def test_streams_zip_of_all_pdfs(self):
+        # First export renders in the process pool, second is served from the PDF cache
+        pools = set()
+        for _ in range(2):
+            response, archive = self.export()
+            pools.add(pdf_export.get_render_pool())
+            self.assertEqual(sorted(archive.namelist()), sorted(f"Quotation_{pk}.pdf" for pk in self.ids))
+            self.assertTrue(all(archive.read(name).startswith(b'%PDF') for name in archive.namelist()))
+
+            progress = self.api.get(reverse('quotation-export-progress', args=[response['X-Export-Id']])).data
+            self.assertEqual(progress, {'total': 3, 'done': 3, 'failed': [], 'finished': True})
+        # Exports share one lazily started pool
+        self.assertEqual(len(pools), 1)
+
+    def test_archive_streams_under_asgi(self):
+        # Each body chunk must leave before the export has finished, not after a buffered run
+        seen = []
+
+        def on_send(event):
+            if event['type'] == 'http.response.start':
+                headers = {name.lower(): value for name, value in event['headers']}
+                seen.append(headers[b'x-export-id'].decode())
+            elif event['type'] == 'http.response.body' and event.get('body'):
+                seen.append(pdf_export.get_export_progress(seen[0])['finished'])
+
+        events = asgi_get(reverse('quotation-export'), self.engineer, f"ids={','.join(map(str, self.ids))}", on_send)
+        self.assertEqual(events[0]['status'], 200)
+        self.assertGreater(len(seen), 3)
+        self.assertFalse(any(seen[1:-1]))
+        archive = zipfile.ZipFile(BytesIO(b''.join(event.get('body', b'') for event in events[1:])))
+        self.assertEqual(len(archive.namelist()), 3)
+
+    def test_clients_cannot_export(self):
+        self.api.force_authenticate(self.client_user)
+        response = self.api.get(reverse('quotation-export'), {'ids': str(self.ids[0])})
+        self.assertEqual(response.status_code, 403)
+
+
+class QuotationPdfLayoutTests(TestCase):
+    def test_pack_blocks_keeps_order_and_fills_pages(self):
+        pages = pdf.pack_blocks([100, 100, 100, 250, 50], first_capacity=250, capacity=400, gap=10)
+        self.assertEqual(pages, [[0, 1], [2, 3], [4]])
+        # A block that cannot fit under the header starts on a fresh page
+        self.assertEqual(pdf.pack_blocks([300], first_capacity=200, capacity=400), [[], [0]])
+
+    def test_rendered_pages_match_packing(self):
+        with mock.patch('api.pdf.pack_blocks', wraps=pdf.pack_blocks) as pack:
+            pdf_data = pdf.generate_quotation_pdf(build_sample_quotation(40))
+        packed_pages = len(pdf.pack_blocks(*pack.call_args.args, **pack.call_args.kwargs))
+        self.assertEqual(pdf_data.count(b'/Type /Page\n'), packed_pages)
+        self.assertLess(packed_pages, 14)  # the old fixed 3-items-per-page layout needed 14
+
+    def test_render_context_reused_across_documents(self):
+        quotation = build_sample_quotation(2)
+        context = pdf.get_render_context()
+        first = pdf.generate_quotation_pdf(quotation)
+        second = pdf.generate_quotation_pdf(quotation)
+        self.assertIs(pdf.get_render_context(), context)
+        # The shared letterhead is embedded in every document, not just the first
+        self.assertEqual(len(first), len(second))
+        if context.letterhead is not None:
+            self.assertGreater(len(second), 100 * 1024)
+
+    def test_letterhead_is_one_shared_image(self):
+        letterhead = pdf.RenderContext().letterhead
+        self.assertIsNotNone(letterhead)
+        buffer = BytesIO()
+        page = canvas.Canvas(buffer, pagesize=A4)
+        for _ in range(3):
+            letterhead.draw(page)
+            page.showPage()
+        page.save()
+        pdf_data = buffer.getvalue()
+        # One image XObject, listed in the resources of every page
+        self.assertEqual(pdf_data.count(b'/Subtype /Image'), 1)
+        references = re.findall(rb'/FormXob\.\w+ \d+ 0 R', pdf_data)
+        self.assertEqual((len(references), len(set(references))), (3, 1))
+
+    def test_large_render_spools_to_disk(self):
+        quotation = build_sample_quotation(60)
+        with mock.patch('api.pdf.PDF_SPOOL_MAX_SIZE', 64 * 1024), pdf.spool_quotation_pdf(quotation) as pdf_file:
+            self.assertTrue(pdf_file._rolled)
+            self.assertEqual(pdf_file.read(5), b'%PDF-')
@@ -2,12 +2,13 @@ from django.urls import path
 from .views import (
     CategoryListView, CategoryDetailView,
     InstrumentTypeListView, InstrumentTypeDetailView,
-    InstrumentListView, InstrumentDetailView, InstrumentImageUploadView, InstrumentConfigView,
+    InstrumentListView, InstrumentDetailView, InstrumentImageUploadView, InstrumentConfigView, InstrumentConfigEvaluateView,
     ConfigurableFieldListView, ConfigurableFieldDetailView,
     FieldOptionListView, FieldOptionDetailView,
     AddOnTypeListView, AddOnTypeDetailView,
     AddOnListView, AddOnDetailView, InstrumentOptionListView,
     QuotationCreateView, SubmittedQuotationView, QuotationReviewView, QuotationSubmitView, QuotationDownloadView,
+    QuotationExportView, QuotationExportProgressView,
     QuotationItemListView, QuotationItemDetailView,
     QuotationItemSelectionListView, QuotationItemSelectionDetailView,
     QuotationItemAddOnListView, QuotationItemAddOnDetailView,
@@ -43,6 +44,7 @@ urlpatterns = [
     path('instruments/<int:pk>/', InstrumentDetailView.as_view(), name='instrument-detail'),
     path('instruments/<int:pk>/image/', InstrumentImageUploadView.as_view(), name='instrument-image-upload'),
     path('instruments/<int:pk>/config/', InstrumentConfigView.as_view(), name='instrument-config'),
+    path('instruments/<int:pk>/config/evaluate/', InstrumentConfigEvaluateView.as_view(), name='instrument-config-evaluate'),
 
     # ConfigurableField endpoints
     path('configurable-fields/', ConfigurableFieldListView.as_view(), name='configurable-field-list'),
@@ -68,6 +70,8 @@ urlpatterns = [
     path('quotations/review/', QuotationReviewView.as_view(), name='quotation-review-list'),
     path('quotations/<int:pk>/submit/', QuotationSubmitView.as_view(), name='quotation-submit'),
     path('quotations/<int:pk>/download-pdf/', QuotationDownloadView.as_view(), name='quotation-download-pdf'),
+    path('quotations/export/', QuotationExportView.as_view(), name='quotation-export'),
+    path('quotations/export/<str:export_id>/', QuotationExportProgressView.as_view(), name='quotation-export-progress'),
 
     # QuotationItem endpoints
     path('quotation-items/', QuotationItemListView.as_view(), name='quotation-item-list'),
@@ -1,24 +1,26 @@
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from rest_framework import generics, permissions, status
 from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Count
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_etags
 from rest_framework.permissions import IsAuthenticated
-from django.conf import settings
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.core.mail import EmailMessage
 from django.utils import timezone
 import logging
 from django.contrib.auth import get_user_model
 from .models import (
     Category, InstrumentType, Instrument, ConfigurableField,
     FieldOption, AddOnType, AddOn, Quotation, QuotationItem,
-    QuotationItemSelection, QuotationItemAddOn
+    QuotationItemSelection, QuotationItemAddOn, QuotationDeliveryJob
 )
 from .serializers import (
     CategorySerializer, InstrumentTypeSerializer, InstrumentSerializer,
     ConfigurableFieldSerializer, FieldOptionSerializer,
     AddOnTypeSerializer, AddOnSerializer,
-    InstrumentConfigSerializer, QuotationSerializer,
+    InstrumentConfigSerializer, ConfigurationEvaluateSerializer, QuotationSerializer,
     QuotationReviewSerializer, QuotationItemSerializer,
     QuotationItemSelectionSerializer, QuotationItemAddOnSerializer,
     AdminCategorySerializer, AdminInstrumentTypeSerializer,
@@ -28,13 +30,15 @@ from .serializers import (
     AdminQuotationItemSerializer, AdminQuotationItemSelectionSerializer,
     AdminQuotationItemAddOnSerializer, UserSerializer
 )
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Frame, PageTemplate, KeepTogether, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import mm
-from reportlab.lib import colors
-import os
-from io import BytesIO
+from .pricing import reprice_item, reprice_quotation
+from .pagination import SubmittedAtCursorPagination
+from .configurator import get_instrument_config, evaluate_configuration, ConfigurationError
+from .pdf_cache import get_quotation_pdf, quotation_pdf_key
+from .pdf_export import QuotationPdfExport, export_response, get_export_progress
+from .delivery import enqueue_quotation_delivery
+from .blobs import HashingUploadHandler
+from .streaming import async_chunks, file_chunks
+from .media import enqueue_media_upload, stage_media, supersede_media_uploads
 import traceback
 
 logger = logging.getLogger(__name__)
@@ -54,6 +58,36 @@ class IsProposalEngineerOrAdmin(permissions.BasePermission):
     def has_permission(self, request, view):
         return request.user.is_authenticated and request.user.role in ['proposal_engineer', 'admin']
 
+# Keeps the stored QuotationItem/Quotation totals in sync for views that write
+# items, selections or add-ons outside of QuotationSerializer.create
+class RepriceOnWriteMixin:
+    def _priced_item(self, instance):
+        return instance if isinstance(instance, QuotationItem) else instance.quotation_item
+
+    def perform_create(self, serializer):
+        instance = serializer.save()
+        reprice_item(self._priced_item(instance))
+
+    def perform_update(self, serializer):
+        previous = self._priced_item(serializer.instance)
+        previous_item_id, previous_quotation_id = previous.pk, previous.quotation_id
+        item = self._priced_item(serializer.save())
+        reprice_item(item)
+        if item.pk != previous_item_id:
+            stale_item = QuotationItem.objects.filter(pk=previous_item_id).first()
+            if stale_item:
+                reprice_item(stale_item)
+        elif item.quotation_id != previous_quotation_id:
+            reprice_quotation(previous_quotation_id)
+
+    def perform_destroy(self, instance):
+        item = self._priced_item(instance)
+        instance.delete()
+        if item is instance:
+            reprice_quotation(item.quotation_id)
+        else:
+            reprice_item(item)
+
 # User Views
 class UserListView(generics.ListAPIView):
     queryset = User.objects.all()
@@ -118,13 +152,28 @@ class InstrumentImageUploadView(APIView):
             instrument = Instrument.objects.get(pk=pk)
         except Instrument.DoesNotExist:
             return Response({'detail': 'Instrument not found'}, status=status.HTTP_404_NOT_FOUND)
+        # Hashed while it spools so a known image is reused instead of uploaded again
+        request._request.upload_handlers = [HashingUploadHandler(request._request)]
         image = request.FILES.get('image')
         if not image:
             return Response({'detail': 'No image provided'}, status=status.HTTP_400_BAD_REQUEST)
-        instrument.image = image
-        instrument.save()
+        blob, staged = stage_media(Instrument._meta.get_field('image'), image)
+        if blob is not None:
+            with transaction.atomic():
+                instrument.image = blob.name
+                instrument.image_blob = blob
+                instrument.save(update_fields=['image', 'image_blob'])
+                # Earlier uploads still on their way to storage must not land on top of this one
+                supersede_media_uploads(instrument, 'image')
+            serializer = InstrumentSerializer(instrument)
+            return Response({**serializer.data, 'image_status': 'stored'})
+
+        # New content goes to storage in the media worker; the instrument keeps its
+        # current image until then and the uploader hears back on the websocket
+        job = enqueue_media_upload(instrument, 'image', staged, image.name, requested_by=request.user)
+        logger.info(f"Image for instrument {pk} queued for storage as job {job.id}")
         serializer = InstrumentSerializer(instrument)
-        return Response(serializer.data)
+        return Response({**serializer.data, 'image_status': 'pending', 'job': job.id}, status=status.HTTP_202_ACCEPTED)
 
 class InstrumentConfigView(generics.RetrieveAPIView):
     queryset = Instrument.objects.all()
@@ -132,6 +181,36 @@ class InstrumentConfigView(generics.RetrieveAPIView):
     lookup_field = "pk"
     permission_classes = [IsAuthenticated]
 
+    def retrieve(self, request, *args, **kwargs):
+        # Served from the compiled, cached document; unchanged configs only cost a 304
+        entry = get_instrument_config(kwargs[self.lookup_field])
+        if entry is None:
+            return Response({'detail': 'Instrument not found'}, status=status.HTTP_404_NOT_FOUND)
+        etag = f'"{entry["etag"]}"'
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(entry['document'], headers=headers)
+
+class InstrumentConfigEvaluateView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        serializer = ConfigurationEvaluateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            result = evaluate_configuration(pk, **serializer.validated_data)
+        except ConfigurationError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Money as strings, matching the prices in the config document
+        for key in ('base_price', 'unit_price', 'line_total'):
+            result[key] = str(result[key])
+        for line in result['selections'] + result['addons']:
+            line['price'] = str(line['price'])
+        return Response(result)
+
 # ConfigurableField Views
 class ConfigurableFieldListView(generics.ListCreateAPIView):
     queryset = ConfigurableField.objects.all()
@@ -197,7 +276,7 @@ class SubmittedQuotationView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        queryset = Quotation.objects.filter(created_by=self.request.user).order_by('-submitted_at')
+        queryset = Quotation.objects.with_details().filter(created_by=self.request.user).order_by('-submitted_at')
         status_filter = self.request.query_params.get('status')
         if status_filter in ['pending', 'rejected', 'approved', 'submitted']:
             queryset = queryset.filter(status=status_filter)
@@ -206,7 +285,25 @@ class SubmittedQuotationView(generics.ListAPIView):
 class QuotationReviewView(generics.GenericAPIView):
     serializer_class = QuotationReviewSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
-    queryset = Quotation.objects.all().order_by('-submitted_at')
+    queryset = Quotation.objects.order_by('-submitted_at', '-id')
+    pagination_class = SubmittedAtCursorPagination
+
+    # ?fields=summary shape for the review queue; items are fetched with ?expand=items or the detail URL
+    SUMMARY_FIELDS = ['id', 'company', 'project_name', 'status', 'submitted_at', 'total_price', 'item_count']
+    EXPANDABLE_FIELDS = ['items']
+
+    def get_projected_fields(self):
+        fields_param = self.request.query_params.get('fields')
+        expand_param = self.request.query_params.get('expand')
+        if not fields_param and not expand_param:
+            return None
+        if not fields_param or fields_param == 'summary':
+            fields = list(self.SUMMARY_FIELDS)
+        else:
+            fields = [name.strip() for name in fields_param.split(',') if name.strip()]
+        expand = [name.strip() for name in (expand_param or '').split(',')]
+        fields += [name for name in self.EXPANDABLE_FIELDS if name in expand and name not in fields]
+        return fields
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -216,8 +313,22 @@ class QuotationReviewView(generics.GenericAPIView):
         return queryset
 
     def get(self, request, *args, **kwargs):
-        serializer = QuotationSerializer(self.get_queryset(), many=True)
-        return Response(serializer.data)
+        if kwargs.get('pk') is not None:
+            quotation = get_object_or_404(Quotation.objects.with_details(), pk=kwargs['pk'])
+            return Response(QuotationSerializer(quotation).data)
+
+        fields = self.get_projected_fields()
+        queryset = self.get_queryset()
+        if fields is None or 'items' in fields:
+            queryset = queryset.with_details()
+        else:
+            queryset = queryset.select_related('created_by', 'reviewed_by').annotate(item_count=Count('items'))
+
+        page = self.paginate_queryset(queryset)
+        serializer = QuotationSerializer(queryset if page is None else page, many=True, fields=fields)
+        if page is None:
+            return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
 
     def patch(self, request, *args, **kwargs):
         quotation_id = kwargs.get('pk')
@@ -235,203 +346,9 @@ class QuotationReviewView(generics.GenericAPIView):
                 quotation.approved_at = timezone.now()
                 quotation.reviewed_by = request.user
             serializer.save()
-            return Response(QuotationSerializer(quotation).data)
+            return Response(QuotationSerializer(Quotation.objects.with_details().get(pk=quotation.pk)).data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-def page_canvas(canvas, doc):
-    canvas.saveState()
-    letterhead_path = os.path.join(settings.STATIC_ROOT, 'images', 'letterhead.jpg')
-    logger.info(f"Rendering letterhead for page {doc.page} at {letterhead_path}")
-    if os.path.exists(letterhead_path):
-        try:
-            canvas.drawImage(letterhead_path, 0, 0, width=A4[0], height=A4[1], preserveAspectRatio=True)
-        except Exception as e:
-            logger.error(f"Failed to render letterhead on page {doc.page}: {str(e)}\n{traceback.format_exc()}")
-    else:
-        logger.warning(f"Letterhead not found at {letterhead_path}")
-    canvas.restoreState()
-
-class CustomDocTemplate(SimpleDocTemplate):
-    def __init__(self, filename, **kwargs):
-        super().__init__(filename, **kwargs)
-        frame = Frame(15*mm, 15*mm, A4[0]-30*mm, A4[1]-30*mm)
-        template = PageTemplate(id='AllPages', frames=[frame], onPage=page_canvas)
-        self.addPageTemplates(template)  # Single template for all pages
-
-def generate_quotation_pdf(quotation):
-    buffer = BytesIO()
-    doc = CustomDocTemplate(
-        buffer,
-        pagesize=A4,
-        rightMargin=20*mm,
-        leftMargin=20*mm,
-        topMargin=15*mm,
-        bottomMargin=15*mm
-    )
-    elements = []
-    styles = getSampleStyleSheet()
-
-    title_style = ParagraphStyle(name='Title', fontSize=16, leading=20, fontName='Helvetica-Bold', spaceAfter=10, leftIndent=0, alignment=0)
-    heading_style = ParagraphStyle(name='Heading', fontSize=12, leading=16, fontName='Helvetica-Bold', spaceBefore=10, spaceAfter=8, leftIndent=0, alignment=0)
-    normal_style = ParagraphStyle(name='Normal', fontSize=10, leading=12, fontName='Helvetica')
-    bold_style = ParagraphStyle(name='Bold', fontSize=10, leading=12, fontName='Helvetica-Bold', leftIndent=0)
-    list_style = ParagraphStyle(name='List', fontSize=10, leading=14, fontName='Helvetica')
-
-    # Title
-    elements.append(Spacer(1, 20*mm))  # Top padding
-    elements.append(Paragraph(f"Purchase Order Quotation #{quotation.id}", title_style))
-    elements.append(Spacer(1, 5*mm))
-
-    # Details: Two-column layout
-    try:
-        total_price = quotation.calculate_total_price()
-        total_price_str = f"RM {total_price:,.2f}" if total_price is not None else "N/A"
-    except Exception as e:
-        logger.error(f"Failed to calculate total_price for quotation {quotation.id}: {str(e)}")
-        total_price_str = "N/A"
-    logger.debug(f"Quotation {quotation.id} total_price: {total_price_str}")
-
-    details_left = [
-        f"<b>Submitted by:</b> {quotation.created_by.first_name if quotation.created_by else 'N/A'}",
-        f"<b>Company:</b> {quotation.company or 'N/A'}",
-        f"<b>Project:</b> {quotation.project_name or 'N/A'}",
-        f"<b>Total Quotation Price:</b> {total_price_str}",
-    ]
-    details_right = [
-        f"<b>Submitted at:</b> {quotation.submitted_at.strftime('%b %d, %Y, %I:%M %p') if quotation.submitted_at else 'N/A'}",
-        f"<b>Reviewed by:</b> {quotation.reviewed_by.first_name if quotation.reviewed_by else 'N/A'}",
-        f"<b>Status:</b> {quotation.status.capitalize() if quotation.status else 'N/A'}",
-        f"<b>Approved at:</b> {quotation.approved_at.strftime('%b %d, %Y, %I:%M %p') if quotation.approved_at else 'N/A'}",
-    ]
-
-    details_data = [[Paragraph(left, normal_style), Paragraph(right, normal_style)] for left, right in zip(details_left, details_right)]
-    details_table = Table(details_data, colWidths=[85*mm, 85*mm])
-    details_table.setStyle(TableStyle([
-        ('FONT', (0, 0), (-1, -1), 'Helvetica', 10),
-        ('LEFTPADDING', (0, 0), (-1, -1), 5),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 5),
-        ('TOPPADDING', (0, 0), (-1, -1), 2),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-    ]))
-    elements.append(details_table)
-    elements.append(Spacer(1, 5*mm))
-
-    # Divider
-    divider_data = [['']]
-    divider_table = Table(divider_data, colWidths=[A4[0]-40*mm])
-    divider_table.setStyle(TableStyle([
-        ('LINEBELOW', (0, 0), (-1, -1), 0.3, colors.HexColor('#646464')),
-    ]))
-    elements.append(divider_table)
-    elements.append(Spacer(1, 10*mm))
-
-    # Instruments section
-    items = quotation.items.all()
-    if not items:
-        elements.append(Paragraph("No instruments listed.", normal_style))
-    else:
-        page_height_limit = 744.85
-        current_page_height = 20*mm + 30 + 5*mm + len(details_left)*14 + 5*mm + 10 + 10*mm + 28
-        items_per_page = []
-        page_groups = []
-
-        for idx, item in enumerate(items, 1):
-            item_group = []
-            estimated_height = 14  # Item #<n> table (~14pt)
-
-            try:
-                item_total_price = item.calculate_total_price()
-                item_total_price_str = f"RM {item_total_price:,.2f}" if item_total_price is not None else "N/A"
-            except (AttributeError, Exception) as e:
-                logger.error(f"Failed to calculate total_price for QuotationItem {item.id}: {str(e)}")
-                item_total_price_str = "N/A"
-            logger.debug(f"QuotationItem {item.id} total_price: {item_total_price_str}")
-
-            selections_text = ""
-            selections = item.selections.all()
-            if selections:
-                for s in selections:
-                    if s.field_option:
-                        selections_text += f"• {s.field_option.label} ({s.field_option.code})<br/>"
-            else:
-                selections_text = "None"
-
-            addons_text = ""
-            addons = item.addons.all()
-            if addons:
-                for a in addons:
-                    if a.addon:
-                        addons_text += f"• {a.addon.label} ({a.addon.code})<br/>"
-            else:
-                addons_text = "None"
-
-            item_data = [
-                [Paragraph("Instrument Name:", bold_style), Paragraph((item.instrument.name if item.instrument else item.name) or 'N/A', normal_style)],
-                [Paragraph("Product Code:", bold_style), Paragraph(item.product_code or 'N/A', normal_style)],
-                [Paragraph("Quantity:", bold_style), Paragraph(str(item.quantity or 1), normal_style)],
-                [Paragraph("Total Price:", bold_style), Paragraph(item_total_price_str, normal_style)],
-                [Paragraph("Selections:", bold_style), Paragraph(selections_text, list_style)],
-                [Paragraph("Add-Ons:", bold_style), Paragraph(addons_text, list_style)],
-            ]
-            item_table = Table(item_data, colWidths=[50*mm, 120*mm])
-            item_table.setStyle(TableStyle([
-                ('FONT', (0, 0), (-1, -1), 'Helvetica', 10),
-                ('LEFTPADDING', (0, 0), (-1, -1), 5),
-                ('RIGHTPADDING', (0, 0), (-1, -1), 5),
-                ('TOPPADDING', (0, 0), (-1, -1), 2),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
-                ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ]))
-            # Item #<n> in a Table for alignment
-            item_number_table = Table([[Paragraph(f"Item #{idx}", bold_style)]], colWidths=[170*mm])
-            item_number_table.setStyle(TableStyle([
-                ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold', 10),
-                ('LEFTPADDING', (0, 0), (-1, -1), 5),
-                ('RIGHTPADDING', (0, 0), (-1, -1), 0),
-                ('TOPPADDING', (0, 0), (-1, -1), 0),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 0),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ]))
-            item_group.append(item_number_table)
-            item_group.append(Spacer(1, 2))  # Match Details spacing
-            item_group.append(item_table)
-            estimated_height += 84  # 6 rows * ~14pt
-            estimated_height += (len(selections) + len(addons)) * 14  # ~14pt per line
-            item_group.append(Spacer(1, 24))
-            estimated_height += 24
-
-            items_per_page.append((item_group, estimated_height))
-            current_page_height += estimated_height
-
-            if len(items_per_page) >= 3 or current_page_height > page_height_limit or idx == len(items):
-                page_groups.append(items_per_page)
-                items_per_page = []
-                current_page_height = 28 + 10*mm
-            elif idx < len(items):
-                current_page_height += 24
-
-        for page_idx, page_items in enumerate(page_groups):
-            if page_idx > 0:
-                elements.append(PageBreak())
-                elements.append(Paragraph("Instruments (Continued)", heading_style))
-                elements.append(Spacer(1, 10*mm))
-
-            for item_group, _ in page_items:
-                elements.append(KeepTogether(item_group))
-
-    try:
-        doc.build(elements)
-        pdf_data = buffer.getvalue()
-    except Exception as e:
-        logger.error(f"PDF generation failed for quotation {quotation.id}: {str(e)}\n{traceback.format_exc()}")
-        raise
-    finally:
-        buffer.close()
-
-    return pdf_data
-
 class QuotationSubmitView(APIView):
     permission_classes = [IsAuthenticated, IsClient]
 
@@ -453,96 +370,126 @@ class QuotationSubmitView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        try:
-            pdf_data = generate_quotation_pdf(quotation)
-        except Exception as e:
-            logger.error(f"PDF generation failed for quotation {pk}: {str(e)}\n{traceback.format_exc()}")
-            return Response(
-                {'detail': f'Failed to generate PDF: {str(e)}'},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
-
-        try:
-            sales_email_msg = EmailMessage(
-                subject=f"Approved Purchase Order Quotation #{quotation.id} Submission",
-                body=f"Dear Sales Team,\n\nQuotation #{quotation.id} from {quotation.company or 'N/A'} has been approved and submitted by {request.user.first_name or 'Client'} ({client_email}).\nThe PDF is attached for your reference.\n\nBest regards,\nInstruGate System",
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=['adriannorman@graduate.utm.my'],
-                cc=[client_email],
-            )
-            sales_email_msg.attach(f"Quotation_{quotation.id}.pdf", pdf_data, 'application/pdf')
-            sales_email_msg.send(fail_silently=False)
-        except Exception as e:
-            logger.error(f"Email sending failed for quotation {pk}: {str(e)}\n{traceback.format_exc()}")
-            return Response(
-                {'detail': f'Failed to send email to sales team: {str(e)}'},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
-
-        quotation.status = 'submitted'
-        quotation.emailed_at = timezone.now()
-        quotation.save()
-
+        # PDF rendering and SMTP run in the delivery worker; the quotation turns
+        # 'submitted' once the email has actually been sent
+        job = enqueue_quotation_delivery(quotation, requested_by=request.user)
+        logger.info(f"Quotation {pk} queued for delivery as job {job.id}")
         return Response(
-            {'detail': 'Quotation submitted successfully via email'},
-            status=status.HTTP_200_OK
+            {'detail': 'Quotation queued for submission via email', 'job': job.id, 'status': job.status},
+            status=status.HTTP_202_ACCEPTED
         )
 
+    def get(self, request, pk):
+        job = QuotationDeliveryJob.objects.filter(
+            quotation_id=pk, quotation__created_by=request.user
+        ).select_related('quotation').order_by('-id').first()
+        if job is None:
+            return Response({'detail': 'No submission found for this quotation'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            'job': job.id,
+            'status': job.status,
+            'attempts': job.attempts,
+            'last_error': job.last_error,
+            'quotation_status': job.quotation.status,
+            'emailed_at': job.quotation.emailed_at,
+        })
+
 class QuotationDownloadView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, pk):
+        # Only id/updated_at are needed to address the cached PDF
+        queryset = Quotation.objects.only('id', 'updated_at', 'created_by_id')
+        if request.user.role == 'client':
+            quotation = get_object_or_404(queryset, pk=pk, created_by=request.user)
+        else:
+            quotation = get_object_or_404(queryset, pk=pk)
+
+        etag = f'"{quotation_pdf_key(quotation)}"'
+        last_modified = int(quotation.updated_at.timestamp())
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(last_modified),
+            'Cache-Control': 'private, no-cache',
+        }
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            for header, value in headers.items():
+                not_modified[header] = value
+            return not_modified
+
         try:
-            if request.user.role == 'client':
-                quotation = get_object_or_404(Quotation, pk=pk, created_by=request.user)
-            else:
-                quotation = get_object_or_404(Quotation, pk=pk)
-
-            logger.info(f"Generating PDF for quotation {pk} by user {request.user.id}")
-            pdf_data = generate_quotation_pdf(quotation)
-
-            response = HttpResponse(content_type='application/pdf')
-            response['Content-Disposition'] = f'attachment; filename=Quotation_{pk}.pdf'
-            response.write(pdf_data)
-            logger.info(f"PDF generated successfully for quotation {pk}")
-            return response
+            storage, name = get_quotation_pdf(quotation)
+            pdf_file = storage.open(name, 'rb')
+            # Not FileResponse: under ASGI Django 4.2 reads a sync file into a list before sending it
+            response = StreamingHttpResponse(async_chunks(file_chunks(pdf_file)), content_type='application/pdf')
+            response['Content-Length'] = pdf_file.size
+            response['Content-Disposition'] = content_disposition_header(True, f"Quotation_{pk}.pdf")
         except Exception as e:
             logger.error(f"Error in QuotationDownloadView for quotation {pk}: {str(e)}\n{traceback.format_exc()}")
             return Response(
                 {'detail': f'Failed to generate PDF: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+class QuotationExportView(APIView):
+    permission_classes = [IsProposalEngineerOrAdmin]
+
+    def get(self, request):
+        # ?ids=1,2,3 -> ZIP of Quotation_<id>.pdf, streamed as the PDFs are rendered
+        try:
+            ids = [int(value) for value in request.query_params.get('ids', '').split(',') if value.strip()]
+        except ValueError:
+            return Response({'detail': 'ids must be a comma-separated list of quotation ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if not ids:
+            return Response({'detail': 'No quotation ids given'}, status=status.HTTP_400_BAD_REQUEST)
+        quotation_ids = list(Quotation.objects.filter(pk__in=ids).order_by('id').values_list('id', flat=True))
+        if not quotation_ids:
+            return Response({'detail': 'No matching quotations'}, status=status.HTTP_404_NOT_FOUND)
+        return export_response(QuotationPdfExport(quotation_ids))
+
+class QuotationExportProgressView(APIView):
+    permission_classes = [IsProposalEngineerOrAdmin]
+
+    def get(self, request, export_id):
+        progress = get_export_progress(export_id)
+        if progress is None:
+            return Response({'detail': 'Export not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(progress)
 
 # QuotationItem Views
-class QuotationItemListView(generics.ListCreateAPIView):
-    queryset = QuotationItem.objects.all()
+class QuotationItemListView(RepriceOnWriteMixin, generics.ListCreateAPIView):
+    queryset = QuotationItem.objects.with_details()
     serializer_class = QuotationItemSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
 
-class QuotationItemDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = QuotationItem.objects.all()
+class QuotationItemDetailView(RepriceOnWriteMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = QuotationItem.objects.with_details()
     serializer_class = QuotationItemSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
 
 # QuotationItemSelection Views
-class QuotationItemSelectionListView(generics.ListCreateAPIView):
-    queryset = QuotationItemSelection.objects.all()
+class QuotationItemSelectionListView(RepriceOnWriteMixin, generics.ListCreateAPIView):
+    queryset = QuotationItemSelection.objects.select_related('field_option')
     serializer_class = QuotationItemSelectionSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
 
-class QuotationItemSelectionDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = QuotationItemSelection.objects.all()
+class QuotationItemSelectionDetailView(RepriceOnWriteMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = QuotationItemSelection.objects.select_related('field_option')
     serializer_class = QuotationItemSelectionSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
 
 # QuotationItemAddOn Views
-class QuotationItemAddOnListView(generics.ListCreateAPIView):
-    queryset = QuotationItemAddOn.objects.all()
+class QuotationItemAddOnListView(RepriceOnWriteMixin, generics.ListCreateAPIView):
+    queryset = QuotationItemAddOn.objects.select_related('addon__addon_type').prefetch_related('addon__addon_type__instruments')
     serializer_class = QuotationItemAddOnSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
 
-class QuotationItemAddOnDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = QuotationItemAddOn.objects.all()
+class QuotationItemAddOnDetailView(RepriceOnWriteMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = QuotationItemAddOn.objects.select_related('addon__addon_type').prefetch_related('addon__addon_type__instruments')
     serializer_class = QuotationItemAddOnSerializer
     permission_classes = [IsProposalEngineerOrAdmin]
 
@@ -627,32 +574,32 @@ class AdminQuotationDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = AdminQuotationSerializer
     permission_classes = [IsAdmin]
 
-class AdminQuotationItemListView(generics.ListCreateAPIView):
+class AdminQuotationItemListView(RepriceOnWriteMixin, generics.ListCreateAPIView):
     queryset = QuotationItem.objects.all()
     serializer_class = AdminQuotationItemSerializer
     permission_classes = [IsAdmin]
 
-class AdminQuotationItemDetailView(generics.RetrieveUpdateDestroyAPIView):
+class AdminQuotationItemDetailView(RepriceOnWriteMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = QuotationItem.objects.all()
     serializer_class = AdminQuotationItemSerializer
     permission_classes = [IsAdmin]
 
-class AdminQuotationItemSelectionListView(generics.ListCreateAPIView):
+class AdminQuotationItemSelectionListView(RepriceOnWriteMixin, generics.ListCreateAPIView):
     queryset = QuotationItemSelection.objects.all()
     serializer_class = AdminQuotationItemSelectionSerializer
     permission_classes = [IsAdmin]
 
-class AdminQuotationItemSelectionDetailView(generics.RetrieveUpdateDestroyAPIView):
+class AdminQuotationItemSelectionDetailView(RepriceOnWriteMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = QuotationItemSelection.objects.all()
     serializer_class = AdminQuotationItemSelectionSerializer
     permission_classes = [IsAdmin]
 
-class AdminQuotationItemAddOnListView(generics.ListCreateAPIView):
+class AdminQuotationItemAddOnListView(RepriceOnWriteMixin, generics.ListCreateAPIView):
     queryset = QuotationItemAddOn.objects.all()
     serializer_class = AdminQuotationItemAddOnSerializer
     permission_classes = [IsAdmin]
 
-class AdminQuotationItemAddOnDetailView(generics.RetrieveUpdateDestroyAPIView):
+class AdminQuotationItemAddOnDetailView(RepriceOnWriteMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = QuotationItemAddOn.objects.all()
     serializer_class = AdminQuotationItemAddOnSerializer
     permission_classes = [IsAdmin]
\ No newline at end of file
@@ -9,7 +9,6 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
@@ -20,48 +19,16 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 # Initialize Django
 django.setup()
 
-# Import models after setup
-from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import AccessToken
-from django.contrib.auth import get_user_model
-from channels.db import database_sync_to_async
-
 django_asgi_app = get_asgi_application()
 
+from chat.middleware import TokenAuthMiddleware
 from chat.routing import websocket_urlpatterns
 
-User = get_user_model()
-
-@database_sync_to_async
-def get_user_from_token(token):
-    try:
-        validated_token = AccessToken(token)
-        user_id = validated_token['user_id']
-        return User.objects.get(id=user_id)
-    except Exception:
-        return AnonymousUser()
-
-class TokenAuthMiddleware:
-    def __init__(self, inner):
-        self.inner = inner
-
-    async def __call__(self, scope, receive, send):
-        query_string = scope.get('query_string', b'').decode()
-        params = dict(q.split('=') for q in query_string.split('&') if '=' in q)
-        token = params.get('token')
-        if token:
-            scope['user'] = await get_user_from_token(token)
-        else:
-            scope['user'] = AnonymousUser()
-        return await self.inner(scope, receive, send)
-
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            TokenAuthMiddleware(
-                AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
-            )
+            TokenAuthMiddleware(URLRouter(websocket_urlpatterns))
         ),
     }
 )
\ No newline at end of file
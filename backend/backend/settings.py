@@ -112,6 +112,28 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Client -> engineer chat assignments (chat.assignments), shared by every Daphne
+# worker through the channel-layer Redis
+CHAT_ASSIGNMENT_REGISTRY = {
+    'BACKEND': 'chat.assignments.RedisAssignmentRegistry',
+}
+
+# Shared cache (compiled configurator documents, reset tokens). Falls back to
+# per-process memory when no Redis is configured, e.g. in tests.
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get("REDIS_URL"),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -208,4 +230,26 @@ EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'instrugate.system@gmail.com'
-EMAIL_HOST_PASSWORD = 'hfvp lsow ysrr utnx'
\ No newline at end of file
+EMAIL_HOST_PASSWORD = 'hfvp lsow ysrr utnx'
+# Seconds before a stalled SMTP connection fails the attempt. Delivery jobs hold a
+# 10-minute lease (api.delivery.JOB_LEASE); a send must never outlive it, or a second
+# worker re-claims the job and the email goes out twice.
+EMAIL_TIMEOUT = 60
+# Rendered quotation PDFs (api.pdf_cache): Cloudinary when it is configured,
+# otherwise plain files under MEDIA_ROOT
+QUOTATION_PDF_STORAGE = (
+    'cloudinary_storage.storage.RawMediaCloudinaryStorage'
+    if os.environ.get('CLOUDINARY_CLOUD_NAME')
+    else 'django.core.files.storage.FileSystemStorage'
+)
+
+# Resumable chat uploads (chat.uploads) stage their chunks here until completion;
+# it has to be shared by every worker that serves the upload endpoints
+CHAT_UPLOAD_STAGING_DIR = os.environ.get('CHAT_UPLOAD_STAGING_DIR', BASE_DIR / 'chat_upload_staging')
+
+# Uploads waiting for `manage.py run_media_upload_worker` to push them to remote
+# storage (api.media); the web processes and the worker must share it
+MEDIA_UPLOAD_STAGING_DIR = os.environ.get('MEDIA_UPLOAD_STAGING_DIR', BASE_DIR / 'media_upload_staging')
+# Socket timeout (seconds) of `run_media_upload_worker`, so a stalled storage upload fails
+# the attempt well inside the job lease, as EMAIL_TIMEOUT does for deliveries
+MEDIA_UPLOAD_TIMEOUT = 60
@@ -4,7 +4,9 @@ from django.views.generic import RedirectView
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django.conf import settings
 from django.conf.urls.static import static
-from chat.views import upload_file
+from chat.views import (
+    upload_file, room_messages, start_chunked_upload, chunked_upload_status, upload_chunk, complete_chunked_upload
+)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -14,6 +16,11 @@ urlpatterns = [
     path("api/", include("api.urls")),
     path("api/users/", include("users.urls")),
     path('api/chat/upload/', upload_file, name='upload_file'),
+    path('api/chat/rooms/<str:room_name>/messages/', room_messages, name='room_messages'),
+    path('api/chat/uploads/', start_chunked_upload, name='chunked_upload_start'),
+    path('api/chat/uploads/<uuid:upload_id>/', chunked_upload_status, name='chunked_upload_status'),
+    path('api/chat/uploads/<uuid:upload_id>/chunks/<int:index>/', upload_chunk, name='chunked_upload_chunk'),
+    path('api/chat/uploads/<uuid:upload_id>/complete/', complete_chunked_upload, name='chunked_upload_complete'),
     path('', RedirectView.as_view(url='/admin/', permanent=False), name='home'),
     path('favicon.ico', RedirectView.as_view(url='/static/favicon.ico')),  # Favicon
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
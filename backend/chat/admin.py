@@ -1,11 +1,11 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import ChatMessage
+from .models import ChatMessage, ChatUpload, Conversation
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ('id', 'room_name', 'sender', 'sender_type', 'assistance', 'assistance_type','timestamp', 'is_read')
-    list_filter = ('room_name', 'sender_type', 'is_read')
+    list_display = ('id', 'room_name', 'sender', 'sender_type', 'assistance', 'assistance_type','timestamp')
+    list_filter = ('room_name', 'sender_type')
     search_fields = ('content', 'sender__username', 'assistance__username', 'file_name')
     ordering = ('-timestamp',)
 
@@ -20,4 +20,22 @@ class ChatMessageAdmin(admin.ModelAdmin):
             has_agent_message = ChatMessage.objects.filter(sender=obj.assistance, sender_type='agent').exists()
             return 'Agent' if has_agent_message else 'N/A'
         return 'N/A'
-    assistance_type.short_description = 'Assistance Type'
\ No newline at end of file
+    assistance_type.short_description = 'Assistance Type'
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('room_name', 'assistance', 'engineer_unread_count', 'client_unread_count', 'last_message_at')
+    search_fields = ('room_name', 'assistance__username')
+    raw_id_fields = ('assistance', 'last_message')
+    ordering = ('-last_message_at',)
+
+
+
+@admin.register(ChatUpload)
+class ChatUploadAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_name', 'user', 'room_name', 'size', 'status', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('file_name', 'user__username', 'room_name')
+    raw_id_fields = ('user', 'message')
+    ordering = ('-created_at',)
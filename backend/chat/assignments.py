@@ -0,0 +1,222 @@
+"""
+Shared client -> engineer assignment registry for ChatConsumer.
+
+Assignments used to live in a module-level dict, i.e. one copy per Daphne
+process. They now live in the channel-layer Redis so every worker sees the same
+owner for a client:
+
+    chat:{assignments}:assignment:<client>         -> engineer username, with a TTL
+    chat:{assignments}:engineer-clients:<engineer> -> set of clients the engineer holds
+
+claim() is SET NX EX in a Lua script, so checking and taking a client is one
+atomic round trip. Connected engineers refresh their keys with heartbeat();
+assignments held by a worker that died simply expire.
+
+Every key a script touches is passed in KEYS, and all of them share the
+{assignments} hash tag, so the scripts also run on Redis Cluster: the keys
+land in one slot. Where a script would have to discover keys (the owner of a
+client, the clients of an engineer), the caller reads them first and the
+script re-checks what it was given.
+
+InMemoryAssignmentRegistry implements the same API for tests and single-process
+development. The backend is chosen by settings.CHAT_ASSIGNMENT_REGISTRY.
+"""
+import asyncio
+import time
+import weakref
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+ASSIGNMENT_TTL = 90  # seconds; engineers heartbeat every ASSIGNMENT_TTL / 3
+
+
+# One hash tag for every key, so multi-key commands and scripts stay in one cluster slot
+KEY_PREFIX = 'chat:{assignments}'
+
+
+def assignment_key(client):
+    return f"{KEY_PREFIX}:assignment:{client}"
+
+
+def engineer_clients_key(engineer):
+    return f"{KEY_PREFIX}:engineer-clients:{engineer}"
+
+
+# Returns {owner, created}; refreshes the TTL when the caller already owns the client
+CLAIM_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    redis.call('SADD', KEYS[2], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return {ARGV[1], 1}
+end
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return {owner, 0}
+"""
+
+# Releases client ARGV[2] if ARGV[1] still owns it (KEYS: its assignment, the owner's set);
+# returns 0 when the owner changed since the caller read it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+# KEYS[1] is the engineer's set, KEYS[i] the assignment of client ARGV[i] (i > 1).
+# Releases the listed clients the engineer ARGV[1] still owns; returns their names
+RELEASE_ENGINEER_SCRIPT = """
+local released = {}
+for i = 2, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[1] then
+        redis.call('DEL', KEYS[i])
+        table.insert(released, ARGV[i])
+    end
+    redis.call('SREM', KEYS[1], ARGV[i])
+end
+return released
+"""
+
+# KEYS as above, client ARGV[i + 1] for KEYS[i]. Extends the TTL (ARGV[2]) of every
+# listed client the engineer ARGV[1] still owns and prunes the rest
+HEARTBEAT_SCRIPT = """
+for i = 2, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[1] then
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+    else
+        redis.call('SREM', KEYS[1], ARGV[i + 1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class RedisAssignmentRegistry:
+    def __init__(self, url=None, ttl=ASSIGNMENT_TTL):
+        self.url = url or settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
+        self.ttl = ttl
+        # redis.asyncio connections belong to the loop that opened them
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _redis(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            import redis.asyncio
+            client = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+            self._clients[loop] = client
+        return client
+
+    async def claim(self, client, engineer):
+        """Assign `client` to `engineer` unless someone else holds it. Returns (owner, created)."""
+        owner, created = await self._redis().eval(
+            CLAIM_SCRIPT, 2, assignment_key(client), engineer_clients_key(engineer), engineer, self.ttl, client
+        )
+        return owner, bool(created)
+
+    async def owner(self, client):
+        return await self._redis().get(assignment_key(client))
+
+    async def owners(self, clients):
+        clients = list(clients)
+        if not clients:
+            return {}
+        values = await self._redis().mget([assignment_key(client) for client in clients])
+        return {client: owner for client, owner in zip(clients, values) if owner}
+
+    async def release(self, client):
+        """Drop the client's assignment whoever holds it. Returns the previous owner or None."""
+        redis = self._redis()
+        while True:
+            owner = await redis.get(assignment_key(client))
+            if owner is None:
+                return None
+            if await redis.eval(RELEASE_SCRIPT, 2, assignment_key(client), engineer_clients_key(owner), owner, client):
+                return owner
+
+    async def _engineer_script(self, script, engineer, *args):
+        # The script only sees the clients listed here; ones claimed after the SMEMBERS
+        # stay in the set and are handled by the next call or expire with their own TTL
+        redis = self._redis()
+        clients = list(await redis.smembers(engineer_clients_key(engineer)))
+        keys = [engineer_clients_key(engineer)] + [assignment_key(client) for client in clients]
+        return await redis.eval(script, len(keys), *keys, engineer, *args, *clients)
+
+    async def release_engineer(self, engineer):
+        """Drop every assignment the engineer holds. Returns the released clients."""
+        return await self._engineer_script(RELEASE_ENGINEER_SCRIPT, engineer)
+
+    async def heartbeat(self, engineer):
+        await self._engineer_script(HEARTBEAT_SCRIPT, engineer, self.ttl)
+
+
+class InMemoryAssignmentRegistry:
+    """Process-local registry with the same semantics, for tests and runserver."""
+
+    def __init__(self, ttl=ASSIGNMENT_TTL):
+        self.ttl = ttl
+        self._assignments = {}  # client -> (engineer, expires_at)
+
+    def _live(self, client):
+        entry = self._assignments.get(client)
+        if entry and entry[1] <= time.monotonic():
+            del self._assignments[client]
+            return None
+        return entry[0] if entry else None
+
+    async def claim(self, client, engineer):
+        owner = self._live(client)
+        if owner is None or owner == engineer:
+            self._assignments[client] = (engineer, time.monotonic() + self.ttl)
+            return engineer, owner is None
+        return owner, False
+
+    async def owner(self, client):
+        return self._live(client)
+
+    async def owners(self, clients):
+        return {client: owner for client in clients if (owner := self._live(client))}
+
+    async def release(self, client):
+        owner = self._live(client)
+        self._assignments.pop(client, None)
+        return owner
+
+    async def release_engineer(self, engineer):
+        released = [client for client in list(self._assignments) if self._live(client) == engineer]
+        for client in released:
+            del self._assignments[client]
+        return released
+
+    async def heartbeat(self, engineer):
+        expires_at = time.monotonic() + self.ttl
+        for client in list(self._assignments):
+            if self._live(client) == engineer:
+                self._assignments[client] = (engineer, expires_at)
+
+
+_registry = None
+
+
+def get_assignment_registry():
+    global _registry
+    if _registry is None:
+        config = settings.CHAT_ASSIGNMENT_REGISTRY
+        _registry = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _registry
+
+
+@receiver(setting_changed)
+def _reset_assignment_registry(setting, **kwargs):
+    # Tests swap backends with override_settings
+    global _registry
+    if setting == 'CHAT_ASSIGNMENT_REGISTRY':
+        _registry = None
@@ -1,14 +1,104 @@
+"""
+Chat websocket protocol (ws/chat/<username>/?token=<jwt>).
+
+Server -> client frames:
+
+    {message, sender, sender_type, client, is_read, timestamp, message_id, file_url, file_name}
+        One chat or system message.
+    {type: 'chat.batch', messages: [<message frame>, ...]}
+        Several message frames at once, in order; handle each element exactly
+        like a standalone message frame. Used for the engineer offline backlog.
+        A batch carries at most BATCH_MAX_MESSAGES
+        messages and roughly BATCH_MAX_BYTES of JSON; larger sets arrive as
+        consecutive batches.
+    {type: 'read_confirmation', client, sender_type, read_up_to}
+        Every message in room `client` written by `sender_type` with
+        message_id <= read_up_to has been read.
+    {type: 'conversations_page', rooms: [{client, unread_count}], next_before}
+        Ends one page of the engineer offline backlog.
+    {type: 'media_stored', client, message_id, file_name, file_url, status}
+        The file of message_id finished uploading to storage in the background
+        (status 'stored') or gave up ('failed', file_url null). Until then its
+        message frames carry file_name with a null file_url.
+    {type: 'media_stored', instrument_id, image_url, status}
+        Sent to the uploader when an instrument image upload finishes.
+
+Client -> server frames:
+
+    {message, sender_type, receiver?}                 send a message
+    {message, sender_type, receiver?, message_id}     announce a file message
+        message_id is the one returned by /api/chat/upload/ (or an upload's
+        complete/ call); `message` becomes its caption. Each uploaded file can
+        be announced once.
+    {message_type: 'mark_read', sender_type, room_name}
+    {message_type: 'load_conversations', before}      next backlog page (engineers)
+"""
+import asyncio
 import json
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
-from .models import ChatMessage
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils.dateparse import parse_datetime
+from .models import ChatMessage, Conversation
+from .assignments import get_assignment_registry
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
-client_engineer_map = {}  # {client_username: engineer_username}
+# Engineer connect replays unread client messages a page of rooms at a time
+OFFLINE_ROOMS_PAGE_SIZE = 20
+OFFLINE_MESSAGES_PER_ROOM = 20
+
+# Limits for one chat.batch event; each chunk is one channel-layer publish and one websocket frame
+BATCH_MAX_MESSAGES = 100
+BATCH_MAX_BYTES = 256 * 1024
+
+
+def message_frame(msg, **overrides):
+    """Websocket message frame from a ChatMessage.FRAME_FIELDS values() row."""
+    frame = {
+        'message': msg['content'],
+        'sender': msg['sender__username'],
+        'sender_type': msg['sender_type'],
+        'client': msg['room_name'],
+        'is_read': msg.get('is_read', False),
+        'timestamp': msg['timestamp'].isoformat() if msg['timestamp'] else None,
+        'message_id': str(msg['id']),
+        'file_url': msg['file_url'] or None,
+        # Set before file_url while a new file is still being stored
+        'file_name': msg['file_name'] or None,
+    }
+    frame.update(overrides)
+    return frame
+
+
+def chunk_message_frames(frames):
+    """Split message frames into lists that fit one chat.batch event."""
+    chunk, size = [], 0
+    for frame in frames:
+        frame_size = len(json.dumps(frame))
+        if chunk and (len(chunk) >= BATCH_MAX_MESSAGES or size + frame_size > BATCH_MAX_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(frame)
+        size += frame_size
+    if chunk:
+        yield chunk
+
+
+def conversation_cursor(conversation):
+    return f"{conversation['last_message_at'].isoformat()}|{conversation['id']}"
+
+
+def parse_conversation_cursor(cursor):
+    try:
+        last_message_at, conversation_id = cursor.rsplit('|', 1)
+        return parse_datetime(last_message_at), int(conversation_id)
+    except (AttributeError, TypeError, ValueError):
+        return None
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -26,6 +116,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         try:
             if getattr(self.user, 'role', None) == 'proposal_engineer':
                 await self.channel_layer.group_add('engineers', self.channel_name)
+                # Keeps this engineer's client assignments alive in the shared registry
+                self.heartbeat_task = asyncio.create_task(self._heartbeat())
                 await self._send_offline_messages()
             else:
                 await self._mark_messages_read(self.username)
@@ -42,42 +134,41 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.channel_layer.group_discard(self.personal_group, self.channel_name)
 
         try:
+            registry = get_assignment_registry()
             if getattr(self.user, 'role', None) == 'proposal_engineer':
                 await self.channel_layer.group_discard('engineers', self.channel_name)
-                if self.username in client_engineer_map.values():
-                    for client, engineer in list(client_engineer_map.items()):
-                        if engineer == self.username:
-                            del client_engineer_map[client]
-                            await self.channel_layer.group_send(
-                                f'chat_{client}',
-                                {
-                                    'type': 'chat.message',
-                                    'message': 'Agent disconnected. Send a message to reconnect.',
-                                    'sender': 'system',
-                                    'sender_type': 'system',
-                                    'client': client,
-                                    'is_read': True,
-                                    'timestamp': None,
-                                    'message_id': None,
-                                }
-                            )
-                            await self.channel_layer.group_send(
-                                'engineers',
-                                {
-                                    'type': 'chat.message',
-                                    'message': f'{client} is available.',
-                                    'sender': 'system',
-                                    'sender_type': 'system',
-                                    'client': client,
-                                    'is_read': True,
-                                    'timestamp': None,
-                                    'message_id': None,
-                                }
-                            )
+                if hasattr(self, 'heartbeat_task'):
+                    self.heartbeat_task.cancel()
+                for client in await registry.release_engineer(self.username):
+                    await self.channel_layer.group_send(
+                        f'chat_{client}',
+                        {
+                            'type': 'chat.message',
+                            'message': 'Agent disconnected. Send a message to reconnect.',
+                            'sender': 'system',
+                            'sender_type': 'system',
+                            'client': client,
+                            'is_read': True,
+                            'timestamp': None,
+                            'message_id': None,
+                        }
+                    )
+                    await self.channel_layer.group_send(
+                        'engineers',
+                        {
+                            'type': 'chat.message',
+                            'message': f'{client} is available.',
+                            'sender': 'system',
+                            'sender_type': 'system',
+                            'client': client,
+                            'is_read': True,
+                            'timestamp': None,
+                            'message_id': None,
+                        }
+                    )
             else:
-                if self.username in client_engineer_map:
-                    engineer = client_engineer_map[self.username]
-                    del client_engineer_map[self.username]
+                engineer = await registry.release(self.username)
+                if engineer:
                     await self.channel_layer.group_send(
                         f'chat_{self.username}',
                         {
@@ -129,7 +220,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         message_type = data.get('message_type', 'message')
         message = data.get('message', '').strip()
-        file_name = data.get('file_name')
+        file_message_id = data.get('message_id')
         sender_type = data.get('sender_type')
         receiver = data.get('receiver', '').strip()
         room_name = data.get('room_name', '')
@@ -145,6 +236,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     await self.send(text_data=json.dumps({'error': 'Failed to mark messages as read'}))
             return
 
+        if message_type == 'load_conversations':
+            if getattr(self.user, 'role', None) == 'proposal_engineer':
+                await self._send_offline_messages(before=data.get('before'))
+            return
+
         if not (sender.is_authenticated and sender_type in ('client', 'agent')):
             await self.send(text_data=json.dumps({'error': 'Invalid sender or authentication'}))
             return
@@ -153,18 +249,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if sender_type == 'client':
                 await self._mark_messages_read(sender.username)
                 msg = None
-                if file_name:
-                    if not file_name.lower().endswith('.pdf'):
-                        await self.send(text_data=json.dumps({'error': 'Only PDF files are allowed'}))
+                if file_message_id:
+                    msg = await self._save_file_message(sender.username, sender, 'client', message, file_message_id)
+                    if msg is None:
+                        await self.send(text_data=json.dumps({'error': 'Unknown or already sent file'}))
                         return
-                    msg = await self._save_file_message(
-                        sender.username, sender, 'client', message, file_name, assistance=None
-                    )
                 elif message:
                     msg = await self._save_message(sender.username, sender, 'client', message, assistance=None)
                 if msg:
-                    file_url = msg.file.url if msg.file else None
-                    file_name = msg.file_name if msg.file else None
+                    file_url = msg.file_url or None
+                    file_name = msg.file_name or None
                     await self.channel_layer.group_send(
                         f'chat_{sender.username}',
                         {
@@ -180,8 +274,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                             'file_name': file_name,
                         }
                     )
-                    if sender.username in client_engineer_map:
-                        engineer = client_engineer_map[sender.username]
+                    engineer = await get_assignment_registry().owner(sender.username)
+                    if engineer:
                         await self.channel_layer.group_send(
                             f'chat_{engineer}',
                             {
@@ -218,7 +312,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 if not receiver:
                     await self.send(text_data=json.dumps({'error': 'Receiver required for agent message'}))
                     return
-                if receiver in client_engineer_map and client_engineer_map[receiver] != sender.username:
+                # One atomic round trip: take the client if free, refresh it if already ours
+                owner, claimed = await get_assignment_registry().claim(receiver, sender.username)
+                if owner != sender.username:
                     await self.send(text_data=json.dumps({
                         'type': 'chat.message',
                         'message': f'{receiver} is with another engineer.',
@@ -231,8 +327,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     }))
                     return
 
-                if receiver not in client_engineer_map:
-                    client_engineer_map[receiver] = sender.username
+                if claimed:
                     await self._update_conversation_assistance(receiver, sender)
                     await self.channel_layer.group_send(
                         f'chat_{receiver}',
@@ -265,19 +360,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     )
 
                 msg = None
-                if file_name:
-                    if not file_name.lower().endswith('.pdf'):
-                        await self.send(text_data=json.dumps({'error': 'Only PDF files allowed'}))
+                if file_message_id:
+                    msg = await self._save_file_message(receiver, sender, 'agent', message, file_message_id)
+                    if msg is None:
+                        await self.send(text_data=json.dumps({'error': 'Unknown or already sent file'}))
                         return
-                    msg = await self._save_file_message(
-                        receiver, sender, 'agent', message, file_name, sender
-                    )
                 elif message:
                     msg = await self._save_message(receiver, sender, 'agent', message, sender)
                 if msg:
-                    file_url = msg.file.url if msg.file else None
-                    file_name = msg.file_name if msg.file else None
-                    await self._update_conversation_assistance(receiver, sender)
+                    file_url = msg.file_url or None
+                    file_name = msg.file_name or None
                     await self.channel_layer.group_send(
                         f'chat_{receiver}',
                         {
@@ -328,73 +420,133 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Error sending chat message to {self.username}: {str(e)}")
 
+    async def chat_batch(self, event):
+        try:
+            await self.send(text_data=json.dumps({
+                'type': 'chat.batch',
+                'messages': event['messages'],
+            }))
+        except Exception as e:
+            logger.error(f"Error sending chat batch to {self.username}: {str(e)}")
+
+    async def send_batched(self, group, frames):
+        for chunk in chunk_message_frames(frames):
+            await self.channel_layer.group_send(group, {'type': 'chat.batch', 'messages': chunk})
+
+    async def conversations_page(self, event):
+        try:
+            await self.send(text_data=json.dumps({
+                'type': 'conversations_page',
+                'rooms': event['rooms'],
+                'next_before': event['next_before'],
+            }))
+        except Exception as e:
+            logger.error(f"Error sending conversations page to {self.username}: {str(e)}")
+
     async def read_confirmation(self, event):
         try:
             await self.send(text_data=json.dumps({
                 'type': 'read_confirmation',
-                'message_ids': event['message_ids'],
                 'client': event['client'],
+                'sender_type': event['sender_type'],
+                'read_up_to': event['read_up_to'],
             }))
         except Exception as e:
             logger.error(f"Error sending read confirmation to {self.username}: {str(e)}")
 
+    async def media_stored(self, event):
+        try:
+            frame = {key: value for key, value in event.items() if key != 'type'}
+            await self.send(text_data=json.dumps({'type': 'media_stored', **frame}))
+        except Exception as e:
+            logger.error(f"Error sending media_stored to {self.username}: {str(e)}")
+
+    async def _heartbeat(self):
+        registry = get_assignment_registry()
+        while True:
+            await asyncio.sleep(registry.ttl / 3)
+            try:
+                await registry.heartbeat(self.username)
+            except Exception as e:
+                logger.error(f"Assignment heartbeat failed for {self.username}: {str(e)}")
+
     @database_sync_to_async
     def _save_message(self, room_name, user, sender_type, content, assistance=None):
-        return ChatMessage.objects.create(
+        return ChatMessage.objects.create_message(
             room_name=room_name,
             sender=user,
             sender_type=sender_type,
             content=content,
-            is_read=False,
             assistance=assistance
         )
 
     @database_sync_to_async
-    def _save_file_message(self, room_name, user, sender_type, content, file_name, assistance=None):
-        # Find the most recent ChatMessage with matching file_name and sender
+    def _save_file_message(self, room_name, user, sender_type, content, message_id):
+        """
+        Hand off the message the upload view created. The conditional update is a
+        primary-key lookup that only matches while the file is still pending, so a
+        replayed or forged announcement (wrong room, sender or id) matches nothing
+        and returns None.
+        """
         try:
-            msg = ChatMessage.objects.filter(
-                room_name=room_name,
-                sender=user,
-                sender_type=sender_type,
-                file_name=file_name
-            ).latest('timestamp')
-            logger.debug(f"Found existing file message: room={room_name}, file_name={file_name}, file_url={msg.file.url if msg.file else None}")
-            return msg
-        except ChatMessage.DoesNotExist:
-            # Fallback: Create new message (should be rare)
-            msg = ChatMessage.objects.create(
-                room_name=room_name,
-                sender=user,
-                sender_type=sender_type,
-                content=content,
-                file_name=file_name,
-                is_read=False,
-                assistance=assistance
-            )
-            logger.warning(f"No existing file message found, created new: room={room_name}, file_name={file_name}")
-            return msg
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return None
+        claimed = ChatMessage.objects.filter(
+            pk=message_id,
+            room_name=room_name,
+            sender=user,
+            sender_type=sender_type,
+            file_pending=True
+        ).update(file_pending=False, content=content)
+        if not claimed:
+            logger.warning(f"Rejected file announcement: room={room_name}, message_id={message_id}")
+            return None
+        return ChatMessage.objects.only('id', 'timestamp', 'file_url', 'file_name').get(pk=message_id)
 
     @database_sync_to_async
-    def _get_offline_messages(self):
+    def _get_offline_messages(self, before=None):
+        """
+        One page of rooms with unread client messages, newest activity first, read
+        from the Conversation summary index. Returns (rooms, messages, next_before);
+        messages are the latest OFFLINE_MESSAGES_PER_ROOM unread ones per room.
+        """
         try:
-            messages = list(ChatMessage.objects.filter(
-                sender_type='client',
-                room_name__in=[msg.sender.username for msg in ChatMessage.objects.filter(sender_type='client')]
-            ).exclude(
-                room_name__in=client_engineer_map.keys()
-            ).values('id', 'room_name', 'sender__username', 'sender_type', 'content', 'is_read', 'timestamp', 'file', 'file_name'))
-            for msg in messages:
-                msg['file_url'] = msg['file'].url if msg['file'] else None
-            return messages
+            conversations = Conversation.objects.filter(engineer_unread_count__gt=0)
+            cursor = parse_conversation_cursor(before) if before else None
+            if cursor:
+                last_message_at, conversation_id = cursor
+                conversations = conversations.filter(
+                    Q(last_message_at__lt=last_message_at) |
+                    Q(last_message_at=last_message_at, id__lt=conversation_id)
+                )
+            page = list(
+                conversations.order_by('-last_message_at', '-id')
+                .values('id', 'room_name', 'last_message_at', 'engineer_unread_count', 'engineer_read_up_to')
+                [:OFFLINE_ROOMS_PAGE_SIZE + 1]
+            )
+            next_before = conversation_cursor(page[OFFLINE_ROOMS_PAGE_SIZE - 1]) if len(page) > OFFLINE_ROOMS_PAGE_SIZE else None
+            page = page[:OFFLINE_ROOMS_PAGE_SIZE]
+
+            unread = Q(pk__in=[])
+            for conversation in page:
+                unread |= Q(room_name=conversation['room_name'], id__gt=conversation['engineer_read_up_to'])
+            messages = list(
+                ChatMessage.objects.filter(unread, sender_type='client').annotate(
+                    room_position=Window(RowNumber(), partition_by=F('room_name'), order_by=F('timestamp').desc())
+                ).filter(
+                    room_position__lte=OFFLINE_MESSAGES_PER_ROOM
+                ).order_by('timestamp').values(*ChatMessage.FRAME_FIELDS)
+            )
+            return page, messages, next_before
         except Exception as e:
             logger.error(f"Error fetching offline messages: {str(e)}")
-            return []
+            return [], [], None
 
     @database_sync_to_async
     def _update_conversation_assistance(self, room_name, engineer):
         try:
-            ChatMessage.objects.filter(room_name=room_name).update(assistance=engineer)
+            Conversation.objects.assign(room_name, engineer)
         except Exception as e:
             logger.error(f"Error updating assistance for {room_name}: {str(e)}")
 
@@ -403,97 +555,56 @@ class ChatConsumer(AsyncWebsocketConsumer):
         try:
             logger.debug(f"Marking read for {room_name}")
             reader_type = 'client' if room_name == self.username else 'agent'
-            messages_to_update = ChatMessage.objects.filter(
-                room_name=room_name,
-                is_read=False,
-                sender_type='agent' if reader_type == 'client' else 'client'
-            )
-            message_ids = list(messages_to_update.values_list('id', flat=True))
-            messages_to_update.update(is_read=True)
-
-            if message_ids:
-                updated_messages = list(ChatMessage.objects.filter(id__in=message_ids).values(
-                    'id', 'room_name', 'sender__username', 'sender_type', 'content', 'is_read', 'timestamp', 'file', 'file_name'
-                ))
-                return message_ids, room_name, updated_messages
-            return [], room_name, []
+            return Conversation.objects.record_read(room_name, reader_type), reader_type
         except Exception as e:
             logger.error(f"Error marking messages read for {room_name}: {str(e)}")
-            return [], room_name, []
+            return None, None
 
     async def _mark_messages_read(self, room_name):
-        message_ids, room_name, updated_messages = await self._mark_messages_read_sync(room_name)
-        if message_ids:
-            await self._send_read_notifications(message_ids, room_name, updated_messages)
+        read_up_to, reader_type = await self._mark_messages_read_sync(room_name)
+        if read_up_to:
+            await self._send_read_notifications(read_up_to, room_name, reader_type)
 
-    async def _send_read_notifications(self, message_ids, room_name, updated_messages):
+    async def _send_read_notifications(self, read_up_to, room_name, reader_type):
+        # The client listens on chat_<room>, but an engineer only joins that group by
+        # replying on the current connection, so a client's read goes to the assigned
+        # engineer's personal group, or to every engineer while nobody is assigned
         try:
-            senders = {msg['sender__username'] for msg in updated_messages}
-            for sender in senders:
-                sender_message_ids = [str(msg['id']) for msg in updated_messages if msg['sender__username'] == sender]
-                await self.channel_layer.group_send(
-                    f'chat_{sender}',
-                    {
-                        'type': 'read_confirmation',
-                        'message_ids': sender_message_ids,
-                        'client': room_name,
-                    }
-                )
-            for msg in updated_messages:
-                file_url = msg['file'].url if msg['file'] else None
-                file_name = msg['file_name'] if msg['file'] else None
-                await self.channel_layer.group_send(
-                    f'chat_{msg["room_name"]}',
-                    {
-                        'type': 'chat.message',
-                        'message': msg['content'],
-                        'sender': msg['sender__username'],
-                        'sender_type': msg['sender_type'],
-                        'client': msg['room_name'],
-                        'is_read': True,
-                        'timestamp': msg['timestamp'].isoformat(),
-                        'message_id': str(msg['id']),
-                        'file_url': file_url,
-                        'file_name': file_name,
-                    }
-                )
+            if reader_type == 'client':
+                owner = await get_assignment_registry().owner(room_name)
+                group = f'chat_{owner}' if owner else 'engineers'
+            else:
+                group = f'chat_{room_name}'
+            await self.channel_layer.group_send(
+                group,
+                {
+                    'type': 'read_confirmation',
+                    'client': room_name,
+                    'sender_type': 'agent' if reader_type == 'client' else 'client',
+                    'read_up_to': str(read_up_to),
+                }
+            )
         except Exception as e:
             logger.error(f"Error sending read notifications for {room_name}: {str(e)}")
 
-    async def _send_offline_messages(self):
+    async def _send_offline_messages(self, before=None):
         try:
-            messages = await self._get_offline_messages()
-            for msg in messages:
-                await self.channel_layer.group_send(
-                    self.personal_group,
-                    {
-                        'type': 'chat.message',
-                        'message': msg['content'],
-                        'sender': msg['sender__username'],
-                        'sender_type': msg['sender_type'],
-                        'client': msg['room_name'],
-                        'is_read': msg['is_read'],
-                        'timestamp': msg['timestamp'].isoformat() if msg['timestamp'] else None,
-                        'message_id': str(msg['id']),
-                        'file_url': msg['file_url'],
-                        'file_name': msg['file_name'],
-                    }
-                )
-                if msg['room_name'] not in client_engineer_map:
-                    await self.channel_layer.group_send(
-                        'engineers',
-                        {
-                            'type': 'chat.message',
-                            'message': msg['content'],
-                            'sender': msg['sender__username'],
-                            'sender_type': msg['sender_type'],
-                            'client': msg['room_name'],
-                            'is_read': msg['is_read'],
-                            'timestamp': msg['timestamp'].isoformat() if msg['timestamp'] else None,
-                            'message_id': str(msg['id']),
-                            'file_url': msg['file_url'],
-                            'file_name': msg['file_name'],
-                        }
-                    )
+            rooms, messages, next_before = await self._get_offline_messages(before)
+            assigned = await get_assignment_registry().owners({room['room_name'] for room in rooms})
+            messages = [msg for msg in messages if msg['room_name'] not in assigned]
+            frames = [message_frame(msg) for msg in messages]
+            await self.send_batched(self.personal_group, frames)
+            await self.send_batched('engineers', frames)
+            await self.channel_layer.group_send(
+                self.personal_group,
+                {
+                    'type': 'conversations.page',
+                    'rooms': [
+                        {'client': room['room_name'], 'unread_count': room['engineer_unread_count']}
+                        for room in rooms if room['room_name'] not in assigned
+                    ],
+                    'next_before': next_before,
+                }
+            )
         except Exception as e:
             logger.error(f"Error sending offline messages to {self.username}: {str(e)}")
\ No newline at end of file
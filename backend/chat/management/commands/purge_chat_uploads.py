@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.uploads import UPLOAD_TTL, purge_stale_uploads
+
+
+class Command(BaseCommand):
+    help = f"Delete resumable chat uploads left unfinished for more than {UPLOAD_TTL} and their staged chunks."
+
+    def handle(self, *args, **options):
+        removed = purge_stale_uploads()
+        self.stdout.write(f"Purged {removed} stale chat upload(s).")
@@ -0,0 +1,83 @@
+"""
+JWT authentication for chat websockets (ws/chat/<username>/?token=<access token>).
+
+Resolved users are cached for USER_CACHE_TTL seconds under the user id and the
+token's jti, so a reconnect storm after a deploy costs cache reads instead of
+one users query (and one session query) per socket. Saving or deleting a user
+stamps an invalidation marker (see chat.signals) that is fetched in the same
+cache round trip as the entry, so a deactivated user cannot reconnect from a
+stale entry.
+"""
+import time
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+USER_CACHE_TTL = 60
+
+
+def cached_user_key(user_id, jti):
+    return f"ws-user:{user_id}:{jti}"
+
+
+def user_invalidated_key(user_id):
+    return f"ws-user-invalidated:{user_id}"
+
+
+def invalidate_cached_user(user_id):
+    # Entries cached before this moment are ignored; the marker only has to outlive them
+    cache.set(user_invalidated_key(user_id), time.time(), USER_CACHE_TTL)
+
+
+@database_sync_to_async
+def _load_user(user_id):
+    return get_user_model().objects.filter(id=user_id, is_active=True).first()
+
+
+async def get_user_from_token(token):
+    try:
+        validated_token = AccessToken(token)
+        user_id = validated_token['user_id']
+        jti = validated_token['jti']
+    except (TokenError, KeyError):
+        return AnonymousUser()
+
+    key = cached_user_key(user_id, jti)
+    cached = await cache.aget_many([key, user_invalidated_key(user_id)])
+    entry, invalidated_at = cached.get(key), cached.get(user_invalidated_key(user_id))
+    if entry and (invalidated_at is None or entry['cached_at'] > invalidated_at):
+        return entry['user']
+
+    # Stamped before the query so a save racing with it still invalidates this entry
+    cached_at = time.time()
+    user = await _load_user(user_id)
+    if user is None:
+        return AnonymousUser()
+    timeout = min(USER_CACHE_TTL, max(int(validated_token['exp'] - cached_at), 1))
+    await cache.aset(key, {'user': user, 'cached_at': cached_at}, timeout)
+    return user
+
+
+class TokenAuthMiddleware:
+    """
+    Authenticates with ?token= when present. Only token-less connections go
+    through the session/cookie stack, so JWT sockets skip the session lookup.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_inner = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        token = params.get('token', [None])[0]
+        if token:
+            scope = dict(scope, user=await get_user_from_token(token))
+            return await self.inner(scope, receive, send)
+        return await self.session_inner(scope, receive, send)
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.7 on 2026-10-17 18:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_conversations(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+    conversations = {}
+    for message in ChatMessage.objects.order_by('timestamp', 'id').iterator():
+        conversation = conversations.setdefault(message.room_name, Conversation(room_name=message.room_name))
+        conversation.last_message_id = message.id
+        conversation.last_message_at = message.timestamp
+        if message.assistance_id:
+            conversation.assistance_id = message.assistance_id
+        if message.sender_type == 'client' and not message.is_read:
+            conversation.unread_count += 1
+    Conversation.objects.bulk_create(conversations.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_alter_chatmessage_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=150, unique=True)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('assistance', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='assisted_conversations', to=settings.AUTH_USER_MODEL)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmessage')),
+            ],
+            options={
+                'ordering': ['-last_message_at'],
+                'indexes': [models.Index(condition=models.Q(('unread_count__gt', 0)), fields=['-last_message_at'], name='chat_conversation_active_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
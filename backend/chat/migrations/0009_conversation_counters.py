@@ -0,0 +1,53 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_client_unread(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+    unread = (
+        ChatMessage.objects.filter(sender_type='agent', is_read=False)
+        .values('room_name').annotate(count=models.Count('id'))
+    )
+    for row in unread.iterator():
+        Conversation.objects.filter(room_name=row['room_name']).update(client_unread_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_conversation'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='conversation',
+            name='chat_conversation_active_idx',
+        ),
+        migrations.RenameField(
+            model_name='conversation',
+            old_name='unread_count',
+            new_name='engineer_unread_count',
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='client_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('engineer_unread_count__gt', 0)), fields=['-last_message_at'], name='chat_conversation_active_idx'),
+        ),
+        migrations.RunPython(backfill_client_unread, migrations.RunPython.noop),
+    ]
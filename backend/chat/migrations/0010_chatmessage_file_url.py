@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-17 18:23
+
+from django.db import migrations, models
+
+
+def backfill_file_urls(apps, schema_editor):
+    # One-off: resolve URLs of files stored before the column existed
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    storage = ChatMessage._meta.get_field('file').storage
+    batch = []
+    for message in ChatMessage.objects.exclude(file='').exclude(file__isnull=True).only('id', 'file').iterator():
+        message.file_url = storage.url(message.file.name)
+        batch.append(message)
+        if len(batch) >= 500:
+            ChatMessage.objects.bulk_update(batch, ['file_url'])
+            batch = []
+    ChatMessage.objects.bulk_update(batch, ['file_url'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_conversation_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='file_url',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room_name', 'id'], name='chat_message_room_id_idx'),
+        ),
+        migrations.RunPython(backfill_file_urls, migrations.RunPython.noop),
+    ]
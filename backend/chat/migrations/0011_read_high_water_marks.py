@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+def backfill_read_marks(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+    read = (
+        ChatMessage.objects.filter(is_read=True, sender_type__in=('client', 'agent'))
+        .values('room_name', 'sender_type').annotate(last_read=models.Max('id'))
+    )
+    for row in read.iterator():
+        mark = 'engineer_read_up_to' if row['sender_type'] == 'client' else 'client_read_up_to'
+        Conversation.objects.filter(room_name=row['room_name']).update(**{mark: row['last_read']})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_chatmessage_file_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='client_read_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='engineer_read_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_marks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 18:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0011_read_high_water_marks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('room_name', models.CharField(max_length=150)),
+                ('sender_type', models.CharField(choices=[('client', 'Client'), ('agent', 'Agent'), ('system', 'System')], max_length=10)),
+                ('file_name', models.CharField(max_length=255)),
+                ('size', models.PositiveIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('open', 'Open'), ('completing', 'Completing'), ('completed', 'Completed')], default='open', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmessage')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
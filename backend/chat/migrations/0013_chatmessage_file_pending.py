@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_chatupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='file_pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
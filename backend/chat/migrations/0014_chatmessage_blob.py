@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-17 18:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0036_stored_blob'),
+        ('chat', '0013_chatmessage_file_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.storedblob'),
+        ),
+    ]
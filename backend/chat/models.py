@@ -1,7 +1,21 @@
-from django.db import models
+import uuid
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
 from django.conf import settings
+from django.utils import timezone
 from cloudinary_storage.storage import RawMediaCloudinaryStorage  # ✅ Add this
 
+
+class ChatMessageManager(models.Manager):
+    def create_message(self, **fields):
+        """Insert a message and fold it into its Conversation in the same transaction."""
+        with transaction.atomic():
+            message = self.create(**fields)
+            Conversation.objects.record_message(message)
+        return message
+
+
 class ChatMessage(models.Model):
     ROOM_NAME_MAX_LENGTH = 150
 
@@ -38,17 +52,180 @@ class ChatMessage(models.Model):
     )
 
     file_name = models.CharField(max_length=255, null=True, blank=True)
+    # Resolved once when the file is stored, so listing messages never calls the storage backend
+    file_url = models.CharField(max_length=500, blank=True, default='')
+    # Set by the upload views until the sender announces the file over the websocket
+    # with its message_id; clearing it is what makes that handoff happen only once
+    file_pending = models.BooleanField(default=False)
+    # The deduplicated object `file` points at; null for files stored before hashing
+    blob = models.ForeignKey('api.StoredBlob', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+
+    objects = ChatMessageManager()
+
+    # values() columns that message frames are built from (see chat.consumers.message_frame).
+    # Read state is not stored per message; see Conversation.is_read().
+    FRAME_FIELDS = (
+        'id', 'room_name', 'sender__username', 'sender_type', 'content', 'timestamp', 'file_url', 'file_name'
+    )
 
     class Meta:
         ordering = ['timestamp']
         indexes = [
             models.Index(fields=['room_name', 'timestamp']),
+            models.Index(fields=['room_name', 'id'], name='chat_message_room_id_idx'),
         ]
 
     def __str__(self):
         if self.file_name:
             return f'{self.sender.username} ({self.sender_type}): File "{self.file_name}"'
         snippet = self.content[:20] + ("…" if len(self.content) > 20 else "")
-        return f'{self.sender.username} ({self.sender_type}): "{snippet}"'
\ No newline at end of file
+        return f'{self.sender.username} ({self.sender_type}): "{snippet}"'
+
+
+class ConversationManager(models.Manager):
+    def record_message(self, message):
+        """
+        Fold a newly saved ChatMessage into its room's summary row. Counters move
+        with F() expressions, so concurrent writers never lose an increment; call
+        this inside the transaction that inserted the message.
+        """
+        engineer_unread = 1 if message.sender_type == 'client' else 0
+        client_unread = 1 if message.sender_type == 'agent' else 0
+        updated = self.filter(room_name=message.room_name).update(
+            last_message=message,
+            last_message_at=message.timestamp,
+            engineer_unread_count=F('engineer_unread_count') + engineer_unread,
+            client_unread_count=F('client_unread_count') + client_unread,
+            updated_at=timezone.now(),
+        )
+        if updated:
+            return
+        try:
+            with transaction.atomic():
+                self.create(
+                    room_name=message.room_name,
+                    last_message=message,
+                    last_message_at=message.timestamp,
+                    engineer_unread_count=engineer_unread,
+                    client_unread_count=client_unread,
+                )
+        except IntegrityError:
+            # Another worker created the row first
+            self.record_message(message)
+
+    def record_read(self, room_name, reader_type):
+        """
+        Mark the room read for `reader_type` ('client' or 'agent'): move that side's
+        high-water mark up to the other side's latest message. The summary row is
+        locked first and the latest id read afterwards, so a message whose
+        record_message() committed before the lock is counted, and one that commits
+        later increments the counter after this write. The mark only ever moves
+        forward. Returns the new mark, or None if nothing was unread.
+        """
+        side = 'client' if reader_type == 'client' else 'engineer'
+        mark, counter = f'{side}_read_up_to', f'{side}_unread_count'
+        with transaction.atomic():
+            current = self.select_for_update().filter(room_name=room_name).values_list(mark, flat=True).first()
+            if current is None:
+                return None
+            read_up_to = ChatMessage.objects.filter(
+                room_name=room_name, sender_type='agent' if reader_type == 'client' else 'client'
+            ).order_by('-id').values_list('id', flat=True).first()
+            if read_up_to is None or read_up_to <= current:
+                return None
+            # Nothing newer than read_up_to is visible while the row is locked
+            self.filter(room_name=room_name).update(**{mark: read_up_to, counter: 0}, updated_at=timezone.now())
+        return read_up_to
+
+    def assign(self, room_name, engineer):
+        """Record the engineer now assisting the room; one row, however long the history."""
+        updated = self.filter(room_name=room_name).update(assistance=engineer, updated_at=timezone.now())
+        if not updated:
+            self.get_or_create(room_name=room_name, defaults={'assistance': engineer})
+
+
+# Per-room summary, kept current on every message write so nothing has to scan ChatMessage for room state
+class Conversation(models.Model):
+    room_name = models.CharField(max_length=ChatMessage.ROOM_NAME_MAX_LENGTH, unique=True)
+    assistance = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='assisted_conversations'
+    )
+    last_message = models.ForeignKey(
+        ChatMessage,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    engineer_unread_count = models.PositiveIntegerField(default=0)  # client messages no engineer has read yet
+    client_unread_count = models.PositiveIntegerField(default=0)  # engineer messages the client has not read yet
+    # Read receipts as high-water marks: every message of the other side with id <= mark has been read
+    engineer_read_up_to = models.PositiveBigIntegerField(default=0)  # client messages read by engineers
+    client_read_up_to = models.PositiveBigIntegerField(default=0)  # engineer messages read by the client
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ConversationManager()
+
+    class Meta:
+        ordering = ['-last_message_at']
+        indexes = [
+            models.Index(
+                fields=['-last_message_at'],
+                name='chat_conversation_active_idx',
+                condition=Q(engineer_unread_count__gt=0),
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.room_name} ({self.engineer_unread_count} unread)'
+
+    def is_read(self, message_id, sender_type):
+        mark = self.engineer_read_up_to if sender_type == 'client' else self.client_read_up_to
+        return sender_type == 'system' or int(message_id) <= mark
+
+
+# A resumable upload in progress: chunks are staged on disk (chat.uploads) and the ChatMessage is created on completion
+class ChatUpload(models.Model):
+    STATUS_CHOICES = (
+        ('open', 'Open'),
+        ('completing', 'Completing'),
+        ('completed', 'Completed'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='chat_uploads'
+    )
+    room_name = models.CharField(max_length=ChatMessage.ROOM_NAME_MAX_LENGTH)
+    sender_type = models.CharField(max_length=10, choices=ChatMessage.SENDER_CHOICES)
+    file_name = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='open')
+    message = models.ForeignKey(
+        ChatMessage,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def total_chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def __str__(self):
+        return f'{self.file_name} ({self.status}) by {self.user}'
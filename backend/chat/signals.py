@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.media import announce_media, media_upload_finished
+
+from .middleware import invalidate_cached_user
+from .models import ChatMessage
+
+
+# Websocket auth caches resolved users (chat.middleware); any change to a user drops those entries
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, **kwargs):
+    invalidate_cached_user(instance.pk)
+
+
+# File messages are acknowledged before their file is stored (api.media); once the
+# worker is done the message gets its URL and both sides of the room are told
+
+@receiver(media_upload_finished, sender=ChatMessage)
+def chat_file_stored(sender, job, blob, **kwargs):
+    message = ChatMessage.objects.filter(pk=job.object_id).only('id', 'room_name', 'file_name').first()
+    if message is None:
+        return
+    if blob is not None:
+        ChatMessage.objects.filter(pk=message.pk).update(file=blob.name, file_url=blob.url, blob=blob)
+    transaction.on_commit(lambda: announce_media(
+        f"chat_{message.room_name}",
+        client=message.room_name,
+        message_id=str(message.pk),
+        file_name=message.file_name,
+        file_url=blob.url if blob is not None else None,
+        status='stored' if blob is not None else 'failed',
+    ))
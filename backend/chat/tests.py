@@ -1,3 +1,675 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer
+from redis.crc import key_slot
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.media import run_pending_media_uploads
+from api.models import MediaUploadJob
+from users.models import CustomUser
+from . import assignments, consumers, uploads
+from .middleware import TokenAuthMiddleware, get_user_from_token
+from .assignments import InMemoryAssignmentRegistry, get_assignment_registry
+from .consumers import ChatConsumer
+from .models import ChatMessage, ChatUpload, Conversation
+
+IN_MEMORY_CHAT = {
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'CHAT_ASSIGNMENT_REGISTRY': {'BACKEND': 'chat.assignments.InMemoryAssignmentRegistry'},
+}
+
+PDF_BYTES = b'%PDF-1.4\n1 0 obj << >> endobj\ntrailer << >>\n%%EOF\n'
+
+
+class TemporaryChatStorageMixin:
+    # ChatMessage.file lives on Cloudinary; tests swap the field's storage for a temp
+    # directory and stage background uploads (api.media) in another one
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.storage_override = patch.object(
+            ChatMessage._meta.get_field('file'), 'storage',
+            FileSystemStorage(location=f'{cls.media_root}/storage', base_url='/media/')
+        )
+        cls.storage_override.start()
+        cls.staging_override = override_settings(MEDIA_UPLOAD_STAGING_DIR=f'{cls.media_root}/staging')
+        cls.staging_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.staging_override.disable()
+        cls.storage_override.stop()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+class AssignmentRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = InMemoryAssignmentRegistry()
+
+    def run_async(self, coroutine):
+        async def run():
+            return await coroutine
+        return async_to_sync(run)()
+
+    def test_claim_is_exclusive(self):
+        self.assertEqual(self.run_async(self.registry.claim('client1', 'eng1')), ('eng1', True))
+        self.assertEqual(self.run_async(self.registry.claim('client1', 'eng1')), ('eng1', False))
+        self.assertEqual(self.run_async(self.registry.claim('client1', 'eng2')), ('eng1', False))
+        self.assertEqual(self.run_async(self.registry.owners(['client1', 'client2'])), {'client1': 'eng1'})
+
+    def test_release(self):
+        self.run_async(self.registry.claim('client1', 'eng1'))
+        self.run_async(self.registry.claim('client2', 'eng1'))
+        self.run_async(self.registry.claim('client3', 'eng2'))
+        self.assertEqual(self.run_async(self.registry.release('client1')), 'eng1')
+        self.assertIsNone(self.run_async(self.registry.release('client1')))
+        self.assertEqual(self.run_async(self.registry.release_engineer('eng1')), ['client2'])
+        self.assertEqual(self.run_async(self.registry.owner('client3')), 'eng2')
+
+    def test_assignments_expire_without_heartbeat(self):
+        registry = InMemoryAssignmentRegistry(ttl=0)
+        self.run_async(registry.claim('client1', 'eng1'))
+        self.assertIsNone(self.run_async(registry.owner('client1')))
+        self.assertEqual(self.run_async(registry.claim('client1', 'eng2')), ('eng2', True))
+
+    def test_batches_respect_count_and_size_caps(self):
+        frames = [{'message': 'x' * 100, 'message_id': str(n)} for n in range(250)]
+        chunks = list(consumers.chunk_message_frames(frames))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 100, 50])
+        self.assertEqual([frame for chunk in chunks for frame in chunk], frames)
+
+        with patch.object(consumers, 'BATCH_MAX_BYTES', 1000):
+            chunks = list(consumers.chunk_message_frames(frames[:20]))
+        self.assertTrue(all(sum(len(json.dumps(frame)) for frame in chunk) <= 1000 for chunk in chunks))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 20)
+
+    def test_redis_scripts_declare_keys_in_one_cluster_slot(self):
+        class RecordingRedis:
+            """Answers like a Redis holding client1 and client2 for eng1; records the keys of every call."""
+            def __init__(self):
+                self.keys, self.scripts = [], []
+
+            async def get(self, key):
+                self.keys.append(key)
+                return 'eng1'
+
+            async def mget(self, keys):
+                self.keys.extend(keys)
+                return ['eng1'] * len(keys)
+
+            async def smembers(self, key):
+                self.keys.append(key)
+                return {'client1', 'client2'}
+
+            async def eval(self, script, numkeys, *args):
+                keys, argv = args[:numkeys], args[numkeys:]
+                self.keys.extend(keys)
+                self.scripts.append(script)
+                return {assignments.CLAIM_SCRIPT: ['eng1', 1], assignments.RELEASE_SCRIPT: 1}.get(script, list(argv[1:]))
+
+        redis = RecordingRedis()
+        registry = assignments.RedisAssignmentRegistry(url='redis://localhost:6379')
+        with patch.object(registry, '_redis', return_value=redis):
+            self.run_async(registry.claim('client1', 'eng1'))
+            self.run_async(registry.owners(['client1', 'client2']))
+            self.assertEqual(self.run_async(registry.release('client1')), 'eng1')
+            self.assertEqual(sorted(self.run_async(registry.release_engineer('eng1'))), ['client1', 'client2'])
+            self.run_async(registry.heartbeat('eng1'))
+        self.assertIn(assignments.assignment_key('client2'), redis.keys)
+        self.assertEqual(len({key_slot(key.encode()) for key in redis.keys}), 1)
+        # Scripts only touch the keys they are given, never build their own
+        self.assertFalse([script for script in redis.scripts if '..' in script])
+
+    @override_settings(**IN_MEMORY_CHAT)
+    def test_backend_follows_settings(self):
+        self.assertIsInstance(get_assignment_registry(), InMemoryAssignmentRegistry)
+        self.assertIs(get_assignment_registry(), get_assignment_registry())
+
+
+class ConversationSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = CustomUser.objects.create_user('client1', 'client1@example.com', 'x')
+        cls.engineer = CustomUser.objects.create_user('eng1', 'eng1@example.com', 'x', role='proposal_engineer')
+
+    def send(self, sender, sender_type, content='Hi'):
+        return ChatMessage.objects.create_message(room_name='client1', sender=sender, sender_type=sender_type, content=content)
+
+    def test_create_message_tracks_last_message_and_unread(self):
+        self.send(self.client_user, 'client')
+        self.send(self.client_user, 'client')
+        last = self.send(self.engineer, 'agent')
+        conversation = Conversation.objects.get(room_name='client1')
+        self.assertEqual(conversation.last_message, last)
+        self.assertEqual(conversation.last_message_at, last.timestamp)
+        self.assertEqual((conversation.engineer_unread_count, conversation.client_unread_count), (2, 1))
+
+    def test_read_high_water_marks(self):
+        first, second = self.send(self.client_user, 'client'), self.send(self.client_user, 'client')
+        reply = self.send(self.engineer, 'agent')
+
+        # Savepoint, locked read of the mark, latest id, UPDATE, release; however many messages
+        with self.assertNumQueries(5):
+            self.assertEqual(Conversation.objects.record_read('client1', 'agent'), second.id)
+        with self.assertNumQueries(4):
+            self.assertIsNone(Conversation.objects.record_read('client1', 'agent'))  # nothing new
+
+        later = self.send(self.client_user, 'client')
+        conversation = Conversation.objects.get(room_name='client1')
+        self.assertEqual((conversation.engineer_read_up_to, conversation.engineer_unread_count), (second.id, 1))
+        self.assertTrue(conversation.is_read(first.id, 'client'))
+        self.assertFalse(conversation.is_read(later.id, 'client'))
+        self.assertFalse(conversation.is_read(reply.id, 'agent'))
+
+        self.assertEqual(Conversation.objects.record_read('client1', 'client'), reply.id)
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.client_read_up_to, conversation.client_unread_count), (reply.id, 0))
+
+    def test_read_counts_messages_committed_before_the_lock(self):
+        self.send(self.client_user, 'client')
+        # A message whose record_message() committed while record_read waited for the row
+        # lock: the latest id is read after the lock, so it is part of what gets marked read
+        late = []
+        locked_read = Conversation.objects.select_for_update
+
+        def lock_then_commit_message():
+            queryset = locked_read()
+            if not late:
+                late.append(self.send(self.client_user, 'client'))
+            return queryset
+
+        with patch.object(Conversation.objects, 'select_for_update', side_effect=lock_then_commit_message):
+            self.assertEqual(Conversation.objects.record_read('client1', 'agent'), late[0].id)
+        conversation = Conversation.objects.get(room_name='client1')
+        self.assertEqual((conversation.engineer_read_up_to, conversation.engineer_unread_count), (late[0].id, 0))
+        self.assertTrue(conversation.is_read(late[0].id, 'client'))
+
+    def test_message_and_summary_share_a_transaction(self):
+        with patch.object(Conversation.objects, 'record_message', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.send(self.client_user, 'client')
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_assignment_touches_one_row(self):
+        for _ in range(5):
+            self.send(self.client_user, 'client')
+        with self.assertNumQueries(1):
+            Conversation.objects.assign('client1', self.engineer)
+        self.assertEqual(Conversation.objects.get(room_name='client1').assistance, self.engineer)
+        self.assertFalse(ChatMessage.objects.filter(assistance=self.engineer).exists())
+
+
+class TokenAuthMiddlewareTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('client1', 'client1@example.com', 'x')
+
+    def setUp(self):
+        cache.clear()
+        self.token = str(AccessToken.for_user(self.user))
+
+    def resolve(self, token):
+        return async_to_sync(get_user_from_token)(token)
+
+    def test_user_is_cached_per_token(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.resolve(self.token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(self.token), self.user)
+        with self.assertNumQueries(1):
+            self.resolve(str(AccessToken.for_user(self.user)))  # new jti, new entry
+
+    def test_deactivation_invalidates_cache(self):
+        self.resolve(self.token)
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.resolve(self.token).is_authenticated)
+
+    def test_invalid_token_is_anonymous(self):
+        with self.assertNumQueries(0):
+            self.assertFalse(self.resolve('not-a-token').is_authenticated)
+
+    def test_malformed_query_string(self):
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        middleware = TokenAuthMiddleware(inner)
+        query = f'token={self.token}&broken&a=b=c&%ZZ'.encode()
+        async_to_sync(middleware)({'type': 'websocket', 'query_string': query}, None, None)
+        self.assertEqual(scopes[0]['user'], self.user)
+        self.assertNotIn('session', scopes[0])
+
+
+class ChatUploadTests(TemporaryChatStorageMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('client1', 'client1@example.com', 'x')
+
+    def upload(self, content, name='spec.pdf'):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.post(reverse('upload_file'), {'file': SimpleUploadedFile(name, content)}, format='multipart')
+
+    def test_pdf_is_streamed_from_a_spooled_file_and_saved_once(self):
+        received = []
+        stage_media = uploads.stage_media
+
+        def spy(field, file):
+            received.append(file)
+            return stage_media(field, file)
+
+        with patch('chat.uploads.stage_media', side_effect=spy), CaptureQueriesContext(connection) as queries:
+            response = self.upload(PDF_BYTES)
+        self.assertEqual((response.status_code, response.data['status']), (202, 'pending'))
+        message_writes = [q['sql'] for q in queries if '"chat_chatmessage"' in q['sql'].split(' (')[0]]
+        self.assertEqual(len(message_writes), 1)
+        self.assertTrue(message_writes[0].startswith('INSERT'))
+        self.assertIsInstance(received[0], TemporaryUploadedFile)
+        self.assertEqual(ChatMessage.objects.get(pk=response.data['message_id']).file_url, '')
+
+        staged_path = MediaUploadJob.objects.get().staged_path
+        self.assertEqual(run_pending_media_uploads(), 1)
+        msg = ChatMessage.objects.get(pk=response.data['message_id'])
+        self.assertTrue(msg.file_url)
+        with msg.file.open('rb') as stored:
+            self.assertEqual(stored.read(), PDF_BYTES)
+        self.assertFalse(os.path.exists(staged_path))
+
+    @override_settings(**IN_MEMORY_CHAT)
+    def test_stored_file_is_announced_to_the_room(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)('chat_client1', channel)
+        response = self.upload(PDF_BYTES)
+        with self.captureOnCommitCallbacks(execute=True):
+            run_pending_media_uploads()
+        event = async_to_sync(layer.receive)(channel)
+        msg = ChatMessage.objects.get(pk=response.data['message_id'])
+        self.assertEqual(event, {
+            'type': 'media.stored', 'client': 'client1', 'message_id': str(msg.id),
+            'file_name': 'spec.pdf', 'file_url': msg.file_url, 'status': 'stored',
+        })
+
+    def test_failed_storage_is_retried_then_reported(self):
+        response = self.upload(PDF_BYTES)
+        storage = ChatMessage._meta.get_field('file').storage
+        with patch.object(storage, 'save', side_effect=OSError('storage unavailable')):
+            self.assertEqual(run_pending_media_uploads(), 1)
+            job = MediaUploadJob.objects.get()
+            self.assertEqual((job.status, job.attempts), ('pending', 1))
+            self.assertEqual(run_pending_media_uploads(), 0)  # backing off
+
+            MediaUploadJob.objects.update(max_attempts=2)
+            run_pending_media_uploads(now=job.run_after)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), ('failed', 'storage unavailable'))
+        self.assertEqual(ChatMessage.objects.get(pk=response.data['message_id']).file_url, '')
+
+    def test_duplicate_content_reuses_the_stored_file(self):
+        storage = ChatMessage._meta.get_field('file').storage
+        with patch.object(storage, 'save', wraps=storage.save) as save:
+            first = self.upload(PDF_BYTES, name='datasheet.pdf')
+            run_pending_media_uploads()
+            second = self.upload(PDF_BYTES, name='copy.pdf')
+        self.assertEqual(save.call_count, 1)
+        # Known content needs no background upload
+        self.assertEqual((second.status_code, second.data['status']), (200, 'stored'))
+        self.assertEqual(ChatMessage.objects.get(pk=first.data['message_id']).file_url, second.data['file_url'])
+        self.assertEqual(second.data['file_name'], 'copy.pdf')
+        blob = ChatMessage.objects.get(pk=second.data['message_id']).blob
+        self.assertEqual(blob.sha256, hashlib.sha256(PDF_BYTES).hexdigest())
+
+    def test_signature_decides_type_not_suffix(self):
+        response = self.upload(b'MZ\x90\x00 not a pdf', name='invoice.pdf')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Only PDF files are allowed')
+
+        response = self.upload(PDF_BYTES, name='scan')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['file_name'], 'scan.pdf')
+
+    def test_oversize_upload_stops_mid_stream(self):
+        with patch.object(uploads, 'MAX_UPLOAD_SIZE', 16):
+            response = self.upload(PDF_BYTES)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'File size exceeds 10MB')
+        self.assertFalse(ChatMessage.objects.exists())
+
+
+class ChunkedUploadTests(TemporaryChatStorageMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('client1', 'client1@example.com', 'x')
+        cls.other = CustomUser.objects.create_user('client2', 'client2@example.com', 'x')
+
+    def setUp(self):
+        staging = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, staging, ignore_errors=True)
+        overrides = override_settings(CHAT_UPLOAD_STAGING_DIR=staging)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        chunk_size = patch('chat.views.CHUNK_SIZE', 16)
+        chunk_size.start()
+        self.addCleanup(chunk_size.stop)
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def start(self, content=PDF_BYTES, name='drawing.pdf'):
+        response = self.api.post(reverse('chunked_upload_start'), {'file_name': name, 'size': len(content)}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data
+
+    def put_chunk(self, upload, index, content=PDF_BYTES):
+        url = reverse('chunked_upload_chunk', kwargs={'upload_id': upload['upload_id'], 'index': index})
+        body = content[index * 16:(index + 1) * 16]
+        return self.api.put(url, data=body, content_type='application/octet-stream')
+
+    def complete(self, upload):
+        return self.api.post(reverse('chunked_upload_complete', kwargs={'upload_id': upload['upload_id']}))
+
+    def test_out_of_order_retried_chunks_resume_and_complete(self):
+        upload = self.start()
+        self.assertEqual(upload['total_chunks'], 4)
+        for index in (2, 0, 2):
+            self.assertEqual(self.put_chunk(upload, index).status_code, 204)
+
+        status_url = reverse('chunked_upload_status', kwargs={'upload_id': upload['upload_id']})
+        self.assertEqual(self.api.get(status_url).data['received'], [0, 2])
+        response = self.complete(upload)
+        self.assertEqual((response.status_code, response.data['missing']), (400, [1, 3]))
+        self.assertFalse(ChatMessage.objects.exists())
+
+        for index in (3, 1):
+            self.assertEqual(self.put_chunk(upload, index).status_code, 204)
+        response = self.complete(upload)
+        self.assertEqual(response.status_code, 202)
+        run_pending_media_uploads()
+        msg = ChatMessage.objects.get(pk=response.data['message_id'])
+        with msg.file.open('rb') as stored:
+            self.assertEqual(stored.read(), PDF_BYTES)
+        self.assertEqual(Conversation.objects.get(room_name='client1').last_message, msg)
+        self.assertEqual(msg.blob.sha256, hashlib.sha256(PDF_BYTES).hexdigest())
+
+        # Completing again (e.g. the response was lost) returns the same message
+        self.assertEqual(self.complete(upload).data['message_id'], response.data['message_id'])
+        self.assertEqual(self.put_chunk(upload, 0).status_code, 409)
+
+    def test_chunks_are_validated(self):
+        upload = self.start(content=b'GIF89a' + b'x' * 40)
+        self.assertEqual(self.put_chunk(upload, 0, content=b'GIF89a' + b'x' * 40).status_code, 400)
+        url = reverse('chunked_upload_chunk', kwargs={'upload_id': upload['upload_id'], 'index': 1})
+        self.assertEqual(self.api.put(url, data=b'short', content_type='application/octet-stream').status_code, 400)
+        url = reverse('chunked_upload_chunk', kwargs={'upload_id': upload['upload_id'], 'index': 9})
+        self.assertEqual(self.api.put(url, data=b'x' * 16, content_type='application/octet-stream').status_code, 400)
+
+        other = APIClient()
+        other.force_authenticate(self.other)
+        self.assertEqual(other.get(reverse('chunked_upload_status', kwargs={'upload_id': upload['upload_id']})).status_code, 404)
+
+        too_big = self.api.post(reverse('chunked_upload_start'), {'file_name': 'a.pdf', 'size': uploads.MAX_UPLOAD_SIZE + 1}, format='json')
+        self.assertEqual(too_big.status_code, 400)
+
+    def test_stale_uploads_are_purged(self):
+        upload = self.start()
+        self.put_chunk(upload, 0)
+        self.assertEqual(uploads.purge_stale_uploads(), 0)
+        self.assertEqual(uploads.purge_stale_uploads(now=timezone.now() + uploads.UPLOAD_TTL * 2), 1)
+        self.assertFalse(ChatUpload.objects.exists())
+
+
+class RoomMessagesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.client_user = CustomUser.objects.create_user('client1', 'client1@example.com', 'x')
+        cls.other_client = CustomUser.objects.create_user('client2', 'client2@example.com', 'x')
+        cls.engineer = CustomUser.objects.create_user('eng1', 'eng1@example.com', 'x', role='proposal_engineer')
+        cls.messages = [
+            ChatMessage.objects.create_message(
+                room_name='client1', sender=cls.client_user, sender_type='client', content=f'm{n}'
+            )
+            for n in range(7)
+        ]
+        ChatMessage.objects.filter(pk=cls.messages[-1].pk).update(
+            file_name='spec.pdf', file='chat_files/spec.pdf', file_url='https://files.example.com/spec.pdf'
+        )
+
+    def get(self, user, **params):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get(reverse('room_messages', kwargs={'room_name': 'client1'}), params)
+
+    def test_pages_backwards_with_keyset_cursor(self):
+        Conversation.objects.filter(room_name='client1').update(engineer_read_up_to=self.messages[4].id)
+        response = self.get(self.engineer, limit=3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([msg['message'] for msg in response.data['results']], ['m4', 'm5', 'm6'])
+        self.assertEqual([msg['is_read'] for msg in response.data['results']], [True, False, False])
+        self.assertEqual(response.data['results'][-1]['file_url'], 'https://files.example.com/spec.pdf')
+
+        seen = [msg['message'] for msg in response.data['results']]
+        while response.data['next_before']:
+            with self.assertNumQueries(2):  # the page and the room's read marks
+                response = self.get(self.engineer, limit=3, before=response.data['next_before'])
+            seen = [msg['message'] for msg in response.data['results']] + seen
+        self.assertEqual(seen, [f'm{n}' for n in range(7)])
+
+    def test_page_never_touches_file_storage(self):
+        with patch.object(ChatMessage._meta.get_field('file').storage, 'url', side_effect=AssertionError):
+            response = self.get(self.client_user)
+        self.assertEqual(len(response.data['results']), 7)
+
+    def test_other_clients_are_forbidden(self):
+        self.assertEqual(self.get(self.other_client).status_code, 403)
+        self.assertEqual(self.get(self.client_user, before='abc').status_code, 400)
+
+
+@override_settings(**IN_MEMORY_CHAT)
+class ChatAssignmentTests(TransactionTestCase):
+    def setUp(self):
+        self.client_user = CustomUser.objects.create_user('client1', 'client1@example.com', 'x')
+        self.engineers = [
+            CustomUser.objects.create_user(f'eng{n}', f'eng{n}@example.com', 'x', role='proposal_engineer')
+            for n in (1, 2)
+        ]
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{user.username}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_name': user.username}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def drain(self, communicator, expand_batches=True):
+        messages = []
+        while not await communicator.receive_nothing(timeout=0.1):
+            frame = json.loads(await communicator.receive_from())
+            if expand_batches and frame.get('type') == 'chat.batch':
+                messages.extend(frame['messages'])
+            else:
+                messages.append(frame)
+        return messages
+
+    def test_second_engineer_sees_client_as_taken(self):
+        async def scenario():
+            eng1 = await self.connect(self.engineers[0])
+            eng2 = await self.connect(self.engineers[1])
+            message = {'message': 'Hello', 'sender_type': 'agent', 'receiver': 'client1'}
+            await eng1.send_to(text_data=json.dumps(message))
+            await self.drain(eng1)
+            self.assertEqual(await get_assignment_registry().owner('client1'), 'eng1')
+
+            await self.drain(eng2)
+            await eng2.send_to(text_data=json.dumps(message))
+            replies = await self.drain(eng2)
+            self.assertIn('client1 is with another engineer.', [reply['message'] for reply in replies])
+
+            await eng1.disconnect()
+            self.assertIsNone(await get_assignment_registry().owner('client1'))
+            replies = await self.drain(eng2)
+            self.assertIn('client1 is available.', [reply['message'] for reply in replies])
+            await eng2.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_read_confirmation_carries_high_water_mark(self):
+        async def scenario():
+            client = await self.connect(self.client_user)
+            engineer = await self.connect(self.engineers[0])
+            await engineer.send_to(text_data=json.dumps({'message': 'Hello', 'sender_type': 'agent', 'receiver': 'client1'}))
+            frames = await self.drain(client)
+            reply = next(frame for frame in frames if frame['sender_type'] == 'agent')
+            await self.drain(engineer)
+
+            await client.send_to(text_data=json.dumps({
+                'message_type': 'mark_read', 'sender_type': 'client', 'room_name': 'client1',
+            }))
+            confirmations = [frame for frame in await self.drain(engineer) if frame.get('type') == 'read_confirmation']
+            self.assertEqual(confirmations, [{
+                'type': 'read_confirmation', 'client': 'client1', 'sender_type': 'agent', 'read_up_to': reply['message_id'],
+            }])
+            await client.disconnect()
+            await engineer.disconnect()
+
+        async_to_sync(scenario)()
+
+    def read_confirmations(self, frames):
+        return [frame for frame in frames if frame.get('type') == 'read_confirmation']
+
+    def test_read_confirmation_reaches_reconnected_engineers(self):
+        async def scenario():
+            engineer = await self.connect(self.engineers[0])
+            await engineer.send_to(text_data=json.dumps({'message': 'Hello', 'sender_type': 'agent', 'receiver': 'client1'}))
+            reply = next(frame for frame in await self.drain(engineer) if frame.get('message') == 'Hello')
+            # The reconnected engineer is no longer in chat_client1 and nobody holds the room
+            await engineer.disconnect()
+            engineer = await self.connect(self.engineers[0])
+            other = await self.connect(self.engineers[1])
+            await self.drain(engineer)
+            await self.drain(other)
+
+            client = await self.connect(self.client_user)  # reads on connect
+            expected = [{'type': 'read_confirmation', 'client': 'client1', 'sender_type': 'agent', 'read_up_to': reply['message_id']}]
+            self.assertEqual(self.read_confirmations(await self.drain(engineer)), expected)
+            self.assertEqual(self.read_confirmations(await self.drain(other)), expected)
+            for communicator in (client, engineer, other):
+                await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_read_confirmation_reaches_every_tab_of_the_assigned_engineer(self):
+        async def scenario():
+            client = await self.connect(self.client_user)
+            first_tab = await self.connect(self.engineers[0])
+            second_tab = await self.connect(self.engineers[0])
+            other = await self.connect(self.engineers[1])
+            await first_tab.send_to(text_data=json.dumps({'message': 'Hello', 'sender_type': 'agent', 'receiver': 'client1'}))
+            for communicator in (client, first_tab, second_tab, other):
+                await self.drain(communicator)
+
+            await client.send_to(text_data=json.dumps({
+                'message_type': 'mark_read', 'sender_type': 'client', 'room_name': 'client1',
+            }))
+            self.assertEqual(len(self.read_confirmations(await self.drain(first_tab))), 1)
+            self.assertEqual(len(self.read_confirmations(await self.drain(second_tab))), 1)
+            self.assertEqual(self.read_confirmations(await self.drain(other)), [])
+            for communicator in (client, first_tab, second_tab, other):
+                await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def create_waiting_rooms(self, count, messages_per_room):
+        for n in range(count):
+            user = CustomUser.objects.create_user(f'waiting{n}', f'waiting{n}@example.com', 'x')
+            for m in range(messages_per_room):
+                ChatMessage.objects.create_message(
+                    room_name=user.username, sender=user, sender_type='client', content=f'{n}-{m}'
+                )
+
+    def test_engineer_connect_pages_waiting_rooms(self):
+        self.create_waiting_rooms(3, messages_per_room=3)
+        Conversation.objects.record_read('waiting2', 'agent')
+        Conversation.objects.filter(room_name='waiting0').update(
+            engineer_read_up_to=ChatMessage.objects.get(content='0-0').id, engineer_unread_count=2
+        )
+
+        async def scenario():
+            engineer = await self.connect(self.engineers[0])
+            frames = await self.drain(engineer, expand_batches=False)
+            batches = [frame for frame in frames if frame.get('type') == 'chat.batch']
+            # Personal group plus the engineers group, one frame each
+            self.assertEqual(len(batches), 2)
+            frames += [message for batch in batches for message in batch['messages']]
+            pages = [frame for frame in frames if frame.get('type') == 'conversations_page']
+            self.assertEqual(len(pages), 1)
+            self.assertEqual([room['client'] for room in pages[0]['rooms']], ['waiting1'])
+            self.assertIsNotNone(pages[0]['next_before'])
+            replayed = {frame['message'] for frame in frames if frame.get('sender_type') == 'client'}
+            self.assertEqual(replayed, {'1-1', '1-2'})
+
+            await engineer.send_to(text_data=json.dumps({
+                'message_type': 'load_conversations', 'before': pages[0]['next_before'],
+            }))
+            frames = await self.drain(engineer)
+            pages = [frame for frame in frames if frame.get('type') == 'conversations_page']
+            self.assertEqual([room['client'] for room in pages[0]['rooms']], ['waiting0'])
+            replayed = {frame['message'] for frame in frames if frame.get('sender_type') == 'client'}
+            self.assertEqual(replayed, {'0-1', '0-2'})
+            self.assertIsNone(pages[0]['next_before'])
+            await engineer.disconnect()
+
+        with patch.object(consumers, 'OFFLINE_ROOMS_PAGE_SIZE', 1), \
+                patch.object(consumers, 'OFFLINE_MESSAGES_PER_ROOM', 2):
+            async_to_sync(scenario)()
+        self.assertEqual(Conversation.objects.get(room_name='waiting1').engineer_unread_count, 3)
+
+    def test_file_message_is_handed_off_by_id_once(self):
+        upload = ChatMessage.objects.create_message(
+            room_name='client1', sender=self.client_user, sender_type='client', content='',
+            file='chat_files/spec.pdf', file_name='spec.pdf', file_url='https://files.example.com/spec.pdf',
+            file_pending=True
+        )
+        # Same name uploaded earlier; a lookup by file name could pick either row
+        ChatMessage.objects.create_message(
+            room_name='client1', sender=self.client_user, sender_type='client', content='',
+            file='chat_files/spec_old.pdf', file_name='spec.pdf', file_url='https://files.example.com/spec_old.pdf'
+        )
+        announcement = {'message': 'Datasheet', 'sender_type': 'client', 'message_id': str(upload.id)}
+
+        async def scenario():
+            client = await self.connect(self.client_user)
+            await self.drain(client)
+            await client.send_to(text_data=json.dumps(announcement))
+            frames = [frame for frame in await self.drain(client) if frame.get('sender') == 'client1']
+            self.assertEqual([(frame['message_id'], frame['file_url']) for frame in frames],
+                             [(str(upload.id), 'https://files.example.com/spec.pdf')])
+
+            await client.send_to(text_data=json.dumps(announcement))
+            self.assertEqual(await self.drain(client), [{'error': 'Unknown or already sent file'}])
+            await client.disconnect()
+
+        async_to_sync(scenario)()
+        upload.refresh_from_db()
+        self.assertEqual((upload.content, upload.file_pending), ('Datasheet', False))
+        self.assertEqual(ChatMessage.objects.filter(room_name='client1').count(), 2)
@@ -0,0 +1,203 @@
+"""
+Chat attachment intake.
+
+Single-request uploads are spooled to a temporary file by ChatUploadHandler
+rather than held in worker memory and checked for the PDF signature in their
+first bytes. The body is hashed as it is spooled: content that was already
+stored is reused at once, anything new is staged and pushed to the storage
+backend by the media worker (api.media). Either way the ChatMessage row is
+written once; a staged file's message gets its file_url when the worker is done.
+
+Resumable uploads (ChatUpload) go through init -> PUT chunk N -> complete.
+Chunks may arrive in any order, in parallel and more than once; each is
+written to CHAT_UPLOAD_STAGING_DIR/<upload id>/<index> through a temp name and
+an atomic rename, so a retried chunk simply replaces the earlier attempt.
+Completion assembles the chunks into one temp file and hands it over exactly
+like a single-request upload.
+"""
+from contextlib import contextmanager
+from datetime import timedelta
+import hashlib
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import StopUpload
+from django.db import transaction
+from django.utils import timezone
+
+from api.blobs import HashingUploadHandler
+from api.media import discard_staged, enqueue_media_upload, stage_media
+
+from .models import ChatMessage, ChatUpload
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+PDF_SIGNATURE = b'%PDF-'
+# Readers accept the header anywhere in the first KiB
+SIGNATURE_WINDOW = 1024
+CHUNK_SIZE = 1024 * 1024
+COPY_BUFFER_SIZE = 64 * 1024
+# Unfinished resumable uploads older than this are purged with their chunks
+UPLOAD_TTL = timedelta(hours=24)
+
+
+class ChatUploadHandler(HashingUploadHandler):
+    """Spools and hashes the upload, and stops reading it once it passes MAX_UPLOAD_SIZE."""
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > MAX_UPLOAD_SIZE:
+            self.request.upload_error = 'File size exceeds 10MB'
+            raise StopUpload(connection_reset=False)
+        return super().receive_data_chunk(raw_data, start)
+
+
+def has_pdf_signature(file):
+    file.seek(0)
+    head = file.read(SIGNATURE_WINDOW)
+    file.seek(0)
+    return PDF_SIGNATURE in head
+
+
+def pdf_file_name(name):
+    # The content decides the type; the stored name just has to say so too
+    return name if name.lower().endswith('.pdf') else f"{name}.pdf"
+
+
+def create_file_message(file, file_name, room_name, user, sender_type):
+    """
+    File message for `file` (a django File). Stored content is reused at once;
+    new content is staged and queued for the media worker, and the message
+    keeps a blank file_url until the worker has stored it.
+    """
+    blob, staged = stage_media(ChatMessage._meta.get_field('file'), file)
+    try:
+        with transaction.atomic():
+            message = ChatMessage.objects.create_message(
+                room_name=room_name,
+                sender=user,
+                sender_type=sender_type,
+                content='',  # Empty content for file-only messages
+                file=blob.name if blob else None,
+                blob=blob,
+                file_name=file_name,
+                file_pending=True,
+                file_url=blob.url if blob else '',
+                assistance=None if sender_type == 'client' else user
+            )
+            if staged is not None:
+                enqueue_media_upload(message, 'file', staged, file_name, requested_by=user)
+    except Exception:
+        if staged is not None:
+            discard_staged(staged.path)
+        raise
+    return message
+
+
+def staging_dir(upload):
+    return Path(settings.CHAT_UPLOAD_STAGING_DIR) / str(upload.pk)
+
+
+def write_chunk(upload, index, stream, head=b''):
+    """
+    Stage chunk `index`: `head` (bytes already read off the stream) followed by
+    the rest of `stream`, exactly chunk_length(index) bytes in total. Returns
+    False on a short body.
+    """
+    expected = upload.chunk_length(index)
+    directory = staging_dir(upload)
+    directory.mkdir(parents=True, exist_ok=True)
+    partial = directory / f"{index}.{uuid.uuid4().hex}.part"
+    written = len(head)
+    try:
+        with open(partial, 'wb') as chunk_file:
+            chunk_file.write(head)
+            while written < expected:
+                data = stream.read(min(COPY_BUFFER_SIZE, expected - written))
+                if not data:
+                    break
+                chunk_file.write(data)
+                written += len(data)
+        if written != expected:
+            return False
+        os.replace(partial, directory / str(index))
+        return True
+    finally:
+        if partial.exists():
+            partial.unlink()
+
+
+def received_chunks(upload):
+    directory = staging_dir(upload)
+    if not directory.is_dir():
+        return []
+    received = []
+    for entry in directory.iterdir():
+        if entry.name.isdigit():
+            index = int(entry.name)
+            if index < upload.total_chunks and entry.stat().st_size == upload.chunk_length(index):
+                received.append(index)
+    return sorted(received)
+
+
+def missing_chunks(upload):
+    return sorted(set(range(upload.total_chunks)) - set(received_chunks(upload)))
+
+
+@contextmanager
+def assembled_file(upload):
+    """The staged chunks concatenated into one temporary file, as a django File hashed on the way."""
+    directory = staging_dir(upload)
+    digest = hashlib.sha256()
+    with tempfile.TemporaryFile(dir=directory) as assembled:
+        for index in range(upload.total_chunks):
+            with open(directory / str(index), 'rb') as chunk_file:
+                for data in iter(lambda: chunk_file.read(COPY_BUFFER_SIZE), b''):
+                    digest.update(data)
+                    assembled.write(data)
+        assembled.seek(0)
+        file = File(assembled, name=upload.file_name)
+        file.sha256 = digest.hexdigest()
+        yield file
+
+
+def discard_staging(upload):
+    shutil.rmtree(staging_dir(upload), ignore_errors=True)
+
+
+def complete_upload(upload):
+    """
+    Hand the assembled file over and create its ChatMessage. The caller has
+    already moved the upload to 'completing'; it goes back to 'open' if that
+    fails so the client can retry. Raises ValueError when the content is not a PDF.
+    """
+    try:
+        with assembled_file(upload) as file:
+            if not has_pdf_signature(file):
+                raise ValueError('Only PDF files are allowed')
+            message = create_file_message(file, upload.file_name, upload.room_name, upload.user, upload.sender_type)
+    except Exception:
+        ChatUpload.objects.filter(pk=upload.pk).update(status='open')
+        raise
+    upload.status = 'completed'
+    upload.message = message
+    upload.save(update_fields=['status', 'message'])
+    discard_staging(upload)
+    logger.info(f"Chunked upload {upload.pk} completed as message {message.id}")
+    return message
+
+
+def purge_stale_uploads(now=None):
+    """Drop unfinished uploads older than UPLOAD_TTL and their staged chunks. Returns how many were removed."""
+    cutoff = (now or timezone.now()) - UPLOAD_TTL
+    stale = list(ChatUpload.objects.filter(created_at__lt=cutoff).exclude(status='completed'))
+    for upload in stale:
+        discard_staging(upload)
+    ChatUpload.objects.filter(pk__in=[upload.pk for upload in stale]).delete()
+    return len(stale)
@@ -2,66 +2,220 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from .models import ChatMessage
-from django.utils import timezone
-from django.core.files.base import ContentFile
+from .models import ChatMessage, ChatUpload, Conversation
+from .consumers import message_frame
+from .uploads import (
+    CHUNK_SIZE, MAX_UPLOAD_SIZE, PDF_SIGNATURE, SIGNATURE_WINDOW, ChatUploadHandler, complete_upload, has_pdf_signature, missing_chunks,
+    create_file_message, pdf_file_name, received_chunks, write_chunk
+)
+from django.shortcuts import get_object_or_404
 import logging
 
 logger = logging.getLogger(__name__)
 
+def file_message_response(msg):
+    # A new file is still on its way to storage; the websocket announces it (media_stored)
+    stored = bool(msg.file_url)
+    return Response({
+        'file_url': msg.file_url or None,  # Return raw Cloudinary URL
+        'file_name': msg.file_name,
+        'room_name': msg.room_name,
+        'sender_type': msg.sender_type,
+        'sender': msg.sender.username,
+        'message_id': str(msg.id),  # Include message_id for WebSocket lookup
+        'status': 'stored' if stored else 'pending',
+    }, status=status.HTTP_200_OK if stored else status.HTTP_202_ACCEPTED)
+
+
+def upload_room(request):
+    """(sender_type, room_name) for an upload by request.user; room_name is '' when an agent did not name one."""
+    sender_type = 'agent' if getattr(request.user, 'role', None) == 'proposal_engineer' else 'client'
+    room_name = request.user.username if sender_type == 'client' else request.data.get('room_name', '')
+    return sender_type, room_name
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def upload_file(request):
     try:
+        # Must be set before request.FILES is first read
+        request._request.upload_handlers = [ChatUploadHandler(request._request)]
         if 'file' not in request.FILES:
+            upload_error = getattr(request._request, 'upload_error', None)
+            if upload_error:
+                logger.error(f"Upload rejected for {request.user.username}: {upload_error}")
+                return Response({'error': upload_error}, status=status.HTTP_400_BAD_REQUEST)
             logger.error("No file provided")
             return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
 
         file = request.FILES['file']
-        file_name = file.name
-        file_size = file.size
 
-        if not file_name.lower().endswith('.pdf'):
-            logger.error(f"Invalid file type: {file_name}")
+        if not has_pdf_signature(file):
+            logger.error(f"Invalid file type: {file.name}")
             return Response({'error': 'Only PDF files are allowed'}, status=status.HTTP_400_BAD_REQUEST)
+        file_name = pdf_file_name(file.name)
 
-        if file_size > 10 * 1024 * 1024:  # 10MB limit
-            logger.error(f"File size too large: {file_size} bytes")
-            return Response({'error': 'File size exceeds 10MB'}, status=status.HTTP_400_BAD_REQUEST)
-
-        sender_type = 'agent' if getattr(request.user, 'role', None) == 'proposal_engineer' else 'client'
-        room_name = request.user.username if sender_type == 'client' else request.POST.get('room_name', '')
-
+        sender_type, room_name = upload_room(request)
         if not room_name:
             logger.error("No room_name provided for agent upload")
             return Response({'error': 'Room name required for agent uploads'}, status=status.HTTP_400_BAD_REQUEST)
 
-        msg = ChatMessage.objects.create(
-            room_name=room_name,
-            sender=request.user,
-            sender_type=sender_type,
-            content='',  # Empty content for file-only messages
-            file_name=file_name,
-            is_read=False,
-            assistance=None if sender_type == 'client' else request.user
-        )
-        # Use clean file path without redundant segments
-        file_path = f"chat_files/{timezone.now().strftime('%Y/%m/%d')}/{file_name}"
-        msg.file.save(file_path, ContentFile(file.read()))
-        msg.save()
+        # Reused if already stored, otherwise staged for the media worker; the message row is inserted once
+        msg = create_file_message(file, file_name, room_name, request.user, sender_type)
 
         # Log the saved file URL and path
         logger.info(f"File uploaded successfully: {file_name} by {request.user.username} to {room_name}")
-        logger.debug(f"Saved file URL: {msg.file.url}, Path: {msg.file.name}")
-
-        return Response({
-            'file_url': msg.file.url,  # Return raw Cloudinary URL
-            'file_name': file_name,
-            'room_name': room_name,
-            'sender_type': sender_type,
-            'sender': request.user.username,
-            'message_id': str(msg.id)  # Include message_id for WebSocket lookup
-        }, status=status.HTTP_200_OK)
+        logger.debug(f"Saved file URL: {msg.file_url or '(pending)'}, Path: {msg.file.name if msg.file else '(staged)'}")
+
+        return file_message_response(msg)
     except Exception as e:
         logger.error(f"Error uploading file for {request.user.username}: {str(e)}")
-        return Response({'error': 'File upload failed'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return Response({'error': 'File upload failed'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def chunked_upload_state(upload):
+    return {
+        'upload_id': str(upload.pk),
+        'file_name': upload.file_name,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'received': received_chunks(upload),
+        'status': upload.status,
+    }
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def start_chunked_upload(request):
+    """Begin a resumable upload: {file_name, size, room_name?} -> upload id and chunk layout."""
+    file_name = str(request.data.get('file_name', '')).strip()
+    try:
+        size = int(request.data.get('size'))
+    except (TypeError, ValueError):
+        return Response({'error': 'size must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    if not file_name:
+        return Response({'error': 'file_name is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        return Response({'error': 'File size exceeds 10MB'}, status=status.HTTP_400_BAD_REQUEST)
+
+    sender_type, room_name = upload_room(request)
+    if not room_name:
+        return Response({'error': 'Room name required for agent uploads'}, status=status.HTTP_400_BAD_REQUEST)
+
+    upload = ChatUpload.objects.create(
+        user=request.user,
+        room_name=room_name,
+        sender_type=sender_type,
+        file_name=pdf_file_name(file_name[:250]),
+        size=size,
+        chunk_size=CHUNK_SIZE,
+    )
+    logger.info(f"Chunked upload {upload.pk} started: {upload.file_name} ({size} bytes) by {request.user.username}")
+    return Response(chunked_upload_state(upload), status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def chunked_upload_status(request, upload_id):
+    """Which chunks the server already holds, so a client can resume after a drop."""
+    upload = get_object_or_404(ChatUpload, pk=upload_id, user=request.user)
+    return Response(chunked_upload_state(upload), status=status.HTTP_200_OK)
+
+
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def upload_chunk(request, upload_id, index):
+    """Raw chunk body; chunks can be sent in any order, in parallel, and retried."""
+    upload = get_object_or_404(ChatUpload, pk=upload_id, user=request.user)
+    if upload.status != 'open':
+        return Response({'error': 'Upload is already complete'}, status=status.HTTP_409_CONFLICT)
+    if index >= upload.total_chunks:
+        return Response({'error': 'Chunk index out of range'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length != upload.chunk_length(index):
+        return Response(
+            {'error': f'Chunk {index} must be exactly {upload.chunk_length(index)} bytes'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    # Read straight from the request stream; a chunk is never parsed or buffered whole
+    head = b''
+    if index == 0:
+        # Reject non-PDFs on the first chunk instead of after the whole file arrived
+        head = request._request.read(min(upload.chunk_length(0), SIGNATURE_WINDOW))
+        if PDF_SIGNATURE not in head:
+            return Response({'error': 'Only PDF files are allowed'}, status=status.HTTP_400_BAD_REQUEST)
+    if not write_chunk(upload, index, request._request, head=head):
+        return Response({'error': 'Incomplete chunk body'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def complete_chunked_upload(request, upload_id):
+    upload = get_object_or_404(ChatUpload.objects.select_related('message__sender'), pk=upload_id, user=request.user)
+    if upload.status == 'completed' and upload.message:
+        return file_message_response(upload.message)
+
+    missing = missing_chunks(upload)
+    if missing:
+        return Response({'error': 'Upload is missing chunks', 'missing': missing}, status=status.HTTP_400_BAD_REQUEST)
+    # Only one request gets to assemble and store the file
+    if not ChatUpload.objects.filter(pk=upload.pk, status='open').update(status='completing'):
+        return Response({'error': 'Upload is already being completed'}, status=status.HTTP_409_CONFLICT)
+
+    try:
+        msg = complete_upload(upload)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        logger.error(f"Error completing chunked upload {upload.pk} for {request.user.username}: {str(e)}")
+        return Response({'error': 'File upload failed'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return file_message_response(msg)
+
+
+ROOM_MESSAGES_DEFAULT_LIMIT = 50
+ROOM_MESSAGES_MAX_LIMIT = 200
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def room_messages(request, room_name):
+    """
+    History of one room, newest page first: ?before=<message_id>&limit=<n>.
+    Keyset pagination on (room_name, id), so every page is one index range scan;
+    file URLs come from the stored column instead of the storage backend, and
+    read state from the conversation's high-water marks.
+    """
+    user = request.user
+    if room_name != user.username and getattr(user, 'role', None) not in ('proposal_engineer', 'admin'):
+        return Response({'error': 'Not allowed to read this room'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        limit = min(max(int(request.GET.get('limit', ROOM_MESSAGES_DEFAULT_LIMIT)), 1), ROOM_MESSAGES_MAX_LIMIT)
+        before = int(request.GET['before']) if request.GET.get('before') else None
+    except ValueError:
+        return Response({'error': 'before and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+    messages = ChatMessage.objects.filter(room_name=room_name)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    page = list(messages.order_by('-id').values(*ChatMessage.FRAME_FIELDS)[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    conversation = (
+        Conversation.objects.filter(room_name=room_name).only('engineer_read_up_to', 'client_read_up_to').first()
+        or Conversation(room_name=room_name)
+    )
+
+    return Response({
+        'results': [
+            message_frame(msg, is_read=conversation.is_read(msg['id'], msg['sender_type']))
+            for msg in reversed(page)
+        ],
+        'next_before': str(page[-1]['id']) if has_more else None,
+    }, status=status.HTTP_200_OK)
@@ -25,6 +25,9 @@ import api from "../api";
 import { ACCESS_TOKEN } from "../constants";
 import "../styles/ChatComponent.css";
 
+// Chunks of a resumable attachment upload sent at the same time
+const UPLOAD_CONCURRENCY = 3;
+
 const ChatComponent = () => {
   const [isOpen, setIsOpen] = useState(false);
   const [wsConnected, setWsConnected] = useState(false);
@@ -34,6 +37,8 @@ const ChatComponent = () => {
   const [clients, setClients] = useState([]);
   const [selectedClient, setSelectedClient] = useState(null);
   const [unreadMessages, setUnreadMessages] = useState({});
+  const [olderConversationsCursor, setOlderConversationsCursor] =
+    useState(null);
   const [error, setError] = useState("");
   const [selectedFile, setSelectedFile] = useState(null);
   const [uploading, setUploading] = useState(false);
@@ -46,6 +51,7 @@ const ChatComponent = () => {
   const fileInputRef = useRef(null);
   const processedMessageIds = useRef(new Set());
   const isConnecting = useRef(false);
+  const pendingUploads = useRef({});
 
   const publicPages = [
     "/login",
@@ -178,24 +184,26 @@ const ChatComponent = () => {
       pendingMarkRead.current = [];
     };
 
-    ws.current.onmessage = (event) => {
+    const handleFrame = (data) => {
       try {
-        const data = JSON.parse(event.data);
         console.log("WebSocket message:", data);
         if (data.error) {
           setError(data.error);
           return;
         }
 
+        // Read receipts are a high-water mark: every message by sender_type up to read_up_to is read
         if (data.type === "read_confirmation") {
-          const { message_ids, client } = data;
+          const { client, sender_type, read_up_to } = data;
           const key = user.senderType === "client" ? user.username : client;
           setMessages((prev) => {
             const existingMessages = prev[key] || [];
             return {
               ...prev,
               [key]: existingMessages.map((msg) =>
-                message_ids.includes(msg.messageId)
+                msg.senderType === sender_type &&
+                msg.messageId &&
+                Number(msg.messageId) <= Number(read_up_to)
                   ? { ...msg, isRead: true }
                   : msg
               ),
@@ -204,6 +212,42 @@ const ChatComponent = () => {
           return;
         }
 
+        // A file finished uploading to storage in the background (or failed to)
+        if (data.type === "media_stored") {
+          if (!data.message_id) return;
+          const { client, message_id, file_url, status } = data;
+          const key = user.senderType === "client" ? user.username : client;
+          setMessages((prev) => {
+            const existingMessages = prev[key] || [];
+            return {
+              ...prev,
+              [key]: existingMessages.map((msg) =>
+                msg.messageId === message_id
+                  ? { ...msg, fileUrl: file_url, fileFailed: status === "failed" }
+                  : msg
+              ),
+            };
+          });
+          return;
+        }
+
+        // Engineers receive waiting rooms one page at a time; next_before requests the next page
+        if (data.type === "conversations_page") {
+          const { rooms, next_before } = data;
+          setClients((prev) => [
+            ...new Set([...prev, ...rooms.map((room) => room.client)]),
+          ]);
+          setUnreadMessages((prev) => {
+            const newUnread = { ...prev };
+            rooms.forEach(({ client, unread_count }) => {
+              newUnread[client] = Math.max(newUnread[client] || 0, unread_count);
+            });
+            return newUnread;
+          });
+          setOlderConversationsCursor(next_before);
+          return;
+        }
+
         // Relax validation to allow file-only messages
         if (!data.sender_type || !data.client) {
           console.log(
@@ -408,6 +452,21 @@ const ChatComponent = () => {
       }
     };
 
+    ws.current.onmessage = (event) => {
+      try {
+        const data = JSON.parse(event.data);
+        // chat.batch carries several message frames in one websocket frame (see chat/consumers.py)
+        if (data.type === "chat.batch") {
+          data.messages.forEach(handleFrame);
+          return;
+        }
+        handleFrame(data);
+      } catch (e) {
+        console.error("WebSocket message error:", e);
+        setError("Error processing message.");
+      }
+    };
+
     ws.current.onclose = () => {
       console.log("WebSocket closed");
       setWsConnected(false);
@@ -417,6 +476,7 @@ const ChatComponent = () => {
         setClients([]);
         setSelectedClient(null);
         setUnreadMessages({});
+        setOlderConversationsCursor(null);
       }
       if (reconnectAttempts.current < maxReconnectAttempts) {
         reconnectAttempts.current += 1;
@@ -553,6 +613,70 @@ const ChatComponent = () => {
     setError("");
   };
 
+  // Resumable upload: init, PUT the chunks in parallel, then complete. A
+  // failed attempt keeps its upload id so a retry only sends missing chunks.
+  const uploadInChunks = async (file) => {
+    const headers = {
+      Authorization: `Bearer ${localStorage.getItem(ACCESS_TOKEN)}`,
+    };
+    const key = `${selectedClient || ""}:${file.name}:${file.size}:${file.lastModified}`;
+    let upload = null;
+    if (pendingUploads.current[key]) {
+      try {
+        const status = await api.get(
+          `/api/chat/uploads/${pendingUploads.current[key]}/`,
+          { headers }
+        );
+        upload = status.data;
+      } catch (err) {
+        console.warn("Could not resume upload, starting over:", err);
+      }
+    }
+    if (!upload || upload.status === "completed") {
+      const started = await api.post(
+        "/api/chat/uploads/",
+        {
+          file_name: file.name,
+          size: file.size,
+          ...(user.senderType === "agent" && { room_name: selectedClient }),
+        },
+        { headers }
+      );
+      upload = started.data;
+      pendingUploads.current[key] = upload.upload_id;
+    }
+
+    const received = new Set(upload.received);
+    const queue = [];
+    for (let index = 0; index < upload.total_chunks; index++) {
+      if (!received.has(index)) queue.push(index);
+    }
+    const sendNext = async () => {
+      while (queue.length) {
+        const index = queue.shift();
+        const start = index * upload.chunk_size;
+        await api.put(
+          `/api/chat/uploads/${upload.upload_id}/chunks/${index}/`,
+          file.slice(start, start + upload.chunk_size),
+          {
+            headers: { ...headers, "Content-Type": "application/octet-stream" },
+          }
+        );
+      }
+    };
+    await Promise.all(
+      Array.from({ length: UPLOAD_CONCURRENCY }, () => sendNext())
+    );
+
+    const response = await api.post(
+      `/api/chat/uploads/${upload.upload_id}/complete/`,
+      null,
+      { headers }
+    );
+    delete pendingUploads.current[key];
+    return response;
+  };
+
   const handleFileUpload = async () => {
     if (!ws.current || !wsConnected || !user || !selectedFile) return;
     if (user.senderType === "agent" && !selectedClient) {
@@ -563,19 +687,8 @@ const ChatComponent = () => {
     setUploading(true);
     setError("");
 
-    const formData = new FormData();
-    formData.append("file", selectedFile);
-    if (user.senderType === "agent") {
-      formData.append("room_name", selectedClient);
-    }
-
     try {
-      const response = await api.post("/api/chat/upload/", formData, {
-        headers: {
-          "Content-Type": "multipart/form-data",
-          Authorization: `Bearer ${localStorage.getItem(ACCESS_TOKEN)}`,
-        },
-      });
+      const response = await uploadInChunks(selectedFile);
       const { file_name, room_name, sender, sender_type, message_id } =
         response.data;
       console.log("Backend upload response:", {
@@ -597,7 +710,7 @@ const ChatComponent = () => {
         receiver,
         room_name: effectiveRoom,
         file_name,
-        message_id, // Include message_id to help backend locate the message
+        message_id, // The server announces exactly this uploaded message
       };
 
       ws.current.send(JSON.stringify(payload));
@@ -651,6 +764,17 @@ const ChatComponent = () => {
     }
   };
 
+  const handleLoadOlderConversations = () => {
+    if (ws.current?.readyState !== WebSocket.OPEN) return;
+    ws.current.send(
+      JSON.stringify({
+        message_type: "load_conversations",
+        before: olderConversationsCursor,
+      })
+    );
+    setOlderConversationsCursor(null);
+  };
+
   const handleClientSelect = (client) => {
     setSelectedClient(client);
     if (user.senderType === "agent") {
@@ -939,6 +1063,16 @@ const ChatComponent = () => {
                     ))
                   )}
                 </List>
+                {olderConversationsCursor && (
+                  <Button
+                    size="small"
+                    fullWidth
+                    onClick={handleLoadOlderConversations}
+                    disabled={!wsConnected}
+                  >
+                    Load older conversations
+                  </Button>
+                )}
               </Box>
             ) : (
               <Box
@@ -1057,10 +1191,14 @@ const ChatComponent = () => {
                                   <Typography
                                     sx={{
                                       fontSize: "0.75rem",
-                                      color: "error.main",
+                                      color: msg.fileFailed
+                                        ? "error.main"
+                                        : "inherit",
                                     }}
                                   >
-                                    (File unavailable)
+                                    {msg.fileFailed
+                                      ? "(File unavailable)"
+                                      : `${msg.fileName} (uploading…)`}
                                   </Typography>
                                 )
                               )}
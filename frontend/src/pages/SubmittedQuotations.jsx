@@ -361,12 +361,14 @@ function SubmittedQuotations() {
       if (!access) {
         throw new Error("No access token found.");
       }
-      await api.post(
+      const response = await api.post(
         `/api/quotations/${quotationId}/submit/`,
         {},
         { headers: { Authorization: `Bearer ${access}` } }
       );
-      setSuccessMessage("Quotation submitted successfully via email!");
+      setSuccessMessage(
+        response.data?.detail || "Quotation queued for submission via email!"
+      );
       setOpenSuccess(true);
       await fetchData();
     } catch (err) {